@@ -1,96 +1,378 @@
+from django.conf import settings
 from django.contrib import admin
 from django.contrib import messages
-from .models import Item, Order, OrderItem, Discount, Tax
-import stripe
-from django.conf import settings
+from django.db.models import Count, Q, Sum
+from django.template.response import TemplateResponse
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.html import format_html
+from .models import Item, Order, OrderItem, Discount, Tax, Job, JobBatch, StockShard, Reservation, SalesRollup, ItemPopularity, ItemRecommendation, CheckoutSession
+from . import jobs, shards
+
+class StockShardInline(admin.TabularInline):
+    model = StockShard
+    extra = 0
+
+@admin.register(Item)
+class ItemAdmin(admin.ModelAdmin):
+    """
+    Админка для модели Item.
+    Позволяет задавать остаток товара на складе, разбитый на части.
+    """
+    list_display = ['name', 'price', 'currency', 'available']
+    inlines = [StockShardInline]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(available=Sum('stock_shards__quantity'))
+
+    @admin.display(ordering='available')
+    def available(self, obj):
+        return obj.available
+
+@admin.register(Reservation)
+class ReservationAdmin(admin.ModelAdmin):
+    """
+    Админка для резервов товаров.
+    """
+    list_display = ['id', 'item', 'order', 'quantity', 'status', 'expires_at']
+    list_filter = ['status']
+    readonly_fields = ['item', 'shard', 'order', 'quantity', 'status', 'expires_at', 'created_at']
+
+    def get_list_select_related(self, request):
+        # При ORDER_SHARDING заказ хранится в БД своей валюты и не присоединяется к резерву
+        return ['item'] if settings.ORDER_SHARDS else super().get_list_select_related(request)
+
+@admin.register(ItemPopularity)
+class ItemPopularityAdmin(admin.ModelAdmin):
+    """
+    Админка для рейтинга популярности товаров. Только для чтения: рейтинг пересчитывает rollup_popularity.
+    """
+    list_display = ['item', 'currency', 'score', 'updated_at']
+    list_filter = ['currency']
+    ordering = ['-score']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(ItemRecommendation)
+class ItemRecommendationAdmin(admin.ModelAdmin):
+    """
+    Админка для рекомендаций «покупают вместе». Только для чтения: их пересчитывает build_recommendations.
+    """
+    list_display = ['item', 'neighbours', 'updated_at']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+@admin.register(CheckoutSession)
+class CheckoutSessionAdmin(admin.ModelAdmin):
+    """
+    Админка для сессий Stripe Checkout. Только для чтения: данные приходят из Stripe.
+    """
+    list_display = ['stripe_id', 'currency', 'status', 'payment_status', 'amount_total', 'order', 'created_at']
+    list_filter = ['currency', 'status', 'payment_status']
+    search_fields = ['stripe_id']
+
+    def get_list_select_related(self, request):
+        # При ORDER_SHARDING заказ хранится в БД своей валюты и не присоединяется к сессии
+        return [] if settings.ORDER_SHARDS else super().get_list_select_related(request)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+class OrderShardFilter(admin.SimpleListFilter):
+    """
+    Выбор БД заказов при ORDER_SHARDING. Без выбора показываются заказы primary.
+    Без шардирования фильтр не отображается.
+    """
+    title = 'database'
+    parameter_name = 'db'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shards.get_shard_aliases()]
+
+    def queryset(self, request, queryset):
+        if self.value() in shards.get_shard_aliases():
+            return queryset.using(self.value())
+        return queryset
+
+class OrderShardAdminMixin:
+    """
+    Админка для моделей, которые при ORDER_SHARDING хранятся в БД валют.
+    Список показывает одну БД, выбранную фильтром, а объект открывается из БД, определенной по его id.
+    """
+    list_filter = [OrderShardFilter]
+    # Общее количество считалось бы только по primary
+    show_full_result_count = False
+
+    def get_object(self, request, object_id, from_field=None):
+        try:
+            alias = shards.alias_for_order_id(int(object_id))
+        except ValueError:
+            return None
+        return self.get_queryset(request).using(alias).filter(pk=object_id).first()
+
+@admin.register(Order)
+class OrderAdmin(OrderShardAdminMixin, admin.ModelAdmin):
+    """
+    Админка для заказов. Страница «Все БД заказов» опрашивает БД заказов параллельно
+    и показывает сводку по каждой и последние оплаченные заказы из всех БД вместе.
+    """
+    list_display = ['id', 'paid_at', 'discount', 'tax']
+    all_shards_limit = 100
+
+    def get_urls(self):
+        return [
+            path('all-shards/', self.admin_site.admin_view(self.all_shards_view), name='payments_order_all_shards'),
+        ] + super().get_urls()
+
+    def delete_model(self, request, obj):
+        shards.delete_orders(obj._state.db, [obj.pk])
+
+    def delete_queryset(self, request, queryset):
+        shards.delete_orders(queryset.db, list(queryset.values_list('pk', flat=True)))
+
+    def all_shards_view(self, request):
+        def load(alias):
+            orders = Order.objects.using(alias)
+            return {
+                **orders.aggregate(orders=Count('id'), paid=Count('paid_at')),
+                'lines': OrderItem.objects.using(alias).count(),
+                'latest': list(
+                    orders.filter(paid_at__isnull=False).order_by('-paid_at')
+                    .values('id', 'paid_at', 'discount_id', 'tax_id')[:self.all_shards_limit]
+                ),
+            }
+
+        results = shards.fan_out(load)
+        latest = sorted(
+            ({**order, 'db': alias} for alias, result in results.items() for order in result['latest']),
+            key=lambda order: order['paid_at'],
+            reverse=True,
+        )[:self.all_shards_limit]
+        for order in latest:
+            order['url'] = reverse('admin:payments_order_change', args=[order['id']])
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Все БД заказов',
+            'stats': [
+                {'db': alias, 'open': result['orders'] - result['paid'], **result}
+                for alias, result in results.items()
+            ],
+            'latest': latest,
+        }
+        return TemplateResponse(request, 'admin/payments/order/all_shards.html', context)
+
+@admin.register(OrderItem)
+class OrderItemAdmin(OrderShardAdminMixin, admin.ModelAdmin):
+    """
+    Админка для строк заказов.
+    """
+    list_display = ['id', 'order', 'item', 'quantity']
+
+@admin.register(SalesRollup)
+class SalesRollupAdmin(admin.ModelAdmin):
+    """
+    Админка для сводных продаж. Строки только для чтения: их поддерживает приложение.
+    """
+    list_display = ['day', 'item', 'currency', 'units', 'gross', 'discount', 'tax', 'net']
+    list_filter = ['currency']
+    date_hierarchy = 'day'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+def enqueue_batch(modeladmin, request, name, task_name, payloads):
+    """
+    Ставит массовое действие в очередь одной пачкой и выводит ссылку на ее прогресс.
+    """
+    batch = JobBatch.objects.create(name=name)
+    jobs.enqueue_many(task_name, payloads, batch=batch)
+    url = reverse('admin:payments_jobbatch_change', args=[batch.id])
+    modeladmin.message_user(
+        request,
+        format_html('Поставлено задач в очередь: {}. <a href="{}">Прогресс</a>', len(payloads), url),
+        messages.SUCCESS
+    )
 
-admin.site.register(Item)
-admin.site.register(Order)
-admin.site.register(OrderItem)
 @admin.register(Discount)
 class DiscountAdmin(admin.ModelAdmin):
     """
     Админка для модели Discount.
     Позволяет создавать скидки, автоматически создавая купоны в Stripe.
+    Вызовы Stripe выполняются в фоне воркером run_jobs.
     """
-    list_display = ['name', 'percent_off', 'duration', 'currency', 'stripe_coupon_id']
+    list_display = ['name', 'percent_off', 'duration', 'currency', 'active', 'stripe_coupon_id']
+    list_filter = ['active', 'currency']
+    actions = ['sync_to_stripe', 'deactivate']
 
     def get_readonly_fields(self, request, obj=None):
         if obj: 
-            return ['name', 'percent_off', 'duration', 'currency', 'stripe_coupon_id']
+            return ['name', 'percent_off', 'duration', 'currency', 'active', 'stripe_coupon_id']
         return super().get_readonly_fields(request, obj)
     
     def save_model(self, request, obj, form, change):
-        stripe.api_key = settings.STRIPE_KEYS[obj.currency]['secret']  
-        if not obj.stripe_coupon_id:
-            coupon = stripe.Coupon.create(
-                percent_off=obj.percent_off,
-                duration=obj.duration,
-                name=obj.name,
-                currency=obj.currency
-            )
-            obj.stripe_coupon_id = coupon.id
-        elif change:
+        if change and obj.stripe_coupon_id:
             messages.warning(
                 request,
                 "Изменение скидки в текущей реализации не обновит данные в Stripe. Для изменения скидки создайте новый объект."
             )
 
         super().save_model(request, obj, form, change)
+        if not obj.stripe_coupon_id:
+            jobs.enqueue('sync_discount', discount_id=obj.id)
+            messages.info(request, "Купон Stripe будет создан в фоновом режиме.")
         
     def delete_model(self, request, obj):
-        stripe.api_key = settings.STRIPE_KEYS[obj.currency]['secret']  
-        try:
-            if obj.stripe_coupon_id:
-                stripe.Coupon.delete(obj.stripe_coupon_id)
-        except stripe.error.InvalidRequestError as e:
-            messages.error(
-                request,
-                f"Ошибка удаления купона Stripe: {e.user_message}"
-            )
+        if obj.stripe_coupon_id:
+            jobs.enqueue('delete_stripe_coupon', currency=obj.currency, coupon_id=obj.stripe_coupon_id)
         super().delete_model(request, obj)
 
+    def delete_queryset(self, request, queryset):
+        jobs.enqueue_many('delete_stripe_coupon', [
+            {'currency': currency, 'coupon_id': coupon_id}
+            for currency, coupon_id in queryset.exclude(stripe_coupon_id=None).values_list('currency', 'stripe_coupon_id')
+        ])
+        super().delete_queryset(request, queryset)
+
+    @admin.action(description='Синхронизировать выбранные скидки со Stripe')
+    def sync_to_stripe(self, request, queryset):
+        queryset = queryset.filter(active=True)
+        enqueue_batch(self, request, 'Синхронизация скидок со Stripe', 'sync_discount', [
+            {'discount_id': discount_id} for discount_id in queryset.values_list('id', flat=True)
+        ])
+
+    @admin.action(description='Деактивировать выбранные скидки')
+    def deactivate(self, request, queryset):
+        queryset = queryset.filter(active=True)
+        payloads = [
+            {'currency': currency, 'coupon_id': coupon_id}
+            for currency, coupon_id in queryset.exclude(stripe_coupon_id=None).values_list('currency', 'stripe_coupon_id')
+        ]
+        # Удаленный в Stripe купон нельзя восстановить, при повторной синхронизации будет создан новый
+        queryset.update(active=False, stripe_coupon_id=None)
+        enqueue_batch(self, request, 'Деактивация скидок', 'delete_stripe_coupon', payloads)
+
 @admin.register(Tax)
 class TaxAdmin(admin.ModelAdmin):
     """
     Админка для модели Tax.
     Позволяет создавать иналоги, автоматически создавая налоговые ставки в Stripe.
+    Вызовы Stripe выполняются в фоне воркером run_jobs.
     """
-    list_display = ['name', 'percentage', 'currency', 'stripe_tax_rate_id']
+    list_display = ['name', 'percentage', 'currency', 'active', 'stripe_tax_rate_id']
+    list_filter = ['active', 'currency']
+    actions = ['sync_to_stripe', 'deactivate']
 
     def get_readonly_fields(self, request, obj=None):
         if obj: 
-            return ['name', 'percentage', 'currency', 'stripe_tax_rate_id']
+            return ['name', 'percentage', 'currency', 'active', 'stripe_tax_rate_id']
         return super().get_readonly_fields(request, obj)
 
     def save_model(self, request, obj, form, change):
-        stripe.api_key = settings.STRIPE_KEYS[obj.currency]['secret']  
-        if not obj.stripe_tax_rate_id:
-            tax_rate = stripe.TaxRate.create(
-                display_name=obj.name,
-                percentage=obj.percentage,
-                inclusive=False,
-            )
-            obj.stripe_tax_rate_id = tax_rate.id
-        elif change:
+        if change and obj.stripe_tax_rate_id:
             messages.warning(
                 request,
                 "Налоговые ставки Stripe неизменяемы. Для обновления параметров создайте новую ставку."
             )
             
         super().save_model(request, obj, form, change)
+        if not obj.stripe_tax_rate_id:
+            jobs.enqueue('sync_tax', tax_id=obj.id)
+            messages.info(request, "Налоговая ставка Stripe будет создана в фоновом режиме.")
 
     def delete_model(self, request, obj):
-        stripe.api_key = settings.STRIPE_KEYS[obj.currency]['secret']  
-        try:
-            if obj.stripe_tax_rate_id:
-                stripe.TaxRate.modify(
-                    obj.stripe_tax_rate_id,
-                    active=False
-                )
-        except stripe.error.StripeError as e:
-            messages.error(
-                request,
-                f"Ошибка деактивации налоговой ставки: {e.user_message}"
-            )
-        super().delete_model(request, obj)
\ No newline at end of file
+        if obj.stripe_tax_rate_id:
+            jobs.enqueue('deactivate_stripe_tax_rate', currency=obj.currency, tax_rate_id=obj.stripe_tax_rate_id)
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        jobs.enqueue_many('deactivate_stripe_tax_rate', [
+            {'currency': currency, 'tax_rate_id': tax_rate_id}
+            for currency, tax_rate_id in queryset.exclude(stripe_tax_rate_id=None).values_list('currency', 'stripe_tax_rate_id')
+        ])
+        super().delete_queryset(request, queryset)
+
+    @admin.action(description='Синхронизировать выбранные налоги со Stripe')
+    def sync_to_stripe(self, request, queryset):
+        queryset = queryset.filter(active=True)
+        enqueue_batch(self, request, 'Синхронизация налогов со Stripe', 'sync_tax', [
+            {'tax_id': tax_id} for tax_id in queryset.values_list('id', flat=True)
+        ])
+
+    @admin.action(description='Деактивировать выбранные налоги')
+    def deactivate(self, request, queryset):
+        queryset = queryset.filter(active=True)
+        payloads = [
+            {'currency': currency, 'tax_rate_id': tax_rate_id}
+            for currency, tax_rate_id in queryset.exclude(stripe_tax_rate_id=None).values_list('currency', 'stripe_tax_rate_id')
+        ]
+        queryset.update(active=False)
+        enqueue_batch(self, request, 'Деактивация налогов', 'deactivate_stripe_tax_rate', payloads)
+
+@admin.register(JobBatch)
+class JobBatchAdmin(admin.ModelAdmin):
+    """
+    Админка для групп фоновых задач.
+    Показывает прогресс выполнения массовых действий.
+    """
+    list_display = ['name', 'created_at', 'total', 'done', 'failed', 'progress']
+    readonly_fields = ['name', 'created_at', 'total', 'done', 'failed', 'progress']
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            total=Count('jobs'),
+            done=Count('jobs', filter=Q(jobs__status=Job.DONE)),
+            failed=Count('jobs', filter=Q(jobs__status=Job.FAILED)),
+        )
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.display(ordering='total')
+    def total(self, obj):
+        return obj.total
+
+    @admin.display(ordering='done')
+    def done(self, obj):
+        return obj.done
+
+    @admin.display(ordering='failed')
+    def failed(self, obj):
+        return obj.failed
+
+    @admin.display(description='progress')
+    def progress(self, obj):
+        if not obj.total:
+            return '-'
+        return f"{(obj.done + obj.failed) * 100 // obj.total}%"
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    """
+    Админка для фоновых задач.
+    Позволяет отслеживать статус задач и повторно запускать упавшие.
+    """
+    list_display = ['id', 'task', 'status', 'attempts', 'run_at', 'batch', 'updated_at']
+    list_filter = ['status', 'task', 'batch']
+    readonly_fields = ['task', 'payload', 'attempts', 'locked_at', 'last_error', 'batch', 'created_at', 'updated_at']
+    actions = ['retry']
+
+    @admin.action(description='Повторить выбранные задачи')
+    def retry(self, request, queryset):
+        updated = queryset.filter(status=Job.FAILED).update(status=Job.PENDING, attempts=0, run_at=timezone.now())
+        self.message_user(request, f'Задач поставлено на повтор: {updated}', messages.SUCCESS)
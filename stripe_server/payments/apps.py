@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class PaymentsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'payments'
+
+    def ready(self):
+        from django.conf import settings
+        from . import signals
+        if settings.STRIPE_API_BASE:
+            import stripe
+            stripe.api_base = settings.STRIPE_API_BASE
+        if settings.TRACING_ENABLED:
+            from .tracing import instrument_stripe
+            instrument_stripe()
@@ -0,0 +1,285 @@
+import atexit
+import glob
+import gzip
+import hashlib
+import hmac
+import json
+import os
+import queue
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from urllib.parse import urlencode
+from django.conf import settings
+from django.db import connections
+from django.http import QueryDict
+
+# Тело запроса больше этого размера не записывается, сохраняется только его длина
+MAX_BODY_SIZE = 65536
+# Строки из цифр не длиннее этого записываются как есть: это количества и id товаров из форм
+MAX_NUMERIC_STRING = 6
+# Поля, значения которых записываются как есть: они определяют ветку обработки и не содержат данных покупателя
+KEEP_FIELDS = {'op', 'currency', 'group_by'}
+
+
+def anonymize_session(session_key):
+    """
+    Заменяет ключ сессии устойчивым псевдонимом: запросы одного покупателя остаются связанными,
+    а по записи нельзя восстановить cookie сессии.
+    """
+    if not session_key:
+        return None
+    return hmac.new(settings.SECRET_KEY.encode(), f'capture:{session_key}'.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def is_sampled(session_key):
+    """
+    Выборка по сессии, а не по запросу, чтобы в запись попадали целые последовательности запросов покупателя.
+    """
+    digest = hashlib.sha256(f'{settings.SECRET_KEY}:{session_key}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64 < settings.CAPTURE_SAMPLE_RATE
+
+
+def get_shape(value, key=None):
+    """
+    Оставляет от данных запроса структуру: числа, флаги, короткие числовые строки и поля из KEEP_FIELDS сохраняются,
+    остальные строки заменяются их длиной. Коды купонов, id сессий Stripe и прочие строки в запись не попадают.
+    """
+    if isinstance(value, dict):
+        return {name: get_shape(item, name) for name, item in value.items()}
+    if isinstance(value, list):
+        return [get_shape(item, key) for item in value]
+    if isinstance(value, str):
+        if key in KEEP_FIELDS or value.isdigit() and len(value) <= MAX_NUMERIC_STRING:
+            return value
+        return {'$str': len(value)}
+    return value
+
+
+def from_shape(value):
+    """
+    Восстанавливает данные запроса из структуры: строки заменяются заполнителем той же длины.
+    """
+    if isinstance(value, dict):
+        if set(value) == {'$str'}:
+            return 'x' * value['$str']
+        return {key: from_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_shape(item) for item in value]
+    return value
+
+
+def get_body_shape(request):
+    content_type = request.content_type
+    length = int(request.META.get('CONTENT_LENGTH') or 0)
+    if not length:
+        return None
+    if length > MAX_BODY_SIZE:
+        return {'$bytes': length}
+    if content_type == 'application/json':
+        try:
+            return get_shape(json.loads(request.body))
+        except ValueError:
+            return {'$bytes': length}
+    if content_type == 'application/x-www-form-urlencoded':
+        return get_shape(QueryDict(request.body).dict())
+    return {'$bytes': length}
+
+
+class QueryCounter:
+    """
+    Обертка connection.execute_wrapper: считает запросы к БД.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def count_queries(stack):
+    counter = QueryCounter()
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(counter))
+    return counter
+
+
+class CaptureWriter:
+    """
+    Копит записи запросов в ограниченной очереди и дописывает их в сжатые файлы JSONL из фонового потока.
+    У каждого процесса свой файл, новый файл начинается после CAPTURE_FILE_MAX_RECORDS записей.
+    При переполнении очереди записи отбрасываются, чтобы запись трафика не замедляла запросы.
+    Поток запускается лениво, поэтому корректно работает в воркерах gunicorn после fork.
+    """
+    def __init__(self, max_queue_size=10000, interval=1.0):
+        self.queue = queue.Queue(max_queue_size)
+        self.interval = interval
+        self.pid = None
+        self.lock = threading.Lock()
+        self.path = None
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.path = None
+            os.makedirs(settings.CAPTURE_DIR, exist_ok=True)
+            threading.Thread(target=self.run, name='traffic-capture', daemon=True).start()
+            atexit.register(self.flush)
+
+    def submit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        records = []
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                return records
+
+    def write(self, records):
+        with self.lock:
+            if self.path is None or self.written >= settings.CAPTURE_FILE_MAX_RECORDS:
+                self.path = os.path.join(
+                    settings.CAPTURE_DIR, f'capture-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.jsonl.gz'
+                )
+                self.written = 0
+            # Каждая пачка дописывается отдельным членом gzip, такой файл читается gzip.open целиком
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            self.written += len(records)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        records = self.drain()
+        if not records:
+            return
+        try:
+            self.write(records)
+        except OSError:
+            self.dropped += len(records)
+
+
+writer = CaptureWriter()
+
+
+def read_records(paths):
+    """
+    Читает записи из файлов и каталогов с записями трафика в порядке времени.
+    """
+    files = []
+    for path in paths:
+        files.extend(sorted(glob.glob(os.path.join(path, '*.jsonl.gz'))) if os.path.isdir(path) else [path])
+    records = []
+    for path in files:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    records.sort(key=lambda record: record['ts'])
+    return records
+
+
+def group_sessions(records):
+    """
+    Группирует записи по сессиям в порядке первого запроса. Запросы без сессии воспроизводятся по одному.
+    """
+    sessions = {}
+    for index, record in enumerate(records):
+        sessions.setdefault(record['session'] or f'anonymous:{index}', []).append(record)
+    return list(sessions.values())
+
+
+def replay_request(client, record):
+    kwargs = {}
+    body = record.get('body')
+    if isinstance(body, dict) and set(body) == {'$bytes'}:
+        body = None
+    if body is not None:
+        if record['content_type'] == 'application/json':
+            kwargs = {'data': json.dumps(from_shape(body)), 'content_type': 'application/json'}
+        else:
+            kwargs = {'data': urlencode(from_shape(body)), 'content_type': record['content_type']}
+    if record.get('query'):
+        kwargs['query_params'] = from_shape(record['query'])
+    return getattr(client, record['method'].lower())(record['path'], **kwargs)
+
+
+def replay_session(records, started, origin, speed):
+    # Тестовый клиент нужен только при воспроизведении, middleware записи его не загружает
+    from django.test import Client
+    client = Client(raise_request_exception=False)
+    results = []
+    try:
+        for record in records:
+            if speed:
+                delay = started + (record['ts'] - origin) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            with ExitStack() as stack:
+                counter = count_queries(stack)
+                request_started = time.perf_counter()
+                response = replay_request(client, record)
+                duration = (time.perf_counter() - request_started) * 1000
+            results.append({
+                'route': record['route'],
+                'method': record['method'],
+                'status': response.status_code,
+                'duration_ms': duration,
+                'queries': counter.count,
+                'recorded_status': record['status'],
+            })
+    finally:
+        connections.close_all()
+    return results
+
+
+def replay(sessions, speed=1.0, concurrency=32):
+    """
+    Воспроизводит сессии через полный стек Django, сохраняя порядок запросов внутри сессии.
+    speed — ускорение относительно записанного темпа, 0 — без пауз.
+    Возвращает результаты запросов в том же формате, что и записи.
+    """
+    if not sessions:
+        return []
+    origin = min(records[0]['ts'] for records in sessions)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='replay') as executor:
+        futures = [executor.submit(replay_session, records, started, origin, speed) for records in sessions]
+        return [result for future in futures for result in future.result()]
+
+
+def summarize(records):
+    """
+    Сводка по маршрутам: количество запросов, перцентили задержки и среднее число запросов к БД.
+    """
+    routes = {}
+    for record in records:
+        routes.setdefault(f"{record['method']} /{record['route']}", []).append(record)
+    summary = {}
+    for route, items in routes.items():
+        durations = sorted(item['duration_ms'] for item in items)
+        quantiles = statistics.quantiles(durations, n=100) if len(durations) > 1 else durations * 99
+        summary[route] = {
+            'requests': len(items),
+            'p50_ms': quantiles[49],
+            'p95_ms': quantiles[94],
+            'queries': statistics.fmean(item['queries'] for item in items),
+            'errors': sum(item['status'] >= 500 for item in items),
+            'mismatched': sum(item['status'] != item.get('recorded_status', item['status']) for item in items),
+        }
+    return summary
@@ -0,0 +1,238 @@
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .models import Order, OrderItem
+from . import inventory, jobs, shards
+
+BUFFER_KEY = 'cart_buffer:{order_id}'
+LOCK_KEY = 'cart_buffer_lock:{order_id}'
+DROPPED_KEY = 'cart_buffer_dropped:{order_id}'
+
+
+class CurrencyMismatch(Exception):
+    """
+    Товар нельзя добавить в корзину с товарами в другой валюте.
+    """
+
+
+def apply_operations(order, operations, currencies):
+    """
+    Применяет к заказу пакет операций set/increment/remove в одной транзакции
+    несколькими запросами на весь пакет, а не на каждый товар.
+    Резервы на складе приводятся к новым количествам. Если товара не хватает, выбрасывает OutOfStock,
+    если товары в разных валютах — CurrencyMismatch, в обоих случаях заказ не меняется.
+    Строка заказа блокируется на всю транзакцию: иначе параллельные пакеты (или пакет и сброс буфера)
+    с одним новым товаром оба создали бы его строку и резерв.
+    Возвращает словарь item_id -> на сколько увеличилось количество.
+    """
+    with shards.atomic(order):
+        Order.objects.using(order._state.db).select_for_update().filter(pk=order.pk).values_list('pk').first()
+        existing = {
+            order_item.item_id: order_item
+            for order_item in order.orderitem_set.select_for_update().filter(
+                item_id__in={operation['item_id'] for operation in operations}
+            )
+        }
+        previous = {item_id: order_item.quantity for item_id, order_item in existing.items()}
+        quantities = dict(previous)
+        for operation in operations:
+            item_id = operation['item_id']
+            if operation['op'] == 'remove':
+                quantities[item_id] = 0
+            elif operation['op'] == 'set':
+                quantities[item_id] = operation['quantity']
+            else:
+                quantities[item_id] = quantities.get(item_id, 0) + operation['quantity']
+
+        removed = [item_id for item_id, quantity in quantities.items() if quantity == 0]
+        if currencies and order.orderitem_set.exclude(
+            item__currency=next(iter(currencies))
+        ).exclude(item_id__in=removed).exists():
+            raise CurrencyMismatch()
+
+        to_update = []
+        to_create = []
+        for item_id, quantity in quantities.items():
+            if quantity == 0:
+                continue
+            if item_id in existing:
+                if existing[item_id].quantity != quantity:
+                    existing[item_id].quantity = quantity
+                    to_update.append(existing[item_id])
+            else:
+                to_create.append(OrderItem(order=order, item_id=item_id, quantity=quantity))
+
+        for item_id, quantity in quantities.items():
+            if quantity != previous.get(item_id, 0):
+                inventory.set_order_reservation(order, item_id, quantity)
+        inventory.extend_order_reservations(order)
+
+        if removed:
+            order.orderitem_set.filter(item_id__in=removed).delete()
+        if to_update:
+            OrderItem.objects.using(order._state.db).bulk_update(to_update, ['quantity'])
+        if to_create:
+            OrderItem.objects.using(order._state.db).bulk_create(
+                to_create, update_conflicts=True, unique_fields=['order', 'item'], update_fields=['quantity']
+            )
+    return {
+        item_id: quantity - previous.get(item_id, 0)
+        for item_id, quantity in quantities.items()
+        if quantity > previous.get(item_id, 0)
+    }
+
+
+@contextmanager
+def buffer_lock(order_id):
+    """
+    Короткая блокировка буфера корзины в общем кеше. Конкурируют только запросы одного покупателя.
+    Если блокировку не удалось взять за CART_BUFFER_LOCK_TIMEOUT секунд, она считается брошенной.
+    """
+    key = LOCK_KEY.format(order_id=order_id)
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + settings.CART_BUFFER_LOCK_TIMEOUT
+    while not cache.add(key, token, settings.CART_BUFFER_LOCK_TIMEOUT):
+        if time.monotonic() > deadline:
+            cache.set(key, token, settings.CART_BUFFER_LOCK_TIMEOUT)
+            break
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def buffer_add(order, item, quantity=1):
+    """
+    Откладывает добавление товара в корзину: прирост количества складывается в буфер заказа в кеше,
+    повторные нажатия на один товар объединяются. Валюта проверяется по буферу и по строкам заказа в БД,
+    остаток — по складу: при ошибке выбрасывается CurrencyMismatch или OutOfStock, и буфер не меняется.
+    Товар при этом не резервируется, поэтому проверка остатка предварительная.
+    Когда в буфере набирается CART_BUFFER_MAX_PENDING единиц, он сразу сбрасывается в БД.
+    Для нового буфера ставится задача flush_cart_buffer через CART_BUFFER_FLUSH_DELAY секунд,
+    чтобы товар зарезервировался, даже если покупатель не откроет корзину.
+    """
+    key = BUFFER_KEY.format(order_id=order.id)
+    with buffer_lock(order.id):
+        started = cache.get(key) is None
+        buffer = cache.get(key) or {'currency': None, 'items': {}}
+        if buffer['currency'] is None:
+            if order.orderitem_set.exclude(item__currency=item['currency']).exists():
+                raise CurrencyMismatch()
+        elif buffer['currency'] != item['currency']:
+            raise CurrencyMismatch()
+        pending = buffer['items'].get(item['id'], 0) + quantity
+        available = inventory.get_available(item['id'])
+        if available is not None and available < pending:
+            raise inventory.OutOfStock(item['id'])
+        buffer['currency'] = item['currency']
+        buffer['items'][item['id']] = pending
+        if sum(buffer['items'].values()) >= settings.CART_BUFFER_MAX_PENDING:
+            remember_dropped(order.id, apply_buffer(order, buffer))
+            cache.delete(key)
+            return
+        cache.set(key, buffer, settings.CART_BUFFER_TTL)
+    if started:
+        jobs.enqueue(
+            'flush_cart_buffer',
+            run_at=timezone.now() + timedelta(seconds=settings.CART_BUFFER_FLUSH_DELAY),
+            order_id=order.id,
+        )
+
+
+def apply_buffer(order, buffer):
+    """
+    Записывает накопленные приросты одним пакетом. Валюта и остаток проверены в buffer_add, но товар
+    мог закончиться до сброса: тогда пакет применяется по товарам, и в корзину попадает столько единиц,
+    сколько осталось. Возвращает словарь item_id -> сколько единиц не попало в корзину.
+    """
+    currencies = {buffer['currency']}
+    operations = [
+        {'item_id': item_id, 'quantity': quantity, 'op': 'increment'}
+        for item_id, quantity in sorted(buffer['items'].items())
+    ]
+    try:
+        apply_operations(order, operations, currencies)
+        return {}
+    except (inventory.OutOfStock, CurrencyMismatch):
+        pass
+    dropped = {}
+    for operation in operations:
+        item_id = operation['item_id']
+        try:
+            apply_operations(order, [operation], currencies)
+        except inventory.OutOfStock:
+            available = min(inventory.get_available(item_id) or 0, operation['quantity'])
+            try:
+                if available:
+                    apply_operations(order, [{**operation, 'quantity': available}], currencies)
+            except inventory.OutOfStock:
+                available = 0
+            dropped[item_id] = operation['quantity'] - available
+        except CurrencyMismatch:
+            dropped[item_id] = operation['quantity']
+    return dropped
+
+
+def remember_dropped(order_id, dropped):
+    """
+    Запоминает, что не попало в корзину при сбросе буфера, до следующего показа корзины покупателю.
+    Сброс может пройти в фоновой задаче или в запросе, который корзину не показывает.
+    """
+    if not dropped:
+        return
+    key = DROPPED_KEY.format(order_id=order_id)
+    current = cache.get(key) or {}
+    for item_id, quantity in dropped.items():
+        current[item_id] = current.get(item_id, 0) + quantity
+    cache.set(key, current, settings.CART_BUFFER_TTL)
+
+
+def pop_dropped(order_id):
+    """
+    Возвращает и забывает товары, не попавшие в корзину при сбросах буфера: словарь item_id -> единиц.
+    """
+    if not settings.CART_WRITE_BEHIND:
+        return {}
+    key = DROPPED_KEY.format(order_id=order_id)
+    with buffer_lock(order_id):
+        dropped = cache.get(key) or {}
+        cache.delete(key)
+    return dropped
+
+
+def flush(order):
+    """
+    Сбрасывает отложенные изменения корзины в БД. Вызывается перед любым чтением корзины и оплатой,
+    поэтому покупатель никогда не видит устаревшие данные, а также задачей flush_cart_buffer.
+    Не попавшее в корзину запоминается для pop_dropped. Без отложенной записи ничего не делает.
+    """
+    if not settings.CART_WRITE_BEHIND:
+        return
+    key = BUFFER_KEY.format(order_id=order.id)
+    if cache.get(key) is None:
+        return
+    with buffer_lock(order.id):
+        buffer = cache.get(key)
+        if buffer is not None:
+            remember_dropped(order.id, apply_buffer(order, buffer))
+            cache.delete(key)
+
+
+def has_pending(order_id):
+    """
+    Есть ли у заказа отложенные изменения, еще не записанные в БД.
+    """
+    return settings.CART_WRITE_BEHIND and cache.get(BUFFER_KEY.format(order_id=order_id)) is not None
+
+
+def discard(order_id):
+    """
+    Отбрасывает отложенные изменения корзины, например при ее очистке.
+    """
+    cache.delete_many([BUFFER_KEY.format(order_id=order_id), DROPPED_KEY.format(order_id=order_id)])
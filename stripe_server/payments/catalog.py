@@ -0,0 +1,289 @@
+import mmap
+import os
+import socket
+import struct
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from .models import Item
+from .serializers import ItemSerializer
+
+# Формат снимка каталога:
+#   заголовок: magic, версия формата, количество товаров, поколение снимка (time_ns на момент сборки),
+#   версия каталога из кеша, по которой собран снимок
+#   записи фиксированной длины, отсортированные по id: id, цена, валюта, смещения и длины имени и описания
+#   блоб строк UTF-8, на который ссылаются смещения
+MAGIC = b'CATS'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sHxxIQQ')
+RECORD = struct.Struct('<QI12sIIII')
+
+VERSION_KEY = 'catalog_snapshot:version'
+# Блокировка перестроения файла снимка: файл свой на каждом хосте, поэтому и блокировка своя
+REBUILD_LOCK_KEY = 'catalog_snapshot:rebuild:{host}:{path}'
+REBUILD_LOCK_TIMEOUT = 300
+
+
+def get_version():
+    return cache.get(VERSION_KEY, 0)
+
+
+def bump_version():
+    """
+    Увеличивает версию каталога в общем кеше: снимки, собранные по меньшей версии, устарели.
+    """
+    cache.add(VERSION_KEY, 0, timeout=None)
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+        return 1
+
+
+def build_snapshot(items, path=None, version=0):
+    """
+    Собирает снимок каталога из итерируемого набора товаров и атомарно заменяет им файл.
+    Читатели, уже отобразившие старый файл, продолжают работать с ним до следующей проверки.
+    """
+    path = path or settings.CATALOG_SNAPSHOT_PATH
+    records = []
+    blob = bytearray()
+    for item in sorted(items, key=lambda item: item.id):
+        name = item.name.encode()
+        description = item.description.encode()
+        name_offset = len(blob)
+        blob += name
+        description_offset = len(blob)
+        blob += description
+        records.append(RECORD.pack(
+            item.id, item.price, item.currency.encode(),
+            name_offset, len(name), description_offset, len(description),
+        ))
+
+    generation = time.time_ns()
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(records), generation, version))
+        f.writelines(records)
+        f.write(blob)
+    os.replace(tmp_path, path)
+    return generation
+
+
+def rebuild_snapshot(changed=False):
+    """
+    Перестраивает снимок по текущим данным primary. changed=True сообщает процессам на других хостах,
+    что каталог изменился в обход сигналов моделей, и они перестроят свои снимки.
+    Версия читается до чтения товаров, поэтому изменение, пришедшее во время сборки, вызовет еще одну.
+    """
+    version = bump_version() if changed else get_version()
+    items = Item.objects.using('default').only('id', 'name', 'description', 'price', 'currency').iterator()
+    return build_snapshot(items, version=version)
+
+
+class SnapshotRebuilder:
+    """
+    Откладывает перестроение снимка на CATALOG_SNAPSHOT_DEBOUNCE секунд: изменения товаров за это время
+    собираются в одно перестроение O(N) вместо перестроения на каждое сохранение.
+    Файл хоста перестраивает один процесс, взявший блокировку в кеше, остальные только отображают
+    новый файл заново. Таймер не фоновый, поэтому процесс (например, команда manage.py) не завершится,
+    не перестроив снимок. Состояние привязано к pid, поэтому корректно работает в воркерах gunicorn после fork.
+    timer_class заменяется в тестах, чтобы выполнять перестроение через flush без ожидания.
+    """
+    def __init__(self, timer_class=threading.Timer):
+        self.timer_class = timer_class
+        self.lock = threading.Lock()
+        self.timer = None
+        self.force = False
+        self.pid = None
+
+    def schedule(self, force=False):
+        """
+        force=True — товары изменились в этом процессе, снимок перестраивается в любом случае.
+        Иначе перестроение пропускается, если снимок уже собрал по актуальной версии другой процесс хоста.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.timer = None
+                self.force = False
+            self.force = self.force or force
+            if self.timer is None:
+                self.timer = self.timer_class(settings.CATALOG_SNAPSHOT_DEBOUNCE, self.run)
+                self.timer.start()
+
+    def flush(self):
+        """
+        Выполняет отложенное перестроение сразу, не дожидаясь таймера.
+        """
+        with self.lock:
+            timer = self.timer if self.pid == os.getpid() else None
+            if timer is not None:
+                timer.cancel()
+        if timer is not None:
+            self.run()
+
+    def run(self):
+        with self.lock:
+            self.timer = None
+            force, self.force = self.force, False
+        key = REBUILD_LOCK_KEY.format(host=socket.gethostname(), path=settings.CATALOG_SNAPSHOT_PATH)
+        token = uuid.uuid4().hex
+        if not cache.add(key, token, REBUILD_LOCK_TIMEOUT):
+            # Файл перестраивает другой процесс хоста. Изменения этого процесса он мог не увидеть,
+            # поэтому принудительное перестроение откладывается еще раз
+            if force:
+                self.schedule(force=True)
+            return
+        try:
+            snapshot = get_snapshot(check_version=False)
+            if force or snapshot is None or snapshot.catalog_version < get_version():
+                rebuild_snapshot()
+        finally:
+            if cache.get(key) == token:
+                cache.delete(key)
+            connections.close_all()
+
+
+rebuilder = SnapshotRebuilder()
+
+
+def mark_changed():
+    """
+    Отмечает изменение каталога: увеличивает версию в общем кеше и откладывает перестроение снимка.
+    """
+    bump_version()
+    rebuilder.schedule(force=True)
+
+
+class CatalogSnapshot:
+    """
+    Снимок каталога, отображенный в память только для чтения.
+    Все воркеры gunicorn отображают один и тот же файл, поэтому данные лежат в page cache в одном экземпляре.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.file_id = (stat.st_ino, stat.st_mtime_ns)
+        magic, version = struct.unpack_from('<4sH', self.buffer, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'Неподдерживаемый формат снимка каталога: {path}')
+        _, _, self.count, self.generation, self.catalog_version = HEADER.unpack_from(self.buffer, 0)
+        self.blob_offset = HEADER.size + self.count * RECORD.size
+
+    def record(self, index):
+        return RECORD.unpack_from(self.buffer, HEADER.size + index * RECORD.size)
+
+    def text(self, offset, length):
+        start = self.blob_offset + offset
+        return self.buffer[start:start + length].decode()
+
+    def to_dict(self, record, with_description=True):
+        item_id, price, currency, name_offset, name_length, description_offset, description_length = record
+        item = {
+            'id': item_id,
+            'name': self.text(name_offset, name_length),
+            'price': price,
+            'currency': currency.rstrip(b'\0').decode(),
+            'full_price': "{0:.2f}".format(price / 100),
+        }
+        if with_description:
+            item['description'] = self.text(description_offset, description_length)
+        return item
+
+    def get(self, item_id):
+        """
+        Ищет товар по id бинарным поиском по записям без копирования снимка.
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            record = self.record(middle)
+            if record[0] < item_id:
+                low = middle + 1
+            elif record[0] > item_id:
+                high = middle
+            else:
+                return self.to_dict(record)
+        return None
+
+    def all(self, with_description=False):
+        return [self.to_dict(self.record(index), with_description) for index in range(self.count)]
+
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+_version_checked_at = 0
+
+
+def get_snapshot(check_version=True):
+    """
+    Возвращает актуальный снимок каталога или None, если снимок еще не собран или собран в старом формате.
+    На каждом вызове проверяется, не был ли файл заменен, и при необходимости он отображается заново.
+    Раз в CATALOG_SNAPSHOT_CHECK_INTERVAL секунд версия снимка сверяется с версией каталога в общем кеше:
+    так процессы на других хостах узнают об изменениях товаров и перестраивают свой файл.
+    """
+    global _snapshot, _version_checked_at
+    if not settings.CATALOG_SNAPSHOT_ENABLED:
+        return None
+    try:
+        stat = os.stat(settings.CATALOG_SNAPSHOT_PATH)
+    except FileNotFoundError:
+        return None
+    snapshot = _snapshot
+    if snapshot is None or snapshot.file_id != (stat.st_ino, stat.st_mtime_ns):
+        with _snapshot_lock:
+            if _snapshot is None or _snapshot.file_id != (stat.st_ino, stat.st_mtime_ns):
+                try:
+                    # Старое отображение не закрывается явно: его могут читать другие потоки
+                    _snapshot = CatalogSnapshot(settings.CATALOG_SNAPSHOT_PATH)
+                except ValueError:
+                    if check_version:
+                        rebuilder.schedule()
+                    return None
+            snapshot = _snapshot
+    now = time.monotonic()
+    if check_version and now - _version_checked_at >= settings.CATALOG_SNAPSHOT_CHECK_INTERVAL:
+        _version_checked_at = now
+        if snapshot.catalog_version < get_version():
+            rebuilder.schedule()
+    return snapshot
+
+
+def get_item(item_id):
+    """
+    Возвращает товар из снимка, а при отсутствии снимка — из БД.
+    Возвращает None, если товара нет.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.get(item_id)
+    item = Item.objects.filter(pk=item_id).first()
+    return ItemSerializer(item).data if item else None
+
+
+def get_items(item_ids):
+    """
+    Возвращает товары с указанными id в том же порядке, пропуская отсутствующие.
+    При отсутствии снимка все товары читаются из БД одним запросом.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        items = (snapshot.get(item_id) for item_id in item_ids)
+        return [item for item in items if item is not None]
+    items = Item.objects.in_bulk(item_ids)
+    return [ItemSerializer(items[item_id]).data for item_id in item_ids if item_id in items]
+
+
+def list_items():
+    """
+    Возвращает все товары из снимка, а при отсутствии снимка — из БД.
+    """
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return snapshot.all()
+    return ItemSerializer(Item.objects.all(), many=True).data
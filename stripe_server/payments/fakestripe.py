@@ -0,0 +1,270 @@
+import json
+import re
+import secrets
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Поддерживаемые ресурсы: путь API -> (тип объекта, префикс id)
+RESOURCES = {
+    'coupons': ('coupon', ''),
+    'tax_rates': ('tax_rate', 'txr_'),
+    'checkout/sessions': ('checkout.session', 'cs_test_'),
+    'payment_intents': ('payment_intent', 'pi_'),
+}
+
+PATH_RE = re.compile(r'^/v1/(coupons|tax_rates|checkout/sessions|payment_intents)(?:/([^/]+))?$')
+EXPIRE_RE = re.compile(r'^/v1/checkout/sessions/([^/]+)/expire$')
+PAY_RE = re.compile(r'^/_fake/checkout/sessions/([^/]+)/pay$')
+
+
+def decode_form(body):
+    """
+    Разбирает тело запроса Stripe в формате application/x-www-form-urlencoded
+    с вложенными ключами вида line_items[0][price_data][currency] во вложенные словари и списки.
+    """
+    result = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = re.findall(r'[^\[\]]+', key)
+        target = result
+        for part, next_part in zip(parts, parts[1:]):
+            if isinstance(target, list):
+                part = int(part)
+                while len(target) <= part:
+                    target.append(None)
+                if target[part] is None:
+                    target[part] = [] if next_part.isdigit() else {}
+                target = target[part]
+            else:
+                target = target.setdefault(part, [] if next_part.isdigit() else {})
+        if isinstance(target, list):
+            index = int(parts[-1])
+            while len(target) <= index:
+                target.append(None)
+            target[index] = value
+        else:
+            target[parts[-1]] = value
+    return result
+
+
+def to_number(value):
+    if value in (None, ''):
+        return value
+    number = float(value)
+    return int(number) if number.is_integer() else number
+
+
+class FakeStripeState:
+    """
+    Хранилище объектов поддельного Stripe. У каждого секретного ключа свой аккаунт,
+    как у отдельных аккаунтов Stripe для каждой валюты.
+    """
+    def __init__(self):
+        self.accounts = {}
+        self.lock = threading.Lock()
+
+    def account(self, api_key):
+        return self.accounts.setdefault(api_key, {object_type: {} for object_type, _ in RESOURCES.values()})
+
+    def load(self, fixtures):
+        """
+        Загружает объекты из словаря {api_key: {'coupons': [...], 'tax_rates': [...], 'checkout/sessions': [...]}}.
+        """
+        with self.lock:
+            for api_key, resources in fixtures.items():
+                account = self.account(api_key)
+                for resource, objects in resources.items():
+                    object_type, _ = RESOURCES[resource]
+                    for obj in objects:
+                        account[object_type][obj['id']] = {'object': object_type, 'created': int(time.time()), **obj}
+
+    def create(self, api_key, resource, params):
+        object_type, prefix = RESOURCES[resource]
+        obj = {
+            'id': params.pop('id', None) or prefix + secrets.token_hex(12),
+            'object': object_type,
+            'created': int(time.time()),
+            'livemode': False,
+            'metadata': params.pop('metadata', {}),
+        }
+        if object_type == 'coupon':
+            obj.update({
+                'name': params.get('name'),
+                'percent_off': to_number(params.get('percent_off')),
+                'duration': params.get('duration', 'once'),
+                'currency': params.get('currency'),
+                'valid': True,
+            })
+        elif object_type == 'tax_rate':
+            obj.update({
+                'display_name': params.get('display_name'),
+                'percentage': to_number(params.get('percentage')),
+                'inclusive': params.get('inclusive') == 'true',
+                'active': params.get('active', 'true') == 'true',
+            })
+        elif object_type == 'checkout.session':
+            line_items = params.get('line_items') or []
+            subtotal = sum(
+                int(line['price_data']['unit_amount']) * int(line.get('quantity', 1)) for line in line_items
+            )
+            obj.update({
+                'status': 'open',
+                'payment_status': 'unpaid',
+                'currency': line_items[0]['price_data']['currency'] if line_items else None,
+                'amount_subtotal': subtotal,
+                'amount_total': subtotal,
+                'url': f"https://checkout.stripe.test/c/pay/{obj['id']}",
+                'success_url': params.get('success_url'),
+                'cancel_url': params.get('cancel_url'),
+                'expires_at': to_number(params.get('expires_at')),
+            })
+        elif object_type == 'payment_intent':
+            obj.update({
+                'amount': to_number(params.get('amount')),
+                'currency': params.get('currency'),
+                'status': 'requires_payment_method',
+                'client_secret': f"{obj['id']}_secret_{secrets.token_hex(8)}",
+            })
+        with self.lock:
+            self.account(api_key)[object_type][obj['id']] = obj
+        return obj
+
+    def get(self, api_key, resource, object_id):
+        object_type, _ = RESOURCES[resource]
+        return self.account(api_key)[object_type].get(object_id)
+
+    def modify(self, api_key, resource, object_id, params):
+        obj = self.get(api_key, resource, object_id)
+        if obj is None:
+            return None
+        with self.lock:
+            for key, value in params.items():
+                if key == 'metadata':
+                    obj['metadata'].update(value)
+                elif key == 'active':
+                    obj['active'] = value == 'true'
+                elif key in ('amount', 'percentage', 'percent_off'):
+                    obj[key] = to_number(value)
+                else:
+                    obj[key] = value
+        return obj
+
+    def delete(self, api_key, resource, object_id):
+        object_type, _ = RESOURCES[resource]
+        with self.lock:
+            if self.account(api_key)[object_type].pop(object_id, None) is None:
+                return None
+        return {'id': object_id, 'object': object_type, 'deleted': True}
+
+    def list(self, api_key, resource, params):
+        """
+        Список от новых к старым с курсорной пагинацией starting_after, как в Stripe.
+        """
+        object_type, _ = RESOURCES[resource]
+        objects = sorted(
+            self.account(api_key)[object_type].values(),
+            key=lambda obj: (obj['created'], obj['id']),
+            reverse=True,
+        )
+        created = params.get('created')
+        if isinstance(created, dict) and created.get('gte'):
+            objects = [obj for obj in objects if obj['created'] >= int(created['gte'])]
+        if params.get('starting_after'):
+            ids = [obj['id'] for obj in objects]
+            if params['starting_after'] in ids:
+                objects = objects[ids.index(params['starting_after']) + 1:]
+        limit = int(params.get('limit', 10))
+        return {
+            'object': 'list',
+            'url': f'/v1/{resource}',
+            'has_more': len(objects) > limit,
+            'data': objects[:limit],
+        }
+
+    def expire_checkout_session(self, api_key, session_id):
+        """
+        Закрывает открытую сессию Checkout, как stripe.checkout.Session.expire.
+        """
+        obj = self.get(api_key, 'checkout/sessions', session_id)
+        if obj is None or obj['status'] != 'open':
+            return None
+        return self.modify(api_key, 'checkout/sessions', session_id, {'status': 'expired'})
+
+    def pay_checkout_session(self, api_key, session_id):
+        """
+        Имитирует успешную оплату сессии Checkout покупателем.
+        """
+        return self.modify(api_key, 'checkout/sessions', session_id, {'status': 'complete', 'payment_status': 'paid'})
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """
+    HTTP-обработчик поддельного Stripe для библиотеки stripe-python (stripe.api_base = адрес сервера).
+    Поддерживает создание, чтение, изменение, удаление и списки объектов из RESOURCES,
+    закрытие сессии Checkout, а также служебный POST /_fake/checkout/sessions/<id>/pay.
+    """
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def api_key(self):
+        return self.headers.get('Authorization', '').removeprefix('Bearer ').strip()
+
+    def respond(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Request-Id', 'req_' + secrets.token_hex(8))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def missing(self, object_id):
+        self.respond(404, {'error': {
+            'type': 'invalid_request_error',
+            'code': 'resource_missing',
+            'message': f"No such object: '{object_id}'",
+        }})
+
+    def params(self):
+        split = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode() if length else ''
+        return split.path, decode_form(split.query if self.command in ('GET', 'DELETE') else body)
+
+    def dispatch(self):
+        path, params = self.params()
+        api_key = self.api_key()
+        for regex, action in ((EXPIRE_RE, self.state.expire_checkout_session), (PAY_RE, self.state.pay_checkout_session)):
+            match = regex.match(path)
+            if match and self.command == 'POST':
+                obj = action(api_key, match.group(1))
+                return self.respond(200, obj) if obj else self.missing(match.group(1))
+        match = PATH_RE.match(path)
+        if not match:
+            return self.respond(404, {'error': {'type': 'invalid_request_error', 'message': f'Unrecognized request URL: {path}'}})
+        resource, object_id = match.groups()
+        if object_id is None:
+            if self.command == 'GET':
+                return self.respond(200, self.state.list(api_key, resource, params))
+            if self.command == 'POST':
+                return self.respond(200, self.state.create(api_key, resource, params))
+        elif self.command == 'GET':
+            obj = self.state.get(api_key, resource, object_id)
+        elif self.command == 'POST':
+            obj = self.state.modify(api_key, resource, object_id, params)
+        else:
+            obj = self.state.delete(api_key, resource, object_id)
+        return self.respond(200, obj) if obj else self.missing(object_id)
+
+    do_GET = do_POST = do_DELETE = dispatch
+
+
+def serve(host='127.0.0.1', port=12111, state=None):
+    """
+    Создает HTTP-сервер поддельного Stripe. Запуск в фоне: threading.Thread(target=server.serve_forever).
+    """
+    handler = type('Handler', (FakeStripeHandler,), {'state': state or FakeStripeState()})
+    return ThreadingHTTPServer((host, port), handler)
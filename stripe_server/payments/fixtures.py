@@ -0,0 +1,379 @@
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+import numpy as np
+from django.core.management.color import no_style
+from django.db import connection, connections, transaction
+from django.db.models import Max
+from .models import Discount, Item, Order, OrderItem, Tax
+from .routers import get_shard_aliases
+from . import shards
+
+# Размер куска генерации. Кусок получает свой seed из (seed, таблица, номер куска),
+# поэтому данные не зависят от СУБД и способа записи
+CHUNK_SIZE = 50000
+
+WORDS = np.array((
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore '
+    'magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo '
+    'consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur excepteur sint '
+    'occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim id est laborum'
+).split())
+
+TABLES = ['item', 'discount', 'tax', 'order', 'orderitem']
+
+
+class Distributions:
+    """
+    Параметры распределений генерируемых данных.
+    currencies — доли валют, cart_size_mean и cart_size_max — строк в заказе (геометрическое распределение),
+    quantity_mean — среднее количество в строке, description_mean и description_max — длина описания товара
+    в символах (логнормальное распределение), item_skew — показатель распределения Ципфа для популярности товаров,
+    paid_ratio, discount_ratio и tax_ratio — доли оплаченных заказов и заказов со скидкой и налогом,
+    days — за сколько дней до until распределены оплаты.
+    """
+    def __init__(self, currencies=None, cart_size_mean=3.0, cart_size_max=20, quantity_mean=1.5,
+                 description_mean=400, description_max=5000, item_skew=1.1,
+                 paid_ratio=0.8, discount_ratio=0.2, tax_ratio=0.5, days=365, until=None):
+        self.currencies = currencies or {'usd': 0.7, 'eur': 0.3}
+        self.cart_size_mean = cart_size_mean
+        self.cart_size_max = cart_size_max
+        self.quantity_mean = quantity_mean
+        self.description_mean = description_mean
+        self.description_max = description_max
+        self.item_skew = item_skew
+        self.paid_ratio = paid_ratio
+        self.discount_ratio = discount_ratio
+        self.tax_ratio = tax_ratio
+        self.days = days
+        self.until = until or datetime.now(dt_timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def parse_currencies(value):
+    """
+    Разбирает доли валют из строки вида 'usd=0.7,eur=0.3'.
+    """
+    currencies = {}
+    for part in value.split(','):
+        currency, _, share = part.partition('=')
+        currencies[currency.strip()] = float(share)
+    return currencies
+
+
+def get_rng(seed, table, chunk):
+    return np.random.default_rng([seed, TABLES.index(table), chunk])
+
+
+def pick_currencies(rng, size, currencies):
+    names = np.array(list(currencies))
+    shares = np.array(list(currencies.values()), dtype=np.float64)
+    return names[rng.choice(names.size, size=size, p=shares / shares.sum())]
+
+
+def make_text_pool(seed, size=1 << 20):
+    """
+    Текст из случайных слов, из которого описания товаров нарезаются срезами без генерации каждого по отдельности.
+    """
+    rng = np.random.default_rng([seed, len(TABLES)])
+    return ' '.join(WORDS[rng.integers(0, WORDS.size, size // 6)])
+
+
+def format_datetimes(values):
+    """
+    Переводит массив datetime64 (UTC) в строки 'YYYY-MM-DD HH:MM:SS.ffffff+00:00', которые одинаково
+    понимают COPY в PostgreSQL и сравнения строк в SQLite. NaT становится NULL.
+    """
+    text = np.char.add(np.char.replace(np.datetime_as_string(values, unit='us'), 'T', ' '), '+00:00')
+    if connection.vendor == 'sqlite':
+        # Django хранит время в SQLite без смещения, в UTC
+        text = np.char.replace(text, '+00:00', '')
+    return [None if np.isnat(value) else string for value, string in zip(values, text.tolist())]
+
+
+def columns_for(model, names):
+    return [model._meta.get_field(name).column for name in names]
+
+
+class BatchInsertWriter:
+    """
+    Записывает строки пачками через executemany в транзакции на кусок. Используется для SQLite и других СУБД без COPY.
+    """
+    def write(self, model, names, rows, using='default'):
+        ops = connections[using].ops
+        columns = ', '.join(ops.quote_name(column) for column in columns_for(model, names))
+        placeholders = ', '.join(['%s'] * len(names))
+        sql = f'INSERT INTO {ops.quote_name(model._meta.db_table)} ({columns}) VALUES ({placeholders})'
+        with transaction.atomic(using=using), connections[using].cursor() as cursor:
+            cursor.executemany(sql, rows)
+
+
+class CopyWriter:
+    """
+    Передает строки в PostgreSQL потоком через COPY ... FROM STDIN в текстовом формате.
+    """
+    def escape(self, value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, str):
+            return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        return str(value)
+
+    def write(self, model, names, rows, using='default'):
+        ops = connections[using].ops
+        columns = ', '.join(ops.quote_name(column) for column in columns_for(model, names))
+        sql = f'COPY {ops.quote_name(model._meta.db_table)} ({columns}) FROM STDIN'
+        data = ''.join('\t'.join(map(self.escape, row)) + '\n' for row in rows)
+        with transaction.atomic(using=using), connections[using].cursor() as cursor:
+            with cursor.cursor.copy(sql) as copy:
+                copy.write(data)
+
+
+def get_writer():
+    """
+    COPY для PostgreSQL с psycopg 3, пачки INSERT для остальных СУБД.
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            if hasattr(cursor.cursor, 'copy'):
+                return CopyWriter()
+    return BatchInsertWriter()
+
+
+class FixtureGenerator:
+    """
+    Генерирует товары, скидки, налоги, заказы и строки заказов с заданными распределениями и пишет их в БД
+    напрямую, минуя модели Django: данные генерируются столбцами NumPy кусками по CHUNK_SIZE строк.
+    Один и тот же seed дает те же данные. Id назначаются заранее, начиная после максимальных существующих,
+    поэтому строки заказов ссылаются на заказы и товары без обращений к БД; последовательности id
+    обновляются в конце. При ORDER_SHARDING заказы и их строки пишутся в БД своей валюты с id из ее диапазона.
+    Копии каталога в БД валют обновляются перед записью заказов. Сигналы моделей не отправляются,
+    поэтому снимок каталога нужно перестроить отдельно.
+    """
+    def __init__(self, seed=0, distributions=None, writer=None, progress=None):
+        self.seed = seed
+        self.distributions = distributions or Distributions()
+        self.writer = writer or get_writer()
+        self.progress = progress or (lambda table, rows, elapsed: None)
+        self.stats = {}
+
+    def next_id(self, model, using='default'):
+        next_id = (model.objects.using(using).aggregate(max_id=Max('id'))['max_id'] or 0) + 1
+        return next_id if using == 'default' else max(next_id, shards.get_id_offset(using))
+
+    def write(self, table, model, names, chunks):
+        """
+        Пишет куски строк в таблицу. Кусок — строки для default или словарь БД -> строки.
+        """
+        started = time.perf_counter()
+        total = 0
+        for rows in chunks:
+            for using, alias_rows in (rows.items() if isinstance(rows, dict) else [('default', rows)]):
+                self.writer.write(model, names, alias_rows, using)
+                total += len(alias_rows)
+            self.progress(table, total, time.perf_counter() - started)
+        self.stats[table] = (total, time.perf_counter() - started)
+
+    def chunks(self, count):
+        for chunk, start in enumerate(range(0, count, CHUNK_SIZE)):
+            yield chunk, start, min(CHUNK_SIZE, count - start)
+
+    def generate_items(self, count):
+        """
+        Возвращает id и валюты созданных товаров.
+        """
+        first_id = self.next_id(Item)
+        ids = np.arange(first_id, first_id + count, dtype=np.int64)
+        currencies = np.empty(count, dtype=object)
+        pool = make_text_pool(self.seed)
+        distributions = self.distributions
+
+        def rows():
+            for chunk, start, size in self.chunks(count):
+                rng = get_rng(self.seed, 'item', chunk)
+                currencies[start:start + size] = pick_currencies(rng, size, distributions.currencies)
+                prices = np.clip(rng.lognormal(np.log(2000), 1.0, size), 50, 1000000).astype(np.int64)
+                lengths = np.clip(
+                    rng.lognormal(np.log(distributions.description_mean), 0.75, size), 0, min(distributions.description_max, len(pool))
+                ).astype(np.int64)
+                offsets = rng.integers(0, len(pool) - lengths + 1)
+                words = WORDS[rng.integers(0, WORDS.size, size)]
+                yield [
+                    (item_id, f'{word.capitalize()} {item_id}', pool[offset:offset + length], price, currency)
+                    for item_id, word, offset, length, price, currency in zip(
+                        ids[start:start + size].tolist(), words.tolist(), offsets.tolist(), lengths.tolist(),
+                        prices.tolist(), currencies[start:start + size].tolist(),
+                    )
+                ]
+
+        self.write('item', Item, ['id', 'name', 'description', 'price', 'currency'], rows())
+        return ids, currencies.astype(str)
+
+    def generate_rates(self, table, model, count):
+        """
+        Создает скидки или налоги. Возвращает словарь валюта -> (массив id, массив процентов).
+        """
+        first_id = self.next_id(model)
+        rng = get_rng(self.seed, table, 0)
+        currencies = pick_currencies(rng, count, self.distributions.currencies)
+        ids = np.arange(first_id, first_id + count, dtype=np.int64)
+        if table == 'discount':
+            percents = rng.integers(5, 51, count)
+            durations = np.array(['once', 'repeating', 'forever'])[rng.choice(3, count, p=[0.7, 0.2, 0.1])]
+            names = ['id', 'name', 'percent_off', 'duration', 'currency', 'stripe_coupon_id', 'active']
+            rows = [
+                (rate_id, f'Fixture discount {rate_id}', percent, duration, currency, None, True)
+                for rate_id, percent, duration, currency in zip(ids.tolist(), percents.tolist(), durations.tolist(), currencies.tolist())
+            ]
+        else:
+            percents = rng.integers(5, 26, count)
+            names = ['id', 'name', 'percentage', 'currency', 'stripe_tax_rate_id', 'active']
+            rows = [
+                (rate_id, f'Fixture tax {rate_id}', percent, currency, None, True)
+                for rate_id, percent, currency in zip(ids.tolist(), percents.tolist(), currencies.tolist())
+            ]
+        self.write(table, model, names, [rows[start:start + CHUNK_SIZE] for start in range(0, count, CHUNK_SIZE)])
+        return {
+            currency: (ids[currencies == currency], percents[currencies == currency])
+            for currency in self.distributions.currencies
+        }
+
+    def pick(self, rng, choices, size):
+        """
+        Выбирает равновероятно size позиций из параллельных массивов choices, например id и процентов.
+        """
+        index = rng.integers(0, choices[0].size, size)
+        return tuple(values[index] for values in choices)
+
+    def generate_orders(self, count, item_ids, item_currencies, discounts, taxes):
+        distributions = self.distributions
+        # БД заказов каждой валюты; без шардирования у всех валют default и общая нумерация
+        self.aliases = {currency: shards.alias_for_currency(currency) for currency in distributions.currencies}
+        self.next_order_ids = {alias: self.next_id(Order, alias) for alias in set(self.aliases.values())}
+        self.next_line_ids = {alias: self.next_id(OrderItem, alias) for alias in self.next_order_ids}
+        self.line_count = 0
+        until = np.datetime64(distributions.until.astimezone(dt_timezone.utc).replace(tzinfo=None), 'us')
+        span_us = int(timedelta(days=distributions.days) / timedelta(microseconds=1))
+        # Товары каждой валюты в случайном порядке популярности с вероятностями по закону Ципфа
+        catalog = {}
+        for currency in distributions.currencies:
+            ids = item_ids[item_currencies == currency]
+            if ids.size:
+                ids = get_rng(self.seed, 'orderitem', list(distributions.currencies).index(currency)).permutation(ids)
+                weights = 1 / np.arange(1, ids.size + 1) ** distributions.item_skew
+                catalog[currency] = (ids, np.cumsum(weights / weights.sum()))
+
+        def orders():
+            for chunk, start, size in self.chunks(count):
+                rng = get_rng(self.seed, 'order', chunk)
+                currencies = pick_currencies(rng, size, {
+                    currency: share for currency, share in distributions.currencies.items() if currency in catalog
+                })
+                order_ids = self.assign_ids(self.next_order_ids, currencies)
+                paid = rng.random(size) < distributions.paid_ratio
+                paid_at = until - rng.integers(0, span_us, size).astype('timedelta64[us]')
+                paid_at[~paid] = np.datetime64('NaT')
+                discount_ids = np.full(size, None, dtype=object)
+                discount_percents = np.zeros(size, dtype=object)
+                tax_ids = np.full(size, None, dtype=object)
+                tax_percentages = np.zeros(size, dtype=object)
+                has_discount = rng.random(size) < distributions.discount_ratio
+                has_tax = rng.random(size) < distributions.tax_ratio
+                for currency in catalog:
+                    selected = currencies == currency
+                    if discounts[currency][0].size:
+                        mask = selected & has_discount
+                        discount_ids[mask], discount_percents[mask] = self.pick(rng, discounts[currency], int(mask.sum()))
+                    if taxes[currency][0].size:
+                        mask = selected & has_tax
+                        tax_ids[mask], tax_percentages[mask] = self.pick(rng, taxes[currency], int(mask.sum()))
+                # Проценты сохраняются в заказе при оплате, поэтому у открытых корзин их нет,
+                # а у оплаченных заказов без скидки или налога они нулевые
+                discount_percents[~paid] = None
+                tax_percentages[~paid] = None
+                lines = self.make_lines(rng, order_ids, currencies, catalog)
+                paid_at = format_datetimes(paid_at)
+                rows = zip(
+                    order_ids.tolist(), discount_ids.tolist(), discount_percents.tolist(),
+                    tax_ids.tolist(), tax_percentages.tolist(), paid_at, paid_at,
+                )
+                yield self.group_by_alias(currencies, list(rows))
+                # Строки заказов пишутся сразу после заказов своего куска, чтобы не копить их в памяти
+                for using, alias_lines in lines.items():
+                    self.writer.write(OrderItem, ['id', 'order_id', 'item_id', 'quantity'], alias_lines, using)
+                    self.line_count += len(alias_lines)
+
+        names = ['id', 'discount_id', 'discount_percent', 'tax_id', 'tax_percentage', 'paid_at', 'recorded_at']
+        self.write('order', Order, names, orders())
+        # Строки заказов пишутся вместе с заказами, поэтому время у них общее
+        self.stats['orderitem'] = (self.line_count, self.stats['order'][1])
+
+    def assign_ids(self, next_ids, currencies):
+        """
+        Выдает id строкам с валютами currencies: подряд в пределах БД каждой валюты.
+        """
+        ids = np.empty(currencies.size, dtype=np.int64)
+        for using in next_ids:
+            selected = np.isin(currencies, [currency for currency, alias in self.aliases.items() if alias == using])
+            count = int(selected.sum())
+            ids[selected] = np.arange(next_ids[using], next_ids[using] + count, dtype=np.int64)
+            next_ids[using] += count
+        return ids
+
+    def group_by_alias(self, currencies, rows):
+        """
+        Раскладывает строки по БД заказов их валют, сохраняя порядок.
+        """
+        groups = {}
+        for currency, row in zip(currencies.tolist(), rows):
+            groups.setdefault(self.aliases[currency], []).append(row)
+        return groups
+
+    def make_lines(self, rng, order_ids, currencies, catalog):
+        """
+        Генерирует строки заказов. Возвращает словарь БД -> строки.
+        """
+        distributions = self.distributions
+        sizes = np.minimum(rng.geometric(1 / distributions.cart_size_mean, order_ids.size), distributions.cart_size_max)
+        # Позиции заказов в куске, а не id: при шардировании id заказов разных БД отличаются на порядки
+        line_orders = np.repeat(np.arange(order_ids.size), sizes)
+        line_currencies = np.repeat(currencies, sizes)
+        line_items = np.empty(line_orders.size, dtype=np.int64)
+        for currency, (ids, cumulative) in catalog.items():
+            selected = line_currencies == currency
+            ranks = np.searchsorted(cumulative, rng.random(int(selected.sum())) * cumulative[-1], side='right')
+            line_items[selected] = ids[np.minimum(ranks, ids.size - 1)]
+        # Один товар встречается в заказе одной строкой, как в корзине
+        _, unique = np.unique(line_orders * (int(line_items.max(initial=0)) + 1) + line_items, return_index=True)
+        unique.sort()
+        line_orders, line_items, line_currencies = line_orders[unique], line_items[unique], line_currencies[unique]
+        quantities = np.minimum(rng.geometric(1 / distributions.quantity_mean, line_orders.size), 99)
+        line_ids = self.assign_ids(self.next_line_ids, line_currencies)
+        rows = zip(line_ids.tolist(), order_ids[line_orders].tolist(), line_items.tolist(), quantities.tolist())
+        return self.group_by_alias(line_currencies, list(rows))
+
+    def reset_sequences(self):
+        for using in shards.get_aliases():
+            models = [Item, Discount, Tax, Order, OrderItem] if using == 'default' else [Order, OrderItem]
+            sql = connections[using].ops.sequence_reset_sql(no_style(), models)
+            if sql:
+                with connections[using].cursor() as cursor:
+                    for statement in sql:
+                        cursor.execute(statement)
+            if using != 'default':
+                # В пустой БД валюты сброс вернул бы последовательности в начало, до ее диапазона
+                shards.ensure_id_range(using)
+
+    def run(self, items, orders, discounts=100, taxes=20):
+        """
+        Генерирует данные и возвращает статистику: таблица -> (строк, секунд).
+        """
+        item_ids, item_currencies = self.generate_items(items)
+        discount_ids = self.generate_rates('discount', Discount, discounts)
+        tax_ids = self.generate_rates('tax', Tax, taxes)
+        # Заказы в БД валют ссылаются на копии товаров, скидок и налогов, поэтому копии обновляются до них
+        for alias in get_shard_aliases():
+            shards.sync_reference_tables(alias)
+        self.generate_orders(orders, item_ids, item_currencies, discount_ids, tax_ids)
+        self.reset_sequences()
+        return self.stats
@@ -0,0 +1,243 @@
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+from .models import StockShard, Reservation
+
+
+class OutOfStock(Exception):
+    """
+    Недостаточно товара на складе для резервирования.
+    """
+    def __init__(self, item_id):
+        super().__init__(f'Недостаточно товара {item_id} на складе')
+        self.item_id = item_id
+
+
+def set_stock(item_id, quantity, shards=1):
+    """
+    Устанавливает доступный остаток товара, равномерно распределяя его по shards частям.
+    Лишние части удаляются. shards=0 отключает учет остатков для товара.
+    """
+    with transaction.atomic():
+        StockShard.objects.filter(item_id=item_id, index__gte=shards).delete()
+        for index in range(shards):
+            StockShard.objects.update_or_create(
+                item_id=item_id,
+                index=index,
+                defaults={'quantity': quantity // shards + (1 if index < quantity % shards else 0)},
+            )
+
+
+def get_available(item_id):
+    """
+    Возвращает доступный остаток товара или None, если остатки товара не отслеживаются.
+    """
+    total = StockShard.objects.filter(item_id=item_id).aggregate(total=Sum('quantity'))['total']
+    return total
+
+
+def take_from_shard(shard_id, quantity):
+    """
+    Атомарно списывает до quantity единиц с части остатка.
+    Условие quantity__gte в UPDATE гарантирует, что остаток не уйдет в минус даже без блокировок.
+    """
+    return StockShard.objects.filter(pk=shard_id, quantity__gte=quantity).update(quantity=F('quantity') - quantity)
+
+
+def reserve(item_id, quantity, order=None, ttl=None):
+    """
+    Резервирует quantity единиц товара и возвращает созданные резервы.
+    Части остатка выбираются в случайном порядке через SELECT ... FOR UPDATE SKIP LOCKED,
+    поэтому параллельные покупатели расходятся по разным строкам. Если все части с остатком
+    заняты, резервирование ждет блокировку. Для товара без учета остатков возвращает пустой список.
+    Если товара не хватает, выбрасывает OutOfStock и ничего не резервирует.
+    """
+    if quantity <= 0:
+        return []
+    ttl = ttl or settings.INVENTORY_RESERVATION_TTL
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    reservations = []
+    remaining = quantity
+    visited = []
+    with transaction.atomic():
+        for skip_locked in (True, False):
+            while remaining:
+                shard = (
+                    StockShard.objects.select_for_update(skip_locked=skip_locked)
+                    .filter(item_id=item_id, quantity__gt=0)
+                    .exclude(pk__in=visited)
+                    .order_by('?')
+                    .first()
+                )
+                if shard is None:
+                    break
+                visited.append(shard.pk)
+                taken = min(shard.quantity, remaining)
+                if take_from_shard(shard.pk, taken):
+                    reservations.append(Reservation(
+                        item_id=item_id, shard=shard, order=order, quantity=taken, expires_at=expires_at
+                    ))
+                    remaining -= taken
+        if remaining:
+            if not reservations and not StockShard.objects.filter(item_id=item_id).exists():
+                return []
+            raise OutOfStock(item_id)
+        return Reservation.objects.bulk_create(reservations)
+
+
+def release(reservations):
+    """
+    Возвращает на склад количество из активных резервов и помечает их освобожденными.
+    Остаток каждой части увеличивается одним UPDATE.
+    """
+    with transaction.atomic():
+        rows = list(
+            reservations.filter(status=Reservation.ACTIVE)
+            .select_for_update(skip_locked=True)
+            .values_list('id', 'shard_id', 'quantity')
+        )
+        if not rows:
+            return 0
+        per_shard = {}
+        for _, shard_id, quantity in rows:
+            per_shard[shard_id] = per_shard.get(shard_id, 0) + quantity
+        Reservation.objects.filter(id__in=[row[0] for row in rows]).update(status=Reservation.RELEASED)
+        for shard_id, quantity in per_shard.items():
+            StockShard.objects.filter(pk=shard_id).update(quantity=F('quantity') + quantity)
+    return len(rows)
+
+
+def release_expired():
+    """
+    Освобождает все активные резервы с истекшим сроком.
+    """
+    return release(Reservation.objects.filter(expires_at__lte=timezone.now()))
+
+
+def release_order(order, item_id=None):
+    """
+    Освобождает активные резервы заказа, при указании item_id — только по одному товару.
+    """
+    reservations = Reservation.objects.filter(order=order)
+    if item_id is not None:
+        reservations = reservations.filter(item_id=item_id)
+    return release(reservations)
+
+
+def set_order_reservation(order, item_id, quantity, ttl=None):
+    """
+    Приводит резерв товара в заказе к quantity единицам.
+    """
+    with transaction.atomic():
+        reserved = Reservation.objects.filter(
+            order=order, item_id=item_id, status=Reservation.ACTIVE
+        ).aggregate(total=Sum('quantity'))['total'] or 0
+        if quantity > reserved:
+            reserve(item_id, quantity - reserved, order, ttl)
+        elif quantity < reserved:
+            release_order(order, item_id)
+            reserve(item_id, quantity, order, ttl)
+
+
+def ensure_order_reserved(order, ttl):
+    """
+    Проверяет, что все позиции заказа зарезервированы, дорезервирует недостающее
+    (например, после истечения резерва) и продлевает резервы заказа на ttl секунд.
+    Возвращает id активных резервов заказа. Если товара не хватает, выбрасывает OutOfStock.
+    """
+    with transaction.atomic():
+        reserved = dict(
+            Reservation.objects.filter(order=order, status=Reservation.ACTIVE)
+            .values('item_id').annotate(total=Sum('quantity')).values_list('item_id', 'total')
+        )
+        for item_id, quantity in order.orderitem_set.values_list('item_id', 'quantity'):
+            if quantity > reserved.get(item_id, 0):
+                reserve(item_id, quantity - reserved.get(item_id, 0), order, ttl)
+        reservations = Reservation.objects.filter(order=order, status=Reservation.ACTIVE)
+        reservations.update(expires_at=timezone.now() + timedelta(seconds=ttl))
+        return list(reservations.values_list('id', flat=True))
+
+
+def extend_order_reservations(order, ttl=None):
+    """
+    Продлевает активные резервы заказа, пока покупатель работает с корзиной.
+    """
+    ttl = ttl or settings.INVENTORY_RESERVATION_TTL
+    Reservation.objects.filter(order=order, status=Reservation.ACTIVE).update(
+        expires_at=timezone.now() + timedelta(seconds=ttl)
+    )
+
+
+def take(item_id, quantity, order_id=None):
+    """
+    Списывает со склада до quantity единиц уже оплаченного товара и сохраняет их подтвержденными резервами.
+    Нужна, когда резерв истек и вернулся на склад раньше, чем пришла оплата. Оплату уже не отменить,
+    поэтому списывается сколько есть. Возвращает количество, которого не хватило (0 для товара без учета остатков).
+    """
+    remaining = quantity
+    reservations = []
+    with transaction.atomic():
+        shards = StockShard.objects.select_for_update().filter(item_id=item_id, quantity__gt=0).order_by('pk')
+        for shard in shards:
+            taken = min(shard.quantity, remaining)
+            if take_from_shard(shard.pk, taken):
+                reservations.append(Reservation(
+                    item_id=item_id, shard=shard, order_id=order_id, quantity=taken,
+                    status=Reservation.COMMITTED, expires_at=timezone.now()
+                ))
+                remaining -= taken
+            if not remaining:
+                break
+        Reservation.objects.bulk_create(reservations)
+    if remaining and not reservations and not StockShard.objects.filter(item_id=item_id).exists():
+        return 0
+    return remaining
+
+
+def commit(reservation_ids):
+    """
+    Подтверждает резервы после оплаты: количество остается списанным со склада.
+    Резервы, которые успели освободиться, списываются заново через take.
+    Возвращает словарь item_id -> количество, которого не хватило на складе.
+    """
+    with transaction.atomic():
+        Reservation.objects.filter(id__in=reservation_ids, status=Reservation.ACTIVE).update(
+            status=Reservation.COMMITTED
+        )
+        released = (
+            Reservation.objects.filter(id__in=reservation_ids, status=Reservation.RELEASED)
+            .values('item_id', 'order_id').annotate(total=Sum('quantity'))
+        )
+        shortage = {}
+        for row in released:
+            missing = take(row['item_id'], row['total'], row['order_id'])
+            if missing:
+                shortage[row['item_id']] = shortage.get(row['item_id'], 0) + missing
+        return shortage
+
+
+def commit_order(order_id, lines):
+    """
+    Подтверждает резервы оплаченного заказа. lines — пары (item_id, quantity) строк заказа.
+    Если подтвержденных резервов по товару меньше, чем в заказе (резерв истек до оплаты),
+    недостающее списывается заново через take. Возвращает словарь item_id -> количество,
+    которого не хватило на складе.
+    """
+    with transaction.atomic():
+        Reservation.objects.filter(order_id=order_id, status=Reservation.ACTIVE).update(status=Reservation.COMMITTED)
+        committed = dict(
+            Reservation.objects.filter(order_id=order_id, status=Reservation.COMMITTED)
+            .values('item_id').annotate(total=Sum('quantity')).values_list('item_id', 'total')
+        )
+        ordered = {}
+        for item_id, quantity in lines:
+            ordered[item_id] = ordered.get(item_id, 0) + quantity
+        shortage = {}
+        for item_id, quantity in ordered.items():
+            if quantity > committed.get(item_id, 0):
+                missing = take(item_id, quantity - committed.get(item_id, 0), order_id)
+                if missing:
+                    shortage[item_id] = missing
+        return shortage
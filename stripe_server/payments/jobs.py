@@ -0,0 +1,179 @@
+import random
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+import stripe
+from .models import Job, Discount, Order, Tax
+from . import cart, routers, shards
+
+# Зарегистрированные обработчики задач: имя задачи -> функция
+tasks = {}
+
+
+def task(func):
+    """
+    Регистрирует функцию как обработчик фоновой задачи под ее именем.
+    """
+    tasks[func.__name__] = func
+    return func
+
+
+def enqueue(task_name, batch=None, run_at=None, **payload):
+    """
+    Ставит задачу в очередь. Задача станет видна воркеру после коммита текущей транзакции,
+    но не раньше run_at, если он указан.
+    """
+    if task_name not in tasks:
+        raise ValueError(f'Неизвестная задача: {task_name}')
+    return Job.objects.create(task=task_name, payload=payload, batch=batch, run_at=run_at or timezone.now())
+
+
+def enqueue_many(task_name, payloads, batch=None):
+    """
+    Ставит в очередь набор однотипных задач одним запросом.
+    """
+    if task_name not in tasks:
+        raise ValueError(f'Неизвестная задача: {task_name}')
+    return Job.objects.bulk_create(
+        Job(task=task_name, payload=payload, batch=batch) for payload in payloads
+    )
+
+
+def claim_jobs(limit, stale_after):
+    """
+    Забирает до limit готовых к выполнению задач и помечает их как выполняющиеся.
+    Задачи, зависшие в статусе running дольше stale_after (упавший воркер), забираются повторно.
+    На PostgreSQL несколько воркеров не мешают друг другу благодаря SKIP LOCKED.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ready = Job.objects.filter(status=Job.PENDING, run_at__lte=now)
+        stale = Job.objects.filter(status=Job.RUNNING, locked_at__lt=now - stale_after)
+        ids = list(
+            (ready | stale).order_by('run_at')
+            .select_for_update(skip_locked=True)
+            .values_list('id', flat=True)[:limit]
+        )
+        Job.objects.filter(id__in=ids).update(
+            status=Job.RUNNING, locked_at=now, attempts=F('attempts') + 1
+        )
+    return list(Job.objects.filter(id__in=ids))
+
+
+def run_job(job):
+    """
+    Выполняет задачу. При ошибке откладывает повтор с экспоненциальной задержкой,
+    после исчерпания попыток помечает задачу как failed.
+    """
+    # Задачи работают с только что сохраненными объектами, реплика может их еще не содержать
+    routers.pin_to_primary()
+    try:
+        tasks[job.task](**job.payload)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+        else:
+            job.status = Job.PENDING
+            delay = 2 ** job.attempts + random.uniform(0, 1)
+            job.run_at = timezone.now() + timedelta(seconds=delay)
+    else:
+        job.status = Job.DONE
+        job.last_error = ''
+    job.locked_at = None
+    job.save(update_fields=['status', 'last_error', 'run_at', 'locked_at', 'updated_at'])
+    return job.status
+
+
+def is_missing(error):
+    return getattr(error, 'code', None) == 'resource_missing'
+
+
+@task
+def sync_discount(discount_id):
+    """
+    Создает купон в Stripe для скидки, если его еще нет или он был удален в Stripe.
+    """
+    discount = Discount.objects.filter(id=discount_id, active=True).first()
+    if not discount:
+        return
+    api_key = settings.STRIPE_KEYS[discount.currency]['secret']
+    if discount.stripe_coupon_id:
+        try:
+            stripe.Coupon.retrieve(discount.stripe_coupon_id, api_key=api_key)
+            return
+        except stripe.error.InvalidRequestError as e:
+            if not is_missing(e):
+                raise
+    coupon = stripe.Coupon.create(
+        percent_off=discount.percent_off,
+        duration=discount.duration,
+        name=discount.name,
+        currency=discount.currency,
+        api_key=api_key,
+    )
+    Discount.objects.filter(id=discount.id).update(stripe_coupon_id=coupon.id)
+
+
+@task
+def delete_stripe_coupon(currency, coupon_id):
+    """
+    Удаляет купон в Stripe. Уже удаленный купон считается успехом.
+    """
+    try:
+        stripe.Coupon.delete(coupon_id, api_key=settings.STRIPE_KEYS[currency]['secret'])
+    except stripe.error.InvalidRequestError as e:
+        if not is_missing(e):
+            raise
+
+
+@task
+def sync_tax(tax_id):
+    """
+    Создает налоговую ставку в Stripe для налога, если ее еще нет или она была удалена в Stripe.
+    Деактивированную в Stripe ставку активного налога активирует заново.
+    """
+    tax = Tax.objects.filter(id=tax_id, active=True).first()
+    if not tax:
+        return
+    api_key = settings.STRIPE_KEYS[tax.currency]['secret']
+    if tax.stripe_tax_rate_id:
+        try:
+            tax_rate = stripe.TaxRate.retrieve(tax.stripe_tax_rate_id, api_key=api_key)
+            if not tax_rate.active:
+                stripe.TaxRate.modify(tax.stripe_tax_rate_id, active=True, api_key=api_key)
+            return
+        except stripe.error.InvalidRequestError as e:
+            if not is_missing(e):
+                raise
+    tax_rate = stripe.TaxRate.create(
+        display_name=tax.name,
+        percentage=tax.percentage,
+        inclusive=False,
+        api_key=api_key,
+    )
+    Tax.objects.filter(id=tax.id).update(stripe_tax_rate_id=tax_rate.id)
+
+
+@task
+def deactivate_stripe_tax_rate(currency, tax_rate_id):
+    """
+    Деактивирует налоговую ставку в Stripe (удалить ставку Stripe не позволяет).
+    """
+    stripe.TaxRate.modify(tax_rate_id, active=False, api_key=settings.STRIPE_KEYS[currency]['secret'])
+
+
+@task
+def flush_cart_buffer(order_id):
+    """
+    Сбрасывает в БД буфер корзины, которую покупатель не открывал с первого отложенного добавления.
+    Товары резервируются, а не попавшее в корзину покупатель увидит при следующем просмотре корзины.
+    """
+    order = Order.objects.using(shards.alias_for_order_id(order_id)).filter(pk=order_id).first()
+    if order is None:
+        cart.discard(order_id)
+        return
+    cart.flush(order)
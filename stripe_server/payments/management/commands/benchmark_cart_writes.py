@@ -0,0 +1,122 @@
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+from copy import deepcopy
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, override_settings
+from payments.catalog import rebuild_snapshot
+from payments.models import Item, Order
+
+
+class Command(BaseCommand):
+    """
+    Измеряет устойчивую скорость записи в корзины на SQLite при нескольких процессах, как у gunicorn.
+    Запускает --workers процессов по --threads потоков, каждый поток — отдельный покупатель, который
+    в течение --duration секунд добавляет в корзину случайные товары через полный стек Django.
+    Сравнивает настройки SQLite по умолчанию (журнал отката, отложенные транзакции) с профилем из settings
+    (WAL, busy_timeout, BEGIN IMMEDIATE) и с тем же профилем, но отложенными транзакциями, чтобы
+    отдельно оценить вклад BEGIN IMMEDIATE. Лимиты запросов на время теста отключаются.
+    """
+    help = 'Бенчмарк записи в корзины на SQLite с несколькими процессами'
+
+    modes = ['default', 'deferred', 'configured']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Количество процессов')
+        parser.add_argument('--threads', type=int, default=4, help='Количество потоков на процесс')
+        parser.add_argument('--duration', type=float, default=10, help='Длительность теста для каждого режима, секунды')
+        parser.add_argument('--items', type=int, default=20, help='Количество товаров для добавления')
+        parser.add_argument('--mode', choices=self.modes, action='append', help='Режимы для сравнения (по умолчанию все)')
+
+    def handle(self, *args, **options):
+        base = connections['default'].settings_dict
+        if base['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('Бенчмарк поддерживает только django.db.backends.sqlite3')
+
+        items = Item.objects.bulk_create([
+            Item(name=f'benchmark cart item {index}', description='', price=100) for index in range(options['items'])
+        ])
+        # bulk_create не отправляет post_save, поэтому снимок каталога обновляется явно
+        self.rebuild_catalog()
+        last_order_id = Order.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        self.stdout.write(f"{'mode':<12}{'writes/s':>10}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        try:
+            for mode in options['mode'] or self.modes:
+                latencies, errors, elapsed = self.run(self.get_options(base, mode), [item.id for item in items], options)
+                latencies.sort()
+                quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+                self.stdout.write(
+                    f'{mode:<12}{len(latencies) / elapsed:>10.0f}{errors:>8}'
+                    f'{quantiles[49] * 1000:>10.2f}{quantiles[94] * 1000:>10.2f}{quantiles[98] * 1000:>10.2f}'
+                )
+        finally:
+            Order.objects.filter(id__gt=last_order_id).delete()
+            Item.objects.filter(id__in=[item.id for item in items]).delete()
+            self.rebuild_catalog()
+
+    def rebuild_catalog(self):
+        if settings.CATALOG_SNAPSHOT_ENABLED:
+            rebuild_snapshot(changed=True)
+
+    def get_options(self, base, mode):
+        if mode == 'configured':
+            return deepcopy(base['OPTIONS'])
+        if mode == 'deferred':
+            return {**deepcopy(base['OPTIONS']), 'transaction_mode': 'DEFERRED'}
+        # Значения SQLite по умолчанию; режим журнала хранится в файле БД, поэтому WAL выключается явно
+        return {'init_command': 'PRAGMA journal_mode=DELETE'}
+
+    def run(self, db_options, item_ids, options):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        connections.close_all()
+        deadline = time.time() + options['duration']
+        workers = [
+            context.Process(target=self.worker, args=(db_options, item_ids, options['threads'], deadline, results))
+            for _ in range(options['workers'])
+        ]
+        started = time.perf_counter()
+        for process in workers:
+            process.start()
+        latencies = []
+        errors = 0
+        for _ in workers:
+            worker_latencies, worker_errors = results.get()
+            latencies.extend(worker_latencies)
+            errors += worker_errors
+        for process in workers:
+            process.join()
+        return latencies, errors, time.perf_counter() - started
+
+    def worker(self, db_options, item_ids, threads, deadline, results):
+        connections['default'].settings_dict['OPTIONS'] = db_options
+        latencies = []
+        errors = [0]
+        lock = threading.Lock()
+
+        def shopper():
+            client = Client(raise_request_exception=False)
+            local = []
+            while time.time() < deadline:
+                started = time.perf_counter()
+                response = client.post(f'/add_to_order/{random.choice(item_ids)}/')
+                if response.status_code == 200:
+                    local.append(time.perf_counter() - started)
+                else:
+                    with lock:
+                        errors[0] += 1
+            connections.close_all()
+            with lock:
+                latencies.extend(local)
+
+        with override_settings(RATE_LIMITS={}, ALLOWED_HOSTS=['testserver']):
+            shoppers = [threading.Thread(target=shopper) for _ in range(threads)]
+            for thread in shoppers:
+                thread.start()
+            for thread in shoppers:
+                thread.join()
+        results.put((latencies, errors[0]))
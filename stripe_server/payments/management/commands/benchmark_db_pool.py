@@ -0,0 +1,81 @@
+import statistics
+import threading
+import time
+from copy import deepcopy
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from payments.models import Item
+
+
+class Command(BaseCommand):
+    """
+    Сравнивает режимы подключения к PostgreSQL: новое соединение на запрос, постоянные соединения и пул psycopg 3.
+    Каждый поток имитирует цикл обработки HTTP-запроса: получает соединение, выполняет запрос к каталогу
+    и освобождает соединение так же, как это делает Django по сигналу request_finished.
+    """
+    help = 'Бенчмарк соединений с БД без пула, с CONN_MAX_AGE и с пулом psycopg 3'
+
+    modes = ['unpooled', 'persistent', 'pooled']
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8, help='Количество параллельных потоков')
+        parser.add_argument('--requests', type=int, default=200, help='Количество запросов на поток')
+        parser.add_argument('--pool-size', type=int, default=8, help='Максимальный размер пула')
+        parser.add_argument('--mode', choices=self.modes, action='append', help='Режимы для сравнения (по умолчанию все)')
+
+    def handle(self, *args, **options):
+        base = connections['default'].settings_dict
+        if base['ENGINE'] != 'django.db.backends.postgresql':
+            raise CommandError('Бенчмарк поддерживает только django.db.backends.postgresql')
+
+        self.stdout.write(f"{'mode':<12}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for mode in options['mode'] or self.modes:
+            alias = f'benchmark_{mode}'
+            connections.settings[alias] = self.get_settings(base, mode, options['pool_size'])
+            try:
+                latencies, elapsed = self.run(alias, options['threads'], options['requests'])
+            finally:
+                if mode == 'pooled':
+                    connections[alias].close_pool()
+                del connections.settings[alias]
+
+            latencies.sort()
+            quantiles = statistics.quantiles(latencies, n=100)
+            self.stdout.write(
+                f'{mode:<12}{len(latencies) / elapsed:>10.0f}'
+                f'{quantiles[49] * 1000:>10.2f}{quantiles[94] * 1000:>10.2f}{quantiles[98] * 1000:>10.2f}'
+            )
+
+    def get_settings(self, base, mode, pool_size):
+        settings_dict = deepcopy(base)
+        settings_dict['OPTIONS'].pop('pool', None)
+        settings_dict['CONN_MAX_AGE'] = 0
+        if mode == 'persistent':
+            settings_dict['CONN_MAX_AGE'] = None
+        elif mode == 'pooled':
+            settings_dict['OPTIONS']['pool'] = {'min_size': pool_size, 'max_size': pool_size}
+        return settings_dict
+
+    def run(self, alias, threads, requests):
+        latencies = []
+        lock = threading.Lock()
+
+        def worker():
+            local = []
+            connection = connections[alias]
+            for _ in range(requests):
+                started = time.perf_counter()
+                list(Item.objects.using(alias).values_list('id', 'price')[:20])
+                connection.close_if_unusable_or_obsolete()
+                local.append(time.perf_counter() - started)
+            connection.close()
+            with lock:
+                latencies.extend(local)
+
+        pool_threads = [threading.Thread(target=worker) for _ in range(threads)]
+        started = time.perf_counter()
+        for thread in pool_threads:
+            thread.start()
+        for thread in pool_threads:
+            thread.join()
+        return latencies, time.perf_counter() - started
@@ -0,0 +1,69 @@
+import threading
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Sum
+from payments.inventory import OutOfStock, reserve, set_stock
+from payments.models import Item, Reservation, StockShard
+
+
+class Command(BaseCommand):
+    """
+    Нагрузочный тест резервирования товара.
+    Создает временный товар с остатком --stock, разбитым на --shards частей, и резервирует его
+    из --threads потоков по одной единице, пока товар не закончится. После теста проверяет,
+    что зарезервировано ровно столько, сколько было на складе, и ни одна часть не ушла в минус.
+    Для измерения реальной конкурентности запускайте на PostgreSQL.
+    """
+    help = 'Бенчмарк резервирования товара на складе с проверкой отсутствия перепродажи'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--stock', type=int, default=5000, help='Начальный остаток')
+        parser.add_argument('--shards', type=int, default=16, help='Количество частей остатка')
+        parser.add_argument('--threads', type=int, default=32, help='Количество параллельных покупателей')
+
+    def handle(self, *args, **options):
+        item = Item.objects.create(name='benchmark inventory item', description='', price=100)
+        try:
+            set_stock(item.id, options['stock'], options['shards'])
+            reserved, errors, elapsed = self.run(item.id, options['threads'])
+            self.report(item.id, options, reserved, errors, elapsed)
+        finally:
+            item.delete()
+
+    def run(self, item_id, threads):
+        reserved = [0] * threads
+        errors = [0] * threads
+
+        def buyer(index):
+            while True:
+                try:
+                    reserve(item_id, 1, ttl=3600)
+                    reserved[index] += 1
+                except OutOfStock:
+                    break
+                except Exception:
+                    errors[index] += 1
+                    if errors[index] > 1000:
+                        break
+            connections.close_all()
+
+        buyers = [threading.Thread(target=buyer, args=(index,)) for index in range(threads)]
+        started = time.perf_counter()
+        for thread in buyers:
+            thread.start()
+        for thread in buyers:
+            thread.join()
+        return sum(reserved), sum(errors), time.perf_counter() - started
+
+    def report(self, item_id, options, reserved, errors, elapsed):
+        remaining = StockShard.objects.filter(item_id=item_id).aggregate(total=Sum('quantity'))['total']
+        reservations = Reservation.objects.filter(item_id=item_id).aggregate(total=Sum('quantity'))['total'] or 0
+        self.stdout.write(
+            f"stock={options['stock']} shards={options['shards']} threads={options['threads']}\n"
+            f"reserved={reserved} in reservations={reservations} remaining={remaining} errors={errors}\n"
+            f"{reserved / elapsed:.0f} reservations/s in {elapsed:.2f}s"
+        )
+        if reserved != options['stock'] or reservations != options['stock'] or remaining != 0:
+            raise CommandError('Остаток не сошелся: обнаружена перепродажа или потеря товара')
+        self.stdout.write(self.style.SUCCESS('Перепродажи нет'))
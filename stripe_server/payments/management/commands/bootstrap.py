@@ -0,0 +1,38 @@
+import os
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    """
+    Одноразовая подготовка окружения перед запуском веб-процессов.
+    Применяет миграции, собирает снимок каталога и создает суперпользователя из переменных окружения, если его еще нет.
+    Запускается отдельно от gunicorn, чтобы новые реплики не тратили время на эти шаги при старте.
+    """
+    help = 'Применяет миграции, собирает снимок каталога и создает суперпользователя'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--skip-superuser',
+            action='store_true',
+            help='Не создавать суперпользователя',
+        )
+
+    def handle(self, *args, **options):
+        call_command('migrate', interactive=False, verbosity=options['verbosity'])
+        if settings.CATALOG_SNAPSHOT_ENABLED:
+            call_command('build_catalog_snapshot', verbosity=options['verbosity'])
+        if options['skip_superuser']:
+            return
+
+        User = get_user_model()
+        username = os.getenv('DJANGO_SUPERUSER_USERNAME', 'admin')
+        email = os.getenv('DJANGO_SUPERUSER_EMAIL', 'admin@example.com')
+        password = os.getenv('DJANGO_SUPERUSER_PASSWORD', 'admin123')
+        if User.objects.filter(username=username).exists():
+            self.stdout.write(f'Суперпользователь {username} уже существует')
+            return
+        User.objects.create_superuser(username, email, password)
+        self.stdout.write(self.style.SUCCESS(f'Суперпользователь {username} создан'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+from payments.catalog import rebuild_snapshot
+from django.conf import settings
+
+
+class Command(BaseCommand):
+    """
+    Перестраивает снимок каталога товаров.
+    Нужен после массовых изменений товаров в обход сигналов моделей (update, bulk_create, загрузка фикстур).
+    """
+    help = 'Перестраивает снимок каталога товаров'
+
+    def handle(self, *args, **options):
+        generation = rebuild_snapshot(changed=True)
+        self.stdout.write(self.style.SUCCESS(
+            f'Снимок каталога {settings.CATALOG_SNAPSHOT_PATH} собран, поколение {generation}'
+        ))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from payments.recommendations import refresh
+
+
+class Command(BaseCommand):
+    """
+    Пересчитывает рекомендации «покупают вместе» по оплаченным заказам.
+    По умолчанию обрабатывает только заказы, оплаченные после прошлого запуска.
+    Запускается периодически, например из cron.
+    """
+    help = 'Пересчитывает рекомендации «покупают вместе»'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Пересобрать по всей истории заказов')
+        parser.add_argument('--top-k', type=int, default=None, help='Количество соседей у товара')
+        parser.add_argument('--min-support', type=int, default=None, help='Минимальное количество совместных покупок')
+
+    def handle(self, *args, **options):
+        written = refresh(options['full'], options['top_k'], options['min_support'])
+        self.stdout.write(self.style.SUCCESS(f'Обновлено рекомендаций: {written}'))
@@ -0,0 +1,76 @@
+from datetime import datetime, timezone as dt_timezone
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from payments.catalog import rebuild_snapshot
+from payments.fixtures import Distributions, FixtureGenerator, parse_currencies
+
+
+class Command(BaseCommand):
+    """
+    Заполняет БД объемами данных как в продакшене для проверки производительности каталога, админки и заказов.
+    В PostgreSQL строки передаются через COPY, в SQLite — пачками INSERT. Один и тот же --seed дает те же данные.
+    """
+    help = 'Генерирует товары, скидки, налоги, заказы и строки заказов для нагрузочной проверки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=100000, help='Количество товаров')
+        parser.add_argument('--orders', type=int, default=1000000, help='Количество заказов')
+        parser.add_argument('--discounts', type=int, default=100, help='Количество скидок')
+        parser.add_argument('--taxes', type=int, default=20, help='Количество налогов')
+        parser.add_argument('--seed', type=int, default=0, help='Seed генератора')
+        parser.add_argument('--currencies', default='usd=0.7,eur=0.3', help='Доли валют товаров и заказов')
+        parser.add_argument('--cart-size-mean', type=float, default=3.0, help='Среднее количество строк в заказе')
+        parser.add_argument('--cart-size-max', type=int, default=20, help='Максимальное количество строк в заказе')
+        parser.add_argument('--quantity-mean', type=float, default=1.5, help='Среднее количество товара в строке')
+        parser.add_argument('--description-mean', type=int, default=400, help='Медианная длина описания товара, символов')
+        parser.add_argument('--description-max', type=int, default=5000, help='Максимальная длина описания товара, символов')
+        parser.add_argument('--item-skew', type=float, default=1.1, help='Показатель распределения Ципфа популярности товаров')
+        parser.add_argument('--paid-ratio', type=float, default=0.8, help='Доля оплаченных заказов')
+        parser.add_argument('--discount-ratio', type=float, default=0.2, help='Доля заказов со скидкой')
+        parser.add_argument('--tax-ratio', type=float, default=0.5, help='Доля заказов с налогом')
+        parser.add_argument('--days', type=int, default=365, help='За сколько дней распределены оплаты')
+        parser.add_argument('--until', help='Дата последней оплаты YYYY-MM-DD, по умолчанию сегодня')
+
+    def handle(self, *args, **options):
+        if options['orders'] and not options['items']:
+            raise CommandError('Для заказов нужны товары: задайте --items')
+        try:
+            currencies = parse_currencies(options['currencies'])
+            until = datetime.strptime(options['until'], '%Y-%m-%d').replace(tzinfo=dt_timezone.utc) if options['until'] else None
+        except ValueError as e:
+            raise CommandError(e)
+        unknown = set(currencies) - set(settings.STRIPE_KEYS)
+        if unknown:
+            raise CommandError(f"Неизвестные валюты: {', '.join(sorted(unknown))}")
+
+        distributions = Distributions(
+            currencies=currencies,
+            cart_size_mean=options['cart_size_mean'],
+            cart_size_max=options['cart_size_max'],
+            quantity_mean=options['quantity_mean'],
+            description_mean=options['description_mean'],
+            description_max=options['description_max'],
+            item_skew=options['item_skew'],
+            paid_ratio=options['paid_ratio'],
+            discount_ratio=options['discount_ratio'],
+            tax_ratio=options['tax_ratio'],
+            days=options['days'],
+            until=until,
+        )
+        generator = FixtureGenerator(options['seed'], distributions, progress=self.progress)
+        stats = generator.run(options['items'], options['orders'], options['discounts'], options['taxes'])
+        self.stdout.write(f"{'table':<12}{'rows':>12}{'seconds':>10}{'rows/min':>14}")
+        for table, (rows, elapsed) in stats.items():
+            rate = rows / elapsed * 60 if elapsed else 0
+            self.stdout.write(f'{table:<12}{rows:>12}{elapsed:>10.1f}{rate:>14.0f}')
+        # Товары записаны в обход сигналов, поэтому снимок каталога обновляется явно
+        if settings.CATALOG_SNAPSHOT_ENABLED:
+            rebuild_snapshot(changed=True)
+
+    def progress(self, table, rows, elapsed):
+        if self.verbosity > 1:
+            self.stdout.write(f'{table}: {rows} строк, {elapsed:.1f} с')
+
+    def execute(self, *args, **options):
+        self.verbosity = options.get('verbosity', 1)
+        return super().execute(*args, **options)
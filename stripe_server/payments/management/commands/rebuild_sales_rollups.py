@@ -0,0 +1,20 @@
+from datetime import date
+from django.core.management.base import BaseCommand
+from payments.rollups import rebuild
+
+
+class Command(BaseCommand):
+    """
+    Пересобирает сводные продажи по оплаченным заказам.
+    Используется для первичного заполнения таблицы и для исправления после ручных правок заказов.
+    С --since пересчитываются только дни начиная с указанной даты.
+    """
+    help = 'Пересобирает сводные продажи по дням, товарам и валютам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=date.fromisoformat, default=None, help='Первый пересчитываемый день (YYYY-MM-DD)')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки при чтении и записи')
+
+    def handle(self, *args, **options):
+        written = rebuild(options['since'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Записано строк сводных продаж: {written}'))
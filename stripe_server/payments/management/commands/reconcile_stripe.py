@@ -0,0 +1,36 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from payments.reconcile import KINDS, Reconciler
+
+
+class Command(BaseCommand):
+    """
+    Сверяет купоны, налоговые ставки и сессии Checkout аккаунтов Stripe всех валют с локальными данными
+    и исправляет расхождения. Создание и деактивация объектов в Stripe выполняются воркером run_jobs.
+    Для проверки без Stripe запустите run_fake_stripe и задайте STRIPE_API_BASE.
+    """
+    help = 'Сверяет данные Stripe с локальными скидками, налогами и заказами'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='За сколько дней загружать сессии Checkout')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Размер куска при сверке')
+        parser.add_argument('--concurrency', type=int, default=4, help='Количество параллельных загрузок из Stripe')
+        parser.add_argument('--dry-run', action='store_true', help='Только показать расхождения')
+
+    def handle(self, *args, **options):
+        reconciler = Reconciler(
+            since=timezone.now() - timedelta(days=options['days']),
+            chunk_size=options['chunk_size'],
+            concurrency=options['concurrency'],
+            dry_run=options['dry_run'],
+        )
+        stats = reconciler.run()
+        columns = ['fetched', 'matched', 'orphaned', 'drifted', 'missing', 'unsynced', 'activity', 'completed', 'unconfirmed', 'fixed']
+        self.stdout.write(f"{'currency':<10}{'kind':<19}" + ''.join(f'{column:>12}' for column in columns))
+        for (currency, kind), counter in sorted(stats.items(), key=lambda entry: (entry[0][0], KINDS.index(entry[0][1]))):
+            self.stdout.write(f'{currency:<10}{kind:<19}' + ''.join(f'{counter[column]:>12}' for column in columns))
+        for error in reconciler.errors:
+            self.stderr.write(error)
+        if options['dry_run']:
+            self.stdout.write('Режим --dry-run: изменения не применялись')
@@ -0,0 +1,25 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from payments.inventory import release_expired
+
+
+class Command(BaseCommand):
+    """
+    Возвращает на склад товары из резервов с истекшим сроком.
+    Запускается периодически или в режиме цикла с --interval.
+    """
+    help = 'Освобождает просроченные резервы товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help='Повторять каждые N секунд (0 — выполнить один раз)')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            released = release_expired()
+            if released:
+                self.stdout.write(f'Освобождено резервов: {released}')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
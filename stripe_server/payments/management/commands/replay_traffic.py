@@ -0,0 +1,94 @@
+import json
+import threading
+import stripe
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from payments import capture
+from payments.fakestripe import serve
+
+
+class Command(BaseCommand):
+    """
+    Воспроизводит записанный TrafficCaptureMiddleware трафик на локальной копии приложения через полный стек Django.
+    Запросы каждой сессии идут в записанном порядке и с записанными паузами, деленными на --speed.
+    Stripe заменяется поддельным сервером в том же процессе, лимиты запросов отключаются.
+    Запросы пишут корзины, заказы и резервы в настроенную БД, поэтому перед запуском запрашивается подтверждение.
+    Выводит по маршрутам задержку и число запросов к БД в сравнении с записью или с сохраненным прогоном --baseline.
+    """
+    help = 'Воспроизводит записанный трафик и сравнивает задержки и число запросов к БД по маршрутам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Файлы записи или каталоги с ними')
+        parser.add_argument('--speed', type=float, default=1, help='Ускорение относительно записи, 0 — без пауз')
+        parser.add_argument('--concurrency', type=int, default=32, help='Количество одновременно воспроизводимых сессий')
+        parser.add_argument('--sessions', type=int, help='Воспроизвести только первые N сессий')
+        parser.add_argument('--baseline', help='Сравнивать со сводкой прогона, сохраненной --save, а не с записью')
+        parser.add_argument('--save', help='Сохранить сводку этого прогона в JSON')
+        parser.add_argument(
+            '--noinput', '--no-input', action='store_false', dest='interactive',
+            help='Не спрашивать подтверждение записи в БД'
+        )
+
+    def handle(self, *args, **options):
+        records = capture.read_records(options['paths'])
+        if not records:
+            raise CommandError('Записей не найдено')
+        sessions = capture.group_sessions(records)[:options['sessions']]
+        recorded = [record for records in sessions for record in records]
+
+        database = settings.DATABASES['default']
+        target = f"{database['NAME']} ({database.get('HOST') or 'localhost'})"
+        self.stdout.write(self.style.WARNING(
+            f'Воспроизведение запишет корзины, заказы и резервы в БД {target}. Используйте копию, а не продакшен.'
+        ))
+        if options['interactive'] and input('Продолжить? (yes/no): ') != 'yes':
+            raise CommandError('Воспроизведение отменено')
+        server = serve(port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_base = stripe.api_base
+        stripe.api_base = f'http://127.0.0.1:{server.server_address[1]}'
+        fake_keys = {
+            currency: {'public': f'pk_test_replay_{currency}', 'secret': f'sk_test_replay_{currency}'}
+            for currency in settings.STRIPE_KEYS
+        }
+        self.stdout.write(f'Воспроизведение {len(recorded)} запросов из {len(sessions)} сессий')
+        try:
+            with override_settings(RATE_LIMITS={}, ALLOWED_HOSTS=['testserver'], STRIPE_KEYS=fake_keys, CAPTURE_ENABLED=False):
+                results = capture.replay(sessions, options['speed'], options['concurrency'])
+        finally:
+            stripe.api_base = api_base
+            server.shutdown()
+            server.server_close()
+
+        summary = capture.summarize(results)
+        if options['save']:
+            with open(options['save'], 'w', encoding='utf-8') as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as f:
+                baseline = json.load(f)
+        else:
+            baseline = capture.summarize(recorded)
+        self.report(baseline, summary)
+
+    def report(self, baseline, summary):
+        self.stdout.write(
+            f"{'route':<40}{'requests':>9}{'p50 base':>10}{'p50':>9}{'Δ%':>8}{'p95 base':>10}{'p95':>9}{'Δ%':>8}"
+            f"{'queries base':>14}{'queries':>9}{'Δ':>7}{'errors':>8}{'status≠':>9}"
+        )
+        for route, stats in sorted(summary.items()):
+            base = baseline.get(route)
+            if base is None:
+                self.stdout.write(f"{route:<40}{stats['requests']:>9}   нет в базовой сводке")
+                continue
+            self.stdout.write(
+                f"{route:<40}{stats['requests']:>9}"
+                f"{base['p50_ms']:>10.2f}{stats['p50_ms']:>9.2f}{self.delta(base['p50_ms'], stats['p50_ms']):>8}"
+                f"{base['p95_ms']:>10.2f}{stats['p95_ms']:>9.2f}{self.delta(base['p95_ms'], stats['p95_ms']):>8}"
+                f"{base['queries']:>14.1f}{stats['queries']:>9.1f}{stats['queries'] - base['queries']:>+7.1f}"
+                f"{stats['errors']:>8}{stats['mismatched']:>9}"
+            )
+
+    def delta(self, base, value):
+        return f'{(value - base) / base * 100:+.0f}' if base else '-'
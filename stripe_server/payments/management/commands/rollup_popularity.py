@@ -0,0 +1,24 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from payments.popularity import rollup
+
+
+class Command(BaseCommand):
+    """
+    Сворачивает счетчики популярности в затухающий рейтинг и обновляет списки популярных товаров в кеше.
+    Запускается периодически или в режиме цикла с --interval.
+    """
+    help = 'Пересчитывает рейтинг популярности товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=0, help='Повторять каждые N секунд (0 — выполнить один раз)')
+
+    def handle(self, *args, **options):
+        while True:
+            close_old_connections()
+            ranked = rollup()
+            self.stdout.write(f'Товаров в рейтинге: {ranked}')
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,30 @@
+import json
+from django.core.management.base import BaseCommand
+from payments.fakestripe import FakeStripeState, serve
+
+
+class Command(BaseCommand):
+    """
+    Запускает локальный поддельный Stripe для проверки интеграции без доступа к Stripe.
+    Приложение направляется на него переменной STRIPE_API_BASE=http://127.0.0.1:12111.
+    """
+    help = 'Запускает локальный поддельный Stripe API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1', help='Адрес')
+        parser.add_argument('--port', type=int, default=12111, help='Порт')
+        parser.add_argument('--fixtures', help='JSON с начальными объектами: {api_key: {"coupons": [...], "tax_rates": [...]}}')
+
+    def handle(self, *args, **options):
+        state = FakeStripeState()
+        if options['fixtures']:
+            with open(options['fixtures'], encoding='utf-8') as f:
+                state.load(json.load(f))
+        server = serve(options['host'], options['port'], state)
+        self.stdout.write(f"Поддельный Stripe слушает http://{options['host']}:{options['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
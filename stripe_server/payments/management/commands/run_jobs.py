@@ -0,0 +1,42 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from payments.jobs import claim_jobs, run_job
+
+
+class Command(BaseCommand):
+    """
+    Воркер очереди фоновых задач.
+    Забирает готовые задачи из БД пачками и выполняет их в пуле потоков ограниченного размера,
+    чтобы не превышать лимиты Stripe API. Можно запускать несколько воркеров параллельно.
+    """
+    help = 'Выполняет фоновые задачи из очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='Количество задач, выполняемых параллельно')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Пауза при пустой очереди, секунды')
+        parser.add_argument('--stale-after', type=int, default=300, help='Через сколько секунд задача running считается зависшей')
+        parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и завершиться')
+
+    def handle(self, *args, **options):
+        concurrency = options['concurrency']
+        stale_after = timedelta(seconds=options['stale_after'])
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while True:
+                close_old_connections()
+                jobs = claim_jobs(concurrency, stale_after)
+                if jobs:
+                    for job, status in zip(jobs, executor.map(self.run, jobs)):
+                        self.stdout.write(f'{job} -> {status}')
+                    continue
+                if options['once']:
+                    return
+                time.sleep(options['sleep'])
+
+    def run(self, job):
+        try:
+            return run_job(job)
+        finally:
+            connections.close_all()
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from payments.inventory import set_stock
+from payments.models import Item
+
+
+class Command(BaseCommand):
+    """
+    Устанавливает доступный остаток товара.
+    Для популярных товаров остаток стоит разбить на несколько частей (--shards), чтобы снизить конкуренцию за блокировки.
+    """
+    help = 'Устанавливает остаток товара на складе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('item_id', type=int)
+        parser.add_argument('quantity', type=int)
+        parser.add_argument('--shards', type=int, default=1, help='Количество частей остатка (0 — не отслеживать остаток)')
+
+    def handle(self, *args, **options):
+        if not Item.objects.filter(pk=options['item_id']).exists():
+            raise CommandError(f"Товар {options['item_id']} не найден")
+        set_stock(options['item_id'], options['quantity'], options['shards'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Остаток товара {options['item_id']}: {options['quantity']} в {options['shards']} частях"
+        ))
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from payments.shards import ensure_id_range, sync_reference_tables
+
+
+class Command(BaseCommand):
+    """
+    Готовит БД валют к работе при ORDER_SHARDING: копирует в них товары, скидки и налоги с primary
+    и сдвигает последовательности id заказов к началу диапазона каждой БД.
+    Запускается после migrate --database=orders_<валюта> и после записей в каталог в обход сигналов.
+    Повторный запуск безопасен.
+    """
+    help = 'Синхронизирует справочные таблицы и диапазоны id в БД заказов валют'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Размер пачки при копировании')
+
+    def handle(self, *args, **options):
+        if not settings.ORDER_SHARDS:
+            raise CommandError('Шардирование заказов выключено: задайте ORDER_SHARDING=True')
+        for currency, shard in settings.ORDER_SHARDS.items():
+            stats = sync_reference_tables(shard['alias'], options['batch_size'])
+            ensure_id_range(shard['alias'])
+            copied = ', '.join(f'{model}: {count}' for model, count in stats.items())
+            self.stdout.write(self.style.SUCCESS(
+                f"{shard['alias']} ({currency}): {copied}; id заказов с {shard['id_offset']}"
+            ))
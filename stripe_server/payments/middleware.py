@@ -0,0 +1,224 @@
+import math
+import random
+import time
+from contextlib import ExitStack
+from django.conf import settings
+from django.db import connection, connections, DatabaseError
+from django.http import JsonResponse
+from . import capture, ratelimit, routers, tracing
+
+
+class HealthCheckMiddleware:
+    """
+    Отвечает на пробы оркестратора /healthz и /readyz.
+    Стоит первым в MIDDLEWARE, поэтому ответ формируется до проверки ALLOWED_HOSTS
+    (пробы приходят на IP пода), сессий, CSRF и DRF.
+    /healthz не обращается к БД, /readyz выполняет самый дешевый запрос и при недоступности БД возвращает 503.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.path == '/healthz':
+            return JsonResponse({'status': 'ok'})
+        if request.path == '/readyz':
+            return self.readyz()
+        return self.get_response(request)
+
+    def readyz(self):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except DatabaseError as e:
+            return JsonResponse({'status': 'unavailable', 'error': str(e)}, status=503)
+        return JsonResponse({'status': 'ok'})
+
+
+class PrimaryDatabasePinningMiddleware:
+    """
+    Обеспечивает read-your-writes при чтении каталога с реплик.
+    Запрос читает с primary, если он изменяющий (не GET/HEAD/OPTIONS), если у представления
+    выставлен атрибут use_primary_db (корзина и оплата) или если сессия недавно писала в БД.
+    После запроса с записью сессия закрепляется за primary на DB_REPLICA_PIN_SECONDS секунд,
+    чтобы пользователь не увидел устаревшие данные, пока реплика догоняет primary.
+    Должен стоять после SessionMiddleware.
+    """
+    session_key = 'db_primary_until'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        routers.reset_state()
+        pinned_until = request.session.get(self.session_key, 0)
+        routers.pin_to_primary(
+            request.method not in ('GET', 'HEAD', 'OPTIONS') or pinned_until > time.time()
+        )
+        try:
+            response = self.get_response(request)
+            if routers.has_written():
+                request.session[self.session_key] = time.time() + settings.DB_REPLICA_PIN_SECONDS
+            elif pinned_until and pinned_until <= time.time():
+                del request.session[self.session_key]
+        finally:
+            routers.reset_state()
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if getattr(view_class, 'use_primary_db', False):
+            routers.pin_to_primary()
+
+
+class RateLimitMiddleware:
+    """
+    Защищает дорогие маршруты (изменение корзины, купоны, оплата) от перегрузки.
+    Маршрут определяется атрибутом rate_limit_scope у представления и настройкой RATE_LIMITS.
+    Сначала срабатывает сброс нагрузки: если в процессе выполняется больше LOAD_SHED_MAX_IN_FLIGHT
+    запросов (включая текущий), возвращается 503 до загрузки сессии и любых запросов к БД.
+    Затем проверяются корзины токенов клиента по IP и по cookie сессии: при исчерпании возвращается 429.
+    Сессия при этом не загружается, поэтому отказ тоже обходится без запросов к БД.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.in_flight = ratelimit.request_started()
+        try:
+            return self.get_response(request)
+        finally:
+            ratelimit.request_finished()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        scope = getattr(view_class, 'rate_limit_scope', None)
+        if scope not in settings.RATE_LIMITS:
+            return None
+
+        if settings.LOAD_SHED_MAX_IN_FLIGHT and request.in_flight > settings.LOAD_SHED_MAX_IN_FLIGHT:
+            ratelimit.record_rejection(scope, 'shed')
+            response = JsonResponse({'error': 'Сервер перегружен, повторите попытку позже'}, status=503)
+            response['Retry-After'] = '1'
+            return response
+
+        wait = ratelimit.take_client_token(scope, request)
+        if wait:
+            ratelimit.record_rejection(scope, 'throttled')
+            response = JsonResponse({'error': 'Слишком много запросов, повторите попытку позже'}, status=429)
+            response['Retry-After'] = str(math.ceil(wait))
+            return response
+        return None
+
+
+class TracingMiddleware:
+    """
+    Открывает корневой спан запроса и спаны на каждый запрос к БД.
+    Решение о трассировке принимается по TRACING_SAMPLE_RATE или по флагу выборки во входящем
+    заголовке traceparent. Запросы вне выборки не создают ни одного спана.
+    Идентификатор трассы возвращается клиенту в заголовке traceresponse.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with tracing.start_trace(
+            f'{request.method} {request.path}',
+            request.META.get('HTTP_TRACEPARENT'),
+            **{'http.method': request.method, 'http.target': request.path},
+        ) as span:
+            if span is None:
+                return self.get_response(request)
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(tracing.trace_query))
+                response = self.get_response(request)
+            span.attributes['http.status_code'] = response.status_code
+            if request.resolver_match:
+                span.attributes['http.route'] = request.resolver_match.route
+                span.name = f'{request.method} {request.resolver_match.route}'
+            response['traceresponse'] = span.traceparent
+            return response
+
+
+class TracingViewMiddleware:
+    """
+    Открывает спан на обработку запроса после всех middleware: разбор URL, process_view,
+    представление и process_exception. Представление вызывает Django, поэтому ATOMIC_REQUESTS
+    и хуки остальных middleware работают как обычно. Имя представления записывается в спан
+    в process_view. Должен стоять последним в MIDDLEWARE.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with tracing.start_span('view') as span:
+            response = self.get_response(request)
+            if span is not None:
+                span.attributes['http.status_code'] = response.status_code
+            return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        span = tracing.current_span.get()
+        if span is None:
+            return None
+        view_class = getattr(view_func, 'view_class', None)
+        name = view_class.__name__ if view_class else getattr(view_func, '__qualname__', repr(view_func))
+        span.name = f'view {name}'
+        span.attributes['code.function'] = name
+        return None
+
+
+class TrafficCaptureMiddleware:
+    """
+    Записывает выборку реальных запросов для воспроизведения командой replay_traffic:
+    маршрут, метод, структуру параметров и тела без строковых значений, статус, время ответа и число запросов к БД.
+    Выборка делается по сессии (CAPTURE_SAMPLE_RATE), поэтому последовательность запросов покупателя
+    записывается целиком; ключ сессии заменяется псевдонимом. Записи пишутся в сжатые файлы в CAPTURE_DIR
+    из фонового потока. Стоит перед SessionMiddleware, чтобы видеть cookie сессии, созданной в этом запросе.
+    CAPTURE_ENABLED проверяется на каждом запросе, поэтому запись можно выключить без пересборки MIDDLEWARE
+    (так делает replay_traffic, чтобы воспроизведение не записывалось снова).
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.CAPTURE_ENABLED:
+            return self.get_response(request)
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if session_key and not capture.is_sampled(session_key):
+            return self.get_response(request)
+        if any(request.path_info.startswith(prefix) for prefix in settings.CAPTURE_EXCLUDE):
+            return self.get_response(request)
+
+        body = capture.get_body_shape(request)
+        started_at = time.time()
+        with ExitStack() as stack:
+            counter = capture.count_queries(stack)
+            started = time.perf_counter()
+            response = self.get_response(request)
+            duration = (time.perf_counter() - started) * 1000
+
+        if not session_key:
+            # Сессия создана в этом запросе: выборка по ее ключу, чтобы следующие запросы тоже попали в запись
+            cookie = response.cookies.get(settings.SESSION_COOKIE_NAME)
+            session_key = cookie.value if cookie else None
+            if session_key and not capture.is_sampled(session_key):
+                return response
+            if not session_key and random.random() >= settings.CAPTURE_SAMPLE_RATE:
+                return response
+        if request.resolver_match is None:
+            return response
+        capture.writer.submit({
+            'ts': started_at,
+            'session': capture.anonymize_session(session_key),
+            'method': request.method,
+            'route': request.resolver_match.route,
+            'path': request.path_info,
+            'query': capture.get_shape(request.GET.dict()) or None,
+            'content_type': request.content_type,
+            'body': body,
+            'status': response.status_code,
+            'duration_ms': round(duration, 3),
+            'queries': counter.count,
+        })
+        return response
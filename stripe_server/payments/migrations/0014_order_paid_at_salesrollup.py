@@ -0,0 +1,39 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0013_stockshard_reservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='paid_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='paid at'),
+        ),
+        migrations.CreateModel(
+            name='SalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(verbose_name='day')),
+                ('currency', models.CharField(max_length=10, verbose_name='currency')),
+                ('units', models.PositiveBigIntegerField(default=0, verbose_name='units sold')),
+                ('gross', models.BigIntegerField(default=0, verbose_name='gross amount')),
+                ('discount', models.BigIntegerField(default=0, verbose_name='discount amount')),
+                ('tax', models.BigIntegerField(default=0, verbose_name='tax amount')),
+                ('net', models.BigIntegerField(default=0, verbose_name='net amount')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sales_rollups', to='payments.item', verbose_name='item')),
+            ],
+            options={
+                'verbose_name': 'Sales Rollup',
+                'verbose_name_plural': 'Sales Rollups',
+                'indexes': [models.Index(fields=['currency', 'day'], name='sales_rollup_currency_day_idx')],
+                'constraints': [models.UniqueConstraint(fields=('day', 'item', 'currency'), name='unique_sales_rollup')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:08
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0014_order_paid_at_salesrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemPopularity',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='popularity', serialize=False, to='payments.item', verbose_name='item')),
+                ('currency', models.CharField(max_length=10, verbose_name='currency')),
+                ('score', models.FloatField(default=0, verbose_name='decayed score')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'Item Popularity',
+                'verbose_name_plural': 'Item Popularity',
+                'indexes': [models.Index(fields=['currency', '-score'], name='item_popularity_rank_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='PopularityCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField(default=0, verbose_name='shard index')),
+                ('count', models.BigIntegerField(default=0, verbose_name='weighted events')),
+                ('item', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popularity_counters', to='payments.item', verbose_name='item')),
+            ],
+            options={
+                'verbose_name': 'Popularity Counter',
+                'verbose_name_plural': 'Popularity Counters',
+                'constraints': [models.UniqueConstraint(fields=('item', 'shard'), name='unique_popularity_counter')],
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0015_popularity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ItemRecommendation',
+            fields=[
+                ('item', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='recommendations', serialize=False, to='payments.item', verbose_name='item')),
+                ('neighbours', models.JSONField(default=list, verbose_name='neighbour ids with scores')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='updated at')),
+            ],
+            options={
+                'verbose_name': 'Item Recommendation',
+                'verbose_name_plural': 'Item Recommendations',
+            },
+        ),
+    ]
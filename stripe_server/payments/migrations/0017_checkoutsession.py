@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0016_itemrecommendation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckoutSession',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('stripe_id', models.CharField(max_length=255, unique=True, verbose_name='stripe checkout session id')),
+                ('currency', models.CharField(max_length=10, verbose_name='currency')),
+                ('status', models.CharField(max_length=20, verbose_name='session status')),
+                ('payment_status', models.CharField(max_length=20, verbose_name='payment status')),
+                ('amount_total', models.BigIntegerField(blank=True, null=True, verbose_name='amount total')),
+                ('created_at', models.DateTimeField(verbose_name='created in stripe at')),
+                ('synced_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='synced at')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='checkout_sessions', to='payments.order', verbose_name='order')),
+            ],
+            options={
+                'verbose_name': 'Checkout Session',
+                'verbose_name_plural': 'Checkout Sessions',
+            },
+        ),
+    ]
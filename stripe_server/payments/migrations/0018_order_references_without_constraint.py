@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0017_checkoutsession'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='checkoutsession',
+            name='order',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='checkout_sessions', to='payments.order', verbose_name='order'),
+        ),
+        migrations.AlterField(
+            model_name='reservation',
+            name='order',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reservations', to='payments.order', verbose_name='order'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.4 on 2026-10-19 12:50
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_recorded_at(apps, schema_editor):
+    # Оплаты, записанные до появления поля, считаются записанными в момент оплаты
+    Order = apps.get_model('payments', 'Order')
+    Order.objects.using(schema_editor.connection.alias).filter(paid_at__isnull=False).update(recorded_at=F('paid_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0018_order_references_without_constraint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='recorded_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='payment recorded at'),
+        ),
+        migrations.RunPython(backfill_recorded_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.4 on 2026-10-19 13:02
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # Строки одного товара в заказе, созданные параллельными запросами, сливаются в одну
+    OrderItem = apps.get_model('payments', 'OrderItem')
+    lines = OrderItem.objects.using(schema_editor.connection.alias)
+    duplicates = (
+        lines.values('order_id', 'item_id')
+        .annotate(count=Count('id'), first_id=Min('id'), total=Sum('quantity'))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        lines.filter(pk=duplicate['first_id']).update(quantity=duplicate['total'])
+        lines.filter(order_id=duplicate['order_id'], item_id=duplicate['item_id']).exclude(pk=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0019_order_recorded_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='orderitem',
+            constraint=models.UniqueConstraint(fields=('order', 'item'), name='unique_order_item'),
+        ),
+    ]
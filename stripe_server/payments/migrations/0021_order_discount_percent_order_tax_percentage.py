@@ -0,0 +1,42 @@
+# Generated by Django 5.2.4 on 2026-10-19 18:20
+
+from django.db import migrations, models
+
+
+def backfill_rates(apps, schema_editor):
+    # Для заказов, оплаченных до появления полей, условия оплаты не сохранились.
+    # Берутся проценты, по которым их до сих пор считали сводные продажи: активные и связанные со Stripe
+    alias = schema_editor.connection.alias
+    Order = apps.get_model('payments', 'Order')
+    Discount = apps.get_model('payments', 'Discount')
+    Tax = apps.get_model('payments', 'Tax')
+    paid = Order.objects.using(alias).filter(paid_at__isnull=False)
+    discounts = Discount.objects.using(alias).filter(active=True).exclude(stripe_coupon_id__isnull=True).exclude(stripe_coupon_id='')
+    for discount_id, percent_off in discounts.values_list('id', 'percent_off'):
+        paid.filter(discount_id=discount_id).update(discount_percent=percent_off)
+    taxes = Tax.objects.using(alias).filter(active=True).exclude(stripe_tax_rate_id__isnull=True).exclude(stripe_tax_rate_id='')
+    for tax_id, percentage in taxes.values_list('id', 'percentage'):
+        paid.filter(tax_id=tax_id).update(tax_percentage=percentage)
+    paid.filter(discount_percent__isnull=True).update(discount_percent=0)
+    paid.filter(tax_percentage__isnull=True).update(tax_percentage=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('payments', '0020_orderitem_unique_order_item'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='discount_percent',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='discount percent at payment'),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='tax_percentage',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='tax percentage at payment'),
+        ),
+        migrations.RunPython(backfill_rates, migrations.RunPython.noop),
+    ]
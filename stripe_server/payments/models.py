@@ -1,6 +1,7 @@
 from django.db import models
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db.models import F, Sum
+from django.utils import timezone
 
 class Item(models.Model):
     """
@@ -35,6 +36,7 @@ class Discount(models.Model):
     )
     currency = models.CharField(max_length=3, choices=[('usd', 'USD'), ('eur', 'EUR')], default='usd')
     stripe_coupon_id = models.CharField(max_length=255, blank=True, null=True, verbose_name='stripe coupon id')
+    active = models.BooleanField(default=True, verbose_name='is discount active')
 
     class Meta:
         verbose_name = 'Discount'
@@ -52,6 +54,7 @@ class Tax(models.Model):
     percentage = models.PositiveIntegerField(validators=[MinValueValidator(0), MaxValueValidator(100)],verbose_name='percentage of tax')
     currency = models.CharField(max_length=3, choices=[('usd', 'USD'), ('eur', 'EUR')], default='usd')
     stripe_tax_rate_id = models.CharField(max_length=255, blank=True, null=True, verbose_name='stripe tax rate id')
+    active = models.BooleanField(default=True, verbose_name='is tax active')
 
     class Meta:
         verbose_name = 'Tax'
@@ -69,6 +72,13 @@ class Order(models.Model):
     items = models.ManyToManyField(Item, through='OrderItem', verbose_name='items in order')
     discount = models.ForeignKey(Discount, on_delete=models.SET_NULL, blank=True, null=True, verbose_name='discount in order')
     tax = models.ForeignKey(Tax, on_delete=models.SET_NULL, blank=True, null=True, verbose_name='tax in order')
+    paid_at = models.DateTimeField(blank=True, null=True, db_index=True, verbose_name='paid at')
+    # Момент, когда оплата записана в БД. paid_at берется из Stripe и может быть задним числом
+    recorded_at = models.DateTimeField(blank=True, null=True, db_index=True, verbose_name='payment recorded at')
+    # Проценты скидки и налога, примененные при оплате. Скидку или налог потом могут изменить или
+    # отключить, а сводные продажи и их пересчет должны опираться на условия оплаты
+    discount_percent = models.PositiveIntegerField(blank=True, null=True, verbose_name='discount percent at payment')
+    tax_percentage = models.PositiveIntegerField(blank=True, null=True, verbose_name='tax percentage at payment')
 
     def get_total_price(self):
         base_total = self.orderitem_set.aggregate(
@@ -103,4 +113,224 @@ class OrderItem(models.Model):
     class Meta:
         verbose_name = 'Order Item'
         verbose_name_plural = 'Order Items'
+        constraints = [
+            models.UniqueConstraint(fields=['order', 'item'], name='unique_order_item'),
+        ]
 
+class JobBatch(models.Model):
+    """
+    Модель для группы фоновых задач, поставленных одним массовым действием в админке.
+    Используется для отображения прогресса выполнения.
+    """
+    name = models.CharField(max_length=255, verbose_name='name of batch')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='created at')
+
+    class Meta:
+        verbose_name = 'Job Batch'
+        verbose_name_plural = 'Job Batches'
+
+    def __str__(self):
+        return self.name
+
+class Job(models.Model):
+    """
+    Модель для фоновой задачи в очереди на базе БД.
+    Содержит имя обработчика, его аргументы, статус, количество попыток и время следующего запуска.
+    Задачи выполняются командой run_jobs.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    task = models.CharField(max_length=100, verbose_name='task name')
+    payload = models.JSONField(default=dict, blank=True, verbose_name='task arguments')
+    status = models.CharField(
+        max_length=10,
+        choices=[(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')],
+        default=PENDING,
+        verbose_name='status of job'
+    )
+    attempts = models.PositiveIntegerField(default=0, verbose_name='attempts')
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name='max attempts')
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='run at')
+    locked_at = models.DateTimeField(blank=True, null=True, verbose_name='locked at')
+    last_error = models.TextField(blank=True, verbose_name='last error')
+    batch = models.ForeignKey(JobBatch, on_delete=models.SET_NULL, blank=True, null=True, related_name='jobs', verbose_name='batch')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='created at')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='updated at')
+
+    class Meta:
+        verbose_name = 'Job'
+        verbose_name_plural = 'Jobs'
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_status_run_at_idx'),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id}: {self.task}"
+
+class StockShard(models.Model):
+    """
+    Модель для части складского остатка товара.
+    Остаток популярного товара разбивается на несколько строк, чтобы параллельные резервирования
+    не выстраивались в очередь за блокировкой одной строки. Общий остаток равен сумме частей.
+    Товар без частей не отслеживается и считается доступным в любом количестве.
+    """
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='stock_shards', verbose_name='item')
+    index = models.PositiveSmallIntegerField(default=0, verbose_name='shard index')
+    quantity = models.PositiveIntegerField(default=0, verbose_name='available quantity')
+
+    class Meta:
+        verbose_name = 'Stock Shard'
+        verbose_name_plural = 'Stock Shards'
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'index'], name='unique_stock_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.item}: shard {self.index}"
+
+class Reservation(models.Model):
+    """
+    Модель для временного резерва товара со склада.
+    Создается при добавлении в корзину или оформлении покупки и списывает количество с части остатка.
+    Активный резерв по истечении срока или при отмене возвращает количество на склад,
+    подтвержденный после оплаты остается списанным.
+    """
+    ACTIVE = 'active'
+    RELEASED = 'released'
+    COMMITTED = 'committed'
+
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='reservations', verbose_name='item')
+    shard = models.ForeignKey(StockShard, on_delete=models.CASCADE, related_name='reservations', verbose_name='stock shard')
+    # Без ограничения в БД: при ORDER_SHARDING заказ хранится в БД своей валюты
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, blank=True, null=True, db_constraint=False, related_name='reservations', verbose_name='order')
+    quantity = models.PositiveIntegerField(verbose_name='quantity')
+    status = models.CharField(
+        max_length=10,
+        choices=[(ACTIVE, 'Active'), (RELEASED, 'Released'), (COMMITTED, 'Committed')],
+        default=ACTIVE,
+        verbose_name='status of reservation'
+    )
+    expires_at = models.DateTimeField(verbose_name='expires at')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='created at')
+
+    class Meta:
+        verbose_name = 'Reservation'
+        verbose_name_plural = 'Reservations'
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='reservation_status_exp_idx'),
+        ]
+
+    def __str__(self):
+        return f"Reservation {self.id}: {self.item} x {self.quantity}"
+
+class SalesRollup(models.Model):
+    """
+    Модель для предрасчитанных продаж товара за день в одной валюте.
+    Обновляется инкрементально при оплате заказа и пересобирается командой rebuild_sales_rollups.
+    Суммы хранятся в центах: gross — до скидки, net — после скидки без налога, tax — налог сверх net.
+    """
+    day = models.DateField(verbose_name='day')
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='sales_rollups', verbose_name='item')
+    currency = models.CharField(max_length=10, verbose_name='currency')
+    units = models.PositiveBigIntegerField(default=0, verbose_name='units sold')
+    gross = models.BigIntegerField(default=0, verbose_name='gross amount')
+    discount = models.BigIntegerField(default=0, verbose_name='discount amount')
+    tax = models.BigIntegerField(default=0, verbose_name='tax amount')
+    net = models.BigIntegerField(default=0, verbose_name='net amount')
+
+    class Meta:
+        verbose_name = 'Sales Rollup'
+        verbose_name_plural = 'Sales Rollups'
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'item', 'currency'], name='unique_sales_rollup'),
+        ]
+        indexes = [
+            models.Index(fields=['currency', 'day'], name='sales_rollup_currency_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.item}: {self.units} ({self.currency})"
+
+class PopularityCounter(models.Model):
+    """
+    Модель для части счетчика событий популярности товара (добавления в корзину и покупки).
+    Каждая запись прибавляется к случайной части, поэтому популярный товар не становится точкой блокировок.
+    Части периодически сворачиваются в ItemPopularity командой rollup_popularity и обнуляются.
+    """
+    item = models.ForeignKey(Item, on_delete=models.CASCADE, related_name='popularity_counters', verbose_name='item')
+    shard = models.PositiveSmallIntegerField(default=0, verbose_name='shard index')
+    count = models.BigIntegerField(default=0, verbose_name='weighted events')
+
+    class Meta:
+        verbose_name = 'Popularity Counter'
+        verbose_name_plural = 'Popularity Counters'
+        constraints = [
+            models.UniqueConstraint(fields=['item', 'shard'], name='unique_popularity_counter'),
+        ]
+
+    def __str__(self):
+        return f"{self.item}: shard {self.shard}"
+
+class ItemPopularity(models.Model):
+    """
+    Модель для затухающего во времени рейтинга популярности товара.
+    При каждом сворачивании старый рейтинг уменьшается с периодом полураспада POPULARITY_HALF_LIFE
+    и к нему прибавляются накопленные события.
+    """
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, primary_key=True, related_name='popularity', verbose_name='item')
+    currency = models.CharField(max_length=10, verbose_name='currency')
+    score = models.FloatField(default=0, verbose_name='decayed score')
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name='updated at')
+
+    class Meta:
+        verbose_name = 'Item Popularity'
+        verbose_name_plural = 'Item Popularity'
+        indexes = [
+            models.Index(fields=['currency', '-score'], name='item_popularity_rank_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.item}: {self.score:.2f}"
+
+class ItemRecommendation(models.Model):
+    """
+    Модель для товаров, которые чаще всего покупают вместе с данным.
+    Хранит до RECOMMENDATIONS_TOP_K соседей с оценкой совместных покупок одной строкой,
+    чтобы страница товара читала их одним запросом по первичному ключу.
+    Заполняется командой build_recommendations.
+    """
+    item = models.OneToOneField(Item, on_delete=models.CASCADE, primary_key=True, related_name='recommendations', verbose_name='item')
+    neighbours = models.JSONField(default=list, verbose_name='neighbour ids with scores')
+    updated_at = models.DateTimeField(default=timezone.now, verbose_name='updated at')
+
+    class Meta:
+        verbose_name = 'Item Recommendation'
+        verbose_name_plural = 'Item Recommendations'
+
+    def __str__(self):
+        return f"{self.item}: {len(self.neighbours)} neighbours"
+
+class CheckoutSession(models.Model):
+    """
+    Модель для сессии Stripe Checkout с ее состоянием в Stripe.
+    Записывается после возврата покупателя на страницу успешной оплаты и сверяется командой reconcile_stripe.
+    """
+    stripe_id = models.CharField(max_length=255, unique=True, verbose_name='stripe checkout session id')
+    currency = models.CharField(max_length=10, verbose_name='currency')
+    status = models.CharField(max_length=20, verbose_name='session status')
+    payment_status = models.CharField(max_length=20, verbose_name='payment status')
+    amount_total = models.BigIntegerField(blank=True, null=True, verbose_name='amount total')
+    # Без ограничения в БД: при ORDER_SHARDING заказ хранится в БД своей валюты
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, blank=True, null=True, db_constraint=False, related_name='checkout_sessions', verbose_name='order')
+    created_at = models.DateTimeField(verbose_name='created in stripe at')
+    synced_at = models.DateTimeField(default=timezone.now, verbose_name='synced at')
+
+    class Meta:
+        verbose_name = 'Checkout Session'
+        verbose_name_plural = 'Checkout Sessions'
+
+    def __str__(self):
+        return f"{self.stripe_id}: {self.payment_status}"
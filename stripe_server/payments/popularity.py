@@ -0,0 +1,183 @@
+import atexit
+import os
+import random
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Item, ItemPopularity, OrderItem, PopularityCounter
+from . import shards
+
+TOP_CACHE_KEY = 'popularity:top:{currency}'
+
+
+def add_counts(counts):
+    """
+    Прибавляет взвешенные события к счетчикам: для каждого товара выбирается случайная часть.
+    Каждое прибавление — отдельный короткий UPDATE вне общей транзакции.
+    """
+    for item_id, weight in sorted(counts.items()):
+        shard = random.randrange(settings.POPULARITY_SHARDS)
+        counter = PopularityCounter.objects.filter(item_id=item_id, shard=shard)
+        if counter.update(count=F('count') + weight):
+            continue
+        try:
+            with transaction.atomic():
+                PopularityCounter.objects.create(item_id=item_id, shard=shard, count=weight)
+        except IntegrityError:
+            # Часть успел создать другой процесс, либо товар уже удален
+            counter.update(count=F('count') + weight)
+
+
+class EventBuffer:
+    """
+    Копит события популярности в памяти процесса и сбрасывает их в счетчики из фонового потока.
+    Запись события — сложение в словаре под блокировкой, поэтому путь корзины не ждет БД.
+    При аварийном завершении процесса события за последний интервал теряются, для рейтинга это допустимо.
+    Поток запускается лениво, поэтому корректно работает в воркерах gunicorn после fork.
+    """
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pending = {}
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name='popularity-flusher', daemon=True).start()
+            atexit.register(self.flush)
+
+    def add(self, item_id, weight):
+        if self.pid != os.getpid():
+            self.start()
+        with self.lock:
+            self.pending[item_id] = self.pending.get(item_id, 0) + weight
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def run(self):
+        while True:
+            time.sleep(settings.POPULARITY_FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        pending = self.take()
+        if not pending:
+            return
+        try:
+            add_counts(pending)
+        except DatabaseError:
+            pass
+        finally:
+            connection.close()
+
+
+buffer = EventBuffer()
+
+
+def record(item_id, kind, quantity=1):
+    """
+    Записывает событие популярности ('add' или 'purchase') с весом из POPULARITY_WEIGHTS.
+    """
+    buffer.add(item_id, settings.POPULARITY_WEIGHTS[kind] * quantity)
+
+
+def record_order(order_id):
+    """
+    Записывает покупку всех товаров оплаченного заказа.
+    """
+    lines = OrderItem.objects.using(shards.alias_for_order_id(order_id)).filter(order_id=order_id)
+    for item_id, quantity in lines.values_list('item_id', 'quantity'):
+        record(item_id, 'purchase', quantity)
+
+
+def rollup(now=None):
+    """
+    Сворачивает накопленные счетчики в рейтинг товаров и обновляет закешированные списки популярных.
+    Старый рейтинг уменьшается вдвое за каждые POPULARITY_HALF_LIFE секунд с прошлого сворачивания.
+    Части счетчиков блокируются на время чтения и обнуляются, поэтому параллельные прибавления не теряются.
+    Возвращает количество товаров с ненулевым рейтингом.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        counters = list(
+            PopularityCounter.objects.select_for_update().filter(count__gt=0).values_list('id', 'item_id', 'count')
+        )
+        deltas = {}
+        for _, item_id, count in counters:
+            deltas[item_id] = deltas.get(item_id, 0) + count
+        PopularityCounter.objects.filter(id__in=[counter[0] for counter in counters]).update(count=0)
+
+        scores = {popularity.item_id: popularity for popularity in ItemPopularity.objects.select_for_update()}
+        currencies = dict(Item.objects.filter(id__in=set(scores) | set(deltas)).values_list('id', 'currency'))
+        to_update = []
+        to_delete = []
+        for item_id, popularity in scores.items():
+            elapsed = (now - popularity.updated_at).total_seconds()
+            popularity.score = popularity.score * 0.5 ** (max(elapsed, 0) / settings.POPULARITY_HALF_LIFE)
+            popularity.score += deltas.pop(item_id, 0)
+            popularity.currency = currencies.get(item_id, popularity.currency)
+            popularity.updated_at = now
+            if popularity.score < 0.01:
+                to_delete.append(item_id)
+            else:
+                to_update.append(popularity)
+        ItemPopularity.objects.filter(item_id__in=to_delete).delete()
+        ItemPopularity.objects.bulk_update(to_update, ['score', 'currency', 'updated_at'])
+        ItemPopularity.objects.bulk_create([
+            ItemPopularity(item_id=item_id, currency=currencies[item_id], score=delta, updated_at=now)
+            for item_id, delta in deltas.items()
+            if item_id in currencies
+        ])
+    for currency in settings.STRIPE_KEYS:
+        cache.set(TOP_CACHE_KEY.format(currency=currency), compute_top(currency), settings.POPULARITY_TOP_TTL)
+    return ItemPopularity.objects.count()
+
+
+def compute_top(currency):
+    return list(
+        ItemPopularity.objects.filter(currency=currency)
+        .order_by('-score')
+        .values_list('item_id', flat=True)[:settings.POPULARITY_TOP_N]
+    )
+
+
+def get_top(currency):
+    """
+    Возвращает id самых популярных товаров в валюте из кеша, при промахе — из БД.
+    Список живет в кеше POPULARITY_TOP_TTL секунд, поэтому с кешем в памяти процесса
+    воркеры, которых не коснулся rollup, видят новый рейтинг не позже чем через TTL.
+    """
+    key = TOP_CACHE_KEY.format(currency=currency)
+    top = cache.get(key)
+    if top is None:
+        top = compute_top(currency)
+        cache.set(key, top, settings.POPULARITY_TOP_TTL)
+    return top
+
+
+def get_popular_items(items):
+    """
+    Выбирает из списка товаров каталога самые популярные по каждой валюте.
+    Возвращает список пар (валюта, товары). Если БД недоступна и кеш пуст, возвращает пустой список.
+    """
+    by_id = {item['id']: item for item in items}
+    popular = []
+    for currency in sorted({item['currency'] for item in items}):
+        try:
+            top = get_top(currency)
+        except DatabaseError:
+            continue
+        top_items = [by_id[item_id] for item_id in top if item_id in by_id]
+        if top_items:
+            popular.append((currency, top_items))
+    return popular
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import stripe
+from django.conf import settings
+from django.core.cache import cache
+
+PREPARED_KEY = 'checkout_prepared:{order_id}'
+PENDING_KEY = 'checkout_pending:{order_id}:{fingerprint}'
+# Сколько секунд создание сессии считается идущим, если процесс, который его начал, завершился
+PENDING_TIMEOUT = 60
+
+
+def get_checkout_data(order, order_items, currency):
+    """
+    Собирает параметры сессии Stripe Checkout для заказа без срока жизни expires_at:
+    он проставляется в момент создания сессии.
+    """
+    line_items = []
+    for order_item in order_items:
+        line_item = {
+            'price_data': {
+                'currency': currency,
+                'unit_amount': order_item.item.price,
+                'product_data': {
+                    'name': order_item.item.name,
+                    'description': order_item.item.description,
+                },
+            },
+            'quantity': order_item.quantity,
+        }
+
+        # Добавляем налог, если он есть
+        if order.tax and order.tax.active and order.tax.stripe_tax_rate_id:
+            line_item['tax_rates'] = [order.tax.stripe_tax_rate_id]
+
+        line_items.append(line_item)
+
+    checkout_data = {
+        'payment_method_types': ['card'],
+        'line_items': line_items,
+        'mode': 'payment',
+        'success_url': settings.SITE_URL + '/success/?session_id={CHECKOUT_SESSION_ID}',
+        'cancel_url': settings.SITE_URL + '/cancel/',
+        'metadata': {'order_id': order.id},
+    }
+
+    # Добавляем скидку, если она есть
+    if order.discount and order.discount.active and order.discount.stripe_coupon_id:
+        checkout_data['discounts'] = [{
+            'coupon': order.discount.stripe_coupon_id
+        }]
+    return checkout_data
+
+
+def get_fingerprint(currency, checkout_data):
+    """
+    Отпечаток содержимого корзины: совпадает, только если сессия была бы создана с теми же параметрами.
+    """
+    payload = json.dumps([currency, checkout_data], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def create_session(currency, checkout_data):
+    return stripe.checkout.Session.create(
+        api_key=settings.STRIPE_KEYS[currency]['secret'],
+        expires_at=int(time.time()) + settings.INVENTORY_CHECKOUT_TTL,
+        **checkout_data
+    )
+
+
+class Preparer:
+    """
+    Создает сессии Checkout заранее в фоновых потоках процесса, вне пути запроса.
+    Готовая сессия хранится в общем кеше, поэтому ее может забрать любой воркер.
+    Пул потоков создается лениво, поэтому корректно работает в воркерах gunicorn после fork.
+    """
+    def __init__(self):
+        self.executor = None
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(
+                    max_workers=settings.CHECKOUT_PRECREATE_WORKERS, thread_name_prefix='checkout-preparer'
+                )
+                self.pid = os.getpid()
+        self.executor.submit(fn, *args)
+
+    def prepare(self, order_id, currency, checkout_data, fingerprint):
+        pending_key = PENDING_KEY.format(order_id=order_id, fingerprint=fingerprint)
+        try:
+            checkout_session = create_session(currency, checkout_data)
+        except stripe.error.StripeError:
+            cache.delete(pending_key)
+            return
+        previous = remember(order_id, currency, fingerprint, checkout_session.id)
+        cache.delete(pending_key)
+        if previous and previous['fingerprint'] != fingerprint:
+            expire(previous)
+
+
+preparer = Preparer()
+
+
+def expire(prepared):
+    """
+    Закрывает в Stripe заранее созданную сессию, которая больше не нужна. Ошибки игнорируются:
+    незакрытая сессия просто истечет сама.
+    """
+    try:
+        stripe.checkout.Session.expire(prepared['id'], api_key=settings.STRIPE_KEYS[prepared['currency']]['secret'])
+    except stripe.error.StripeError:
+        pass
+
+
+def prepare(order, order_items, currency):
+    """
+    Запускает в фоне создание сессии Checkout для текущего содержимого корзины.
+    Ничего не делает, если сессия для такой корзины уже готова или создается.
+    """
+    if not settings.CHECKOUT_PRECREATE:
+        return
+    checkout_data = get_checkout_data(order, order_items, currency)
+    fingerprint = get_fingerprint(currency, checkout_data)
+    prepared = cache.get(PREPARED_KEY.format(order_id=order.id))
+    if prepared and prepared['fingerprint'] == fingerprint:
+        return
+    if cache.add(PENDING_KEY.format(order_id=order.id, fingerprint=fingerprint), 1, PENDING_TIMEOUT):
+        preparer.submit(preparer.prepare, order.id, currency, checkout_data, fingerprint)
+
+
+def remember(order_id, currency, fingerprint, session_id):
+    """
+    Сохраняет сессию Checkout как готовую для корзины с отпечатком fingerprint.
+    Возвращает сессию, которая была сохранена для заказа раньше, или None.
+    """
+    key = PREPARED_KEY.format(order_id=order_id)
+    previous = cache.get(key)
+    cache.set(key, {
+        'fingerprint': fingerprint,
+        'id': session_id,
+        'currency': currency,
+    }, settings.CHECKOUT_PRECREATE_MAX_AGE)
+    return previous
+
+
+def take(order_id, currency, checkout_data):
+    """
+    Возвращает готовую сессию Checkout, если корзина с момента ее создания не изменилась, иначе None.
+    Сессия остается в кеше, поэтому повторное нажатие «Оплатить» открывает ту же сессию.
+    Сессия для изменившейся корзины закрывается в Stripe в фоне, чтобы нельзя было оплатить старый состав.
+    """
+    key = PREPARED_KEY.format(order_id=order_id)
+    prepared = cache.get(key)
+    if prepared is None:
+        return None
+    if prepared['fingerprint'] != get_fingerprint(currency, checkout_data):
+        cache.delete(key)
+        preparer.submit(expire, prepared)
+        return None
+    return prepared['id']
+
+
+def create(order_id, currency, checkout_data):
+    """
+    Создает сессию Checkout синхронно, когда готовой сессии нет, и сохраняет ее как готовую.
+    """
+    checkout_session = create_session(currency, checkout_data)
+    if settings.CHECKOUT_PRECREATE:
+        remember(order_id, currency, get_fingerprint(currency, checkout_data), checkout_session.id)
+    return checkout_session.id
@@ -0,0 +1,149 @@
+import threading
+import time
+from django.conf import settings
+from django.core.cache import cache
+
+PERIODS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600}
+
+# Счетчик запросов, выполняющихся в текущем процессе
+in_flight = 0
+in_flight_lock = threading.Lock()
+
+
+def request_started():
+    """
+    Учитывает начало запроса и возвращает количество выполняющихся запросов процесса, включая текущий.
+    """
+    global in_flight
+    with in_flight_lock:
+        in_flight += 1
+        return in_flight
+
+
+def request_finished():
+    global in_flight
+    with in_flight_lock:
+        in_flight -= 1
+
+
+def parse_rate(rate):
+    """
+    Разбирает лимит вида '60/min' в количество токенов в секунду.
+    """
+    count, period = rate.split('/')
+    return int(count) / PERIODS[period]
+
+
+def get_client_ip(request):
+    if settings.RATE_LIMIT_TRUST_X_FORWARDED_FOR and request.META.get('HTTP_X_FORWARDED_FOR'):
+        return request.META['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def get_client_buckets(request):
+    """
+    Возвращает корзины токенов клиента в виде пар (идентификатор, множитель лимита).
+    Корзина IP есть всегда, ее лимит увеличен в RATE_LIMIT_IP_MULTIPLIER раз для клиентов за общим NAT.
+    Если есть cookie сессии, добавляется корзина по ее значению. Сессия не загружается, поэтому решение
+    принимается без запросов к БД, а клиент со случайными cookie упирается в корзину своего IP.
+    """
+    buckets = [(f'ip:{get_client_ip(request)}', settings.RATE_LIMIT_IP_MULTIPLIER)]
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if session_key:
+        buckets.append((f'session:{session_key}', 1))
+    return buckets
+
+
+def increment(key, delta, timeout):
+    """
+    Атомарно изменяет счетчик в кеше, создавая его при отсутствии. Возвращает новое значение.
+    """
+    cache.add(key, 0, timeout=timeout)
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        # Счетчик истек между add и incr
+        cache.add(key, 0, timeout=timeout)
+        return cache.incr(key, delta)
+
+
+def take_token(scope, ident, multiplier=1):
+    """
+    Забирает один токен из корзины клиента для маршрута scope.
+    Возвращает 0, если запрос разрешен, иначе количество секунд до появления следующего токена.
+    Корзина приближается скользящим окном длиной burst / rate секунд: запросы считаются атомарными
+    cache.incr в текущем окне, предыдущее окно учитывается с весом оставшейся в нем доли времени.
+    Так параллельные запросы не превышают burst, а средняя скорость не превышает rate.
+    При общем кеше (Redis, Memcached) лимит действует на все процессы.
+    """
+    config = settings.RATE_LIMITS[scope]
+    rate = parse_rate(config['rate']) * multiplier
+    burst = config['burst'] * multiplier
+    window = burst / rate
+    now = time.time()
+    index, elapsed = divmod(now, window)
+    key = f'rate_limit:bucket:{scope}:{ident}:{int(index)}'
+    timeout = int(window * 2) + 1
+
+    count = increment(key, 1, timeout)
+    previous = cache.get(f'rate_limit:bucket:{scope}:{ident}:{int(index) - 1}', 0)
+    weight = 1 - elapsed / window
+    if previous * weight + count <= burst:
+        return 0
+    # Отклоненный запрос токен не тратит
+    cache.decr(key)
+    if count > burst or not previous:
+        return window - elapsed
+    return max((previous * weight + count - burst) / previous * window, 0.001)
+
+
+def return_token(scope, ident, multiplier=1):
+    """
+    Возвращает токен, взятый take_token, если запрос отклонила другая корзина клиента.
+    """
+    config = settings.RATE_LIMITS[scope]
+    window = config['burst'] / parse_rate(config['rate'])
+    try:
+        cache.decr(f'rate_limit:bucket:{scope}:{ident}:{int(time.time() // window)}')
+    except ValueError:
+        pass
+
+
+def take_client_token(scope, request):
+    """
+    Забирает токен из всех корзин клиента. Запрос разрешен, только если токен есть в каждой.
+    Возвращает 0 или количество секунд до появления токена в исчерпанной корзине.
+    """
+    taken = []
+    for ident, multiplier in get_client_buckets(request):
+        wait = take_token(scope, ident, multiplier)
+        if wait:
+            for taken_ident, taken_multiplier in taken:
+                return_token(scope, taken_ident, taken_multiplier)
+            return wait
+        taken.append((ident, multiplier))
+    return 0
+
+
+def record_rejection(scope, reason):
+    """
+    Увеличивает счетчик отклоненных запросов для маршрута и причины (throttled или shed).
+    """
+    increment(f'rate_limit:rejected:{scope}:{reason}', 1, None)
+
+
+def get_rejection_stats():
+    """
+    Возвращает счетчики отклоненных запросов по всем настроенным маршрутам.
+    """
+    keys = {
+        f'rate_limit:rejected:{scope}:{reason}': (scope, reason)
+        for scope in settings.RATE_LIMITS
+        for reason in ('throttled', 'shed')
+    }
+    values = cache.get_many(keys)
+    stats = {scope: {'throttled': 0, 'shed': 0} for scope in settings.RATE_LIMITS}
+    for key, value in values.items():
+        scope, reason = keys[key]
+        stats[scope][reason] = value
+    return stats
@@ -0,0 +1,187 @@
+import itertools
+import os
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import Item, ItemRecommendation, OrderItem
+from . import shards
+
+
+def stream_pairs(pairs, chunk_size=100000):
+    """
+    Читает пары (order_id, item_id) потоком и складывает их в массивы NumPy кусками по chunk_size,
+    не создавая в памяти список кортежей на всю историю заказов.
+    """
+    pairs = iter(pairs)
+    orders = []
+    items = []
+    while True:
+        chunk = np.fromiter(itertools.chain.from_iterable(itertools.islice(pairs, chunk_size)), dtype=np.int64)
+        if not chunk.size:
+            break
+        orders.append(chunk[0::2])
+        items.append(chunk[1::2])
+    if not orders:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(orders), np.concatenate(items)
+
+
+def co_occurrence(order_ids, item_ids, size):
+    """
+    Строит матрицу совместных покупок size x size: на диагонали — количество заказов с товаром,
+    вне диагонали — количество заказов, где товары куплены вместе.
+    Считается одним умножением разреженной матрицы заказов на товары на саму себя.
+    """
+    if not order_ids.size:
+        return sparse.csr_matrix((size, size), dtype=np.int64)
+    _, rows = np.unique(order_ids, return_inverse=True)
+    baskets = sparse.csr_matrix(
+        (np.ones(rows.size, dtype=np.int64), (rows, item_ids)),
+        shape=(rows.max() + 1, size),
+    )
+    # Повторные строки одного товара в заказе считаются одной покупкой
+    baskets.data[:] = 1
+    return (baskets.T @ baskets).tocsr()
+
+
+def score_matrix(matrix, min_support):
+    """
+    Нормирует совместные покупки косинусной мерой: count(i, j) / sqrt(count(i) * count(j)).
+    Пары, купленные вместе реже min_support раз, отбрасываются.
+    """
+    counts = matrix.diagonal().astype(np.float64)
+    pairs = matrix.copy()
+    pairs.setdiag(0)
+    pairs.data[pairs.data < min_support] = 0
+    pairs.eliminate_zeros()
+    norm = np.zeros_like(counts)
+    norm[counts > 0] = 1 / np.sqrt(counts[counts > 0])
+    return (sparse.diags(norm) @ pairs @ sparse.diags(norm)).tocsr()
+
+
+def top_neighbours(scores, rows, top_k):
+    """
+    Выбирает для товаров rows до top_k соседей с наибольшей оценкой.
+    Строки сортируются одной общей сортировкой, без цикла по товарам на Python.
+    Возвращает словарь item_id -> [[neighbour_id, score], ...].
+    """
+    selected = scores[rows].tocoo()
+    order = np.lexsort((-selected.data, selected.row))
+    row, col, data = selected.row[order], selected.col[order], selected.data[order]
+    rank = np.arange(row.size) - np.searchsorted(row, row)
+    keep = rank < top_k
+    neighbours = {int(item_id): [] for item_id in rows}
+    for index, neighbour_id, score in zip(row[keep], col[keep], data[keep]):
+        neighbours[int(rows[index])].append([int(neighbour_id), round(float(score), 4)])
+    return neighbours
+
+
+def load_state(path=None):
+    """
+    Возвращает сохраненную матрицу совместных покупок и момент записи оплаты, до которого учтены заказы, или None.
+    """
+    path = path or settings.RECOMMENDATIONS_STATE_PATH
+    try:
+        with np.load(path) as state:
+            matrix = sparse.csr_matrix(
+                (state['data'], state['indices'], state['indptr']), shape=tuple(state['shape'])
+            )
+            until = datetime.fromtimestamp(float(state['until']), tz=dt_timezone.utc)
+    except FileNotFoundError:
+        return None
+    return matrix, until
+
+
+def save_state(matrix, until, path=None):
+    """
+    Атомарно сохраняет матрицу совместных покупок и момент записи оплаты, до которого учтены заказы.
+    """
+    path = path or settings.RECOMMENDATIONS_STATE_PATH
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(
+            f,
+            data=matrix.data,
+            indices=matrix.indices,
+            indptr=matrix.indptr,
+            shape=np.array(matrix.shape),
+            until=np.array(until.timestamp()),
+        )
+    os.replace(tmp_path, path)
+
+
+def store(neighbours, full):
+    """
+    Записывает соседей товаров одной пачкой. Товары без соседей удаляются из таблицы,
+    при полной пересборке удаляются и все товары, которых нет в результате.
+    """
+    now = timezone.now()
+    existing = set(Item.objects.filter(id__in=neighbours).values_list('id', flat=True))
+    rows = [
+        ItemRecommendation(item_id=item_id, neighbours=items, updated_at=now)
+        for item_id, items in neighbours.items()
+        if items and item_id in existing
+    ]
+    with transaction.atomic():
+        if full:
+            ItemRecommendation.objects.exclude(item_id__in=[row.item_id for row in rows]).delete()
+        else:
+            ItemRecommendation.objects.filter(item_id__in=[item_id for item_id, items in neighbours.items() if not items]).delete()
+        ItemRecommendation.objects.bulk_create(
+            rows,
+            batch_size=1000,
+            update_conflicts=True,
+            unique_fields=['item'],
+            update_fields=['neighbours', 'updated_at'],
+        )
+    return len(rows)
+
+
+def refresh(full=False, top_k=None, min_support=None, chunk_size=100000):
+    """
+    Обновляет рекомендации «покупают вместе» по оплаченным заказам.
+    Без full к сохраненной матрице прибавляются только заказы, оплата которых записана после прошлого запуска
+    (по recorded_at: paid_at у заказов, найденных сверкой со Stripe, бывает задним числом),
+    и пересчитываются только товары из этих заказов и их соседи, у которых изменилась нормировка.
+    Параметры top_k и min_support применяются к пересчитываемым товарам, после их изменения нужен full.
+    Возвращает количество товаров с рекомендациями, записанных в этот раз.
+    """
+    top_k = top_k or settings.RECOMMENDATIONS_TOP_K
+    min_support = min_support or settings.RECOMMENDATIONS_MIN_SUPPORT
+    until = timezone.now() - timedelta(seconds=settings.RECOMMENDATIONS_SETTLE_SECONDS)
+    state = None if full else load_state()
+    full = state is None
+
+    lines = OrderItem.objects.filter(order__paid_at__isnull=False, order__recorded_at__lte=until)
+    if state is not None:
+        lines = lines.filter(order__recorded_at__gt=state[1])
+    # Id заказов уникальны во всех БД заказов, поэтому пары из них можно просто объединить
+    order_ids, item_ids = stream_pairs(
+        itertools.chain.from_iterable(
+            lines.using(alias).values_list('order_id', 'item_id').iterator(chunk_size=chunk_size)
+            for alias in shards.get_aliases()
+        ),
+        chunk_size,
+    )
+
+    size = int(item_ids.max()) + 1 if item_ids.size else 0
+    if state is not None:
+        size = max(size, state[0].shape[0])
+    matrix = co_occurrence(order_ids, item_ids, size)
+    if state is not None:
+        previous = state[0].copy()
+        previous.resize((size, size))
+        matrix = matrix + previous
+
+    if full:
+        rows = np.flatnonzero(matrix.diagonal())
+    else:
+        touched = np.unique(item_ids)
+        rows = np.union1d(touched, matrix[:, touched].nonzero()[0])
+    written = store(top_neighbours(score_matrix(matrix, min_support), rows, top_k), full)
+    save_state(matrix, until)
+    return written
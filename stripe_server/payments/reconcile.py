@@ -0,0 +1,353 @@
+import itertools
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import CheckoutSession, Discount, Job, Order, OrderItem, Tax
+from . import inventory, jobs, popularity, rollups, shards
+
+KINDS = ['coupons', 'tax_rates', 'checkout_sessions']
+
+
+def from_timestamp(value):
+    return datetime.fromtimestamp(value, tz=dt_timezone.utc)
+
+
+def record_checkout_session(checkout_session, currency, order_id=None):
+    """
+    Сохраняет текущее состояние сессии Stripe Checkout.
+    """
+    CheckoutSession.objects.update_or_create(
+        stripe_id=checkout_session.id,
+        defaults={
+            'currency': currency,
+            'status': checkout_session.status or '',
+            'payment_status': checkout_session.payment_status or '',
+            'amount_total': checkout_session.amount_total,
+            'order_id': order_id,
+            'created_at': from_timestamp(checkout_session.created),
+            'synced_at': timezone.now(),
+        },
+    )
+
+
+def mark_order_paid(order_id, paid_at):
+    """
+    Отмечает заказ оплаченным, учитывает его в сводных продажах и популярности и подтверждает резервы.
+    Если резервы успели истечь до оплаты, товар списывается со склада заново.
+    Возвращает False, если заказ уже был отмечен оплаченным.
+    """
+    if not rollups.record_paid_order(order_id, paid_at):
+        return False
+    lines = OrderItem.objects.using(shards.alias_for_order_id(order_id)).filter(order_id=order_id)
+    inventory.commit_order(order_id, list(lines.values_list('item_id', 'quantity')))
+    popularity.record_order(order_id)
+    return True
+
+
+def fetch(kind, currency, since):
+    """
+    Возвращает итератор по всем объектам аккаунта Stripe валюты с автоматической пагинацией.
+    """
+    api_key = settings.STRIPE_KEYS[currency]['secret']
+    if kind == 'coupons':
+        listing = stripe.Coupon.list(limit=100, api_key=api_key)
+    elif kind == 'tax_rates':
+        listing = stripe.TaxRate.list(limit=100, api_key=api_key)
+    else:
+        listing = stripe.checkout.Session.list(limit=100, created={'gte': int(since.timestamp())}, api_key=api_key)
+    return listing.auto_paging_iter()
+
+
+def retrieve(kind, currency, object_id):
+    """
+    Загружает купон или налоговую ставку аккаунта Stripe валюты по id. Возвращает None, если объекта нет.
+    """
+    resource = stripe.Coupon if kind == 'coupons' else stripe.TaxRate
+    try:
+        return resource.retrieve(object_id, api_key=settings.STRIPE_KEYS[currency]['secret'])
+    except stripe.error.InvalidRequestError as e:
+        if jobs.is_missing(e):
+            return None
+        raise
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+class Reconciler:
+    """
+    Сверяет купоны, налоговые ставки и сессии Checkout в Stripe с локальными данными.
+    Объекты всех аккаунтов загружаются параллельно и передаются на сверку кусками через ограниченную очередь,
+    поэтому в памяти одновременно находится не больше нескольких кусков. Для поиска локальных строк,
+    которых нет в Stripe, запоминаются только id увиденных объектов. Объект мог быть создан задачей run_jobs
+    уже после того, как список загрузился, поэтому перед сбросом каждый ненайденный id проверяется в Stripe.
+    Исправления применяются пачками на кусок: устаревшие id сбрасываются, а создание и деактивация
+    объектов в Stripe ставятся в очередь задач run_jobs. При dry_run ничего не меняется.
+    """
+    def __init__(self, since, chunk_size=500, concurrency=4, dry_run=False):
+        self.since = since
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.dry_run = dry_run
+        self.stats = {}
+        self.seen = {}
+        self.errors = []
+        self.resynced = {'discounts': set(), 'taxes': set()}
+        self.chunks = queue.Queue(maxsize=concurrency * 2)
+        self.stop = threading.Event()
+
+    def counter(self, currency, kind):
+        return self.stats.setdefault((currency, kind), Counter())
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def drain(self):
+        while True:
+            try:
+                self.chunks.get_nowait()
+            except queue.Empty:
+                return
+
+    def produce(self, currency, kind):
+        try:
+            for chunk in chunked(fetch(kind, currency, self.since), self.chunk_size):
+                if self.stop.is_set():
+                    return
+                self.put((currency, kind, chunk))
+        except stripe.error.StripeError as e:
+            self.put((currency, kind, e))
+        finally:
+            self.put((currency, kind, None))
+
+    def run(self):
+        currencies = [currency for currency, keys in settings.STRIPE_KEYS.items() if keys['secret']]
+        tasks = [(currency, kind) for currency in currencies for kind in KINDS]
+        failed = set()
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for currency, kind in tasks:
+                    self.seen[(currency, kind)] = set()
+                    self.counter(currency, kind)
+                    executor.submit(self.produce, currency, kind)
+                remaining = len(tasks)
+                try:
+                    while remaining:
+                        currency, kind, chunk = self.chunks.get()
+                        if chunk is None:
+                            remaining -= 1
+                        elif isinstance(chunk, Exception):
+                            failed.add((currency, kind))
+                            self.errors.append(f'{currency} {kind}: {chunk}')
+                        else:
+                            self.seen[(currency, kind)].update(obj.id for obj in chunk)
+                            self.counter(currency, kind)['fetched'] += len(chunk)
+                            getattr(self, f'reconcile_{kind}')(currency, chunk)
+                except BaseException:
+                    # Останавливаем загрузчиков до выхода из пула: иначе они ждут места в полной очереди,
+                    # а пул ждет их, и команда зависает вместо того, чтобы упасть с ошибкой
+                    self.stop.set()
+                    self.drain()
+                    raise
+        finally:
+            self.stop.set()
+        # Локальные строки, которых нет в Stripe, ищутся только по полностью загруженным спискам
+        for currency in currencies:
+            if (currency, 'coupons') not in failed:
+                self.sweep_discounts(currency)
+            if (currency, 'tax_rates') not in failed:
+                self.sweep_taxes(currency)
+        return self.stats
+
+    def enqueue(self, task_name, payloads):
+        """
+        Ставит задачи в очередь, пропуская те, что уже ждут выполнения после прошлой сверки.
+        """
+        if not payloads or self.dry_run:
+            return
+        queued = Job.objects.filter(task=task_name, status__in=[Job.PENDING, Job.RUNNING]).values_list('payload', flat=True)
+        queued = {tuple(sorted(payload.items())) for payload in queued}
+        payloads = [payload for payload in payloads if tuple(sorted(payload.items())) not in queued]
+        if payloads:
+            jobs.enqueue_many(task_name, payloads)
+
+    def find_missing(self, currency, kind, rows):
+        """
+        Отбирает строки (id, stripe_id, active), объектов которых нет в Stripe: сначала по загруженному
+        списку, а не найденные в нем — запросом объекта, потому что его могли создать после загрузки списка.
+        """
+        seen = self.seen[(currency, kind)]
+        return [row for row in rows if row[1] not in seen and retrieve(kind, currency, row[1]) is None]
+
+    def resync_discounts(self, currency, rows, stats, reason):
+        """
+        Сбрасывает купоны скидок (id, coupon_id, active) и ставит создание новых купонов для активных скидок.
+        """
+        if not rows:
+            return
+        stats[reason] += len(rows)
+        self.resynced['discounts'].update(row[0] for row in rows)
+        if self.dry_run:
+            return
+        with transaction.atomic():
+            # Сбрасываются только id, прочитанные при сверке: новый купон, записанный тем временем, остается
+            Discount.objects.filter(
+                id__in=[row[0] for row in rows], stripe_coupon_id__in=[row[1] for row in rows]
+            ).update(stripe_coupon_id=None)
+            self.enqueue('sync_discount', [{'discount_id': row[0]} for row in rows if row[2]])
+        stats['fixed'] += len(rows)
+
+    def reconcile_coupons(self, currency, coupons):
+        stats = self.counter(currency, 'coupons')
+        by_id = {coupon.id: coupon for coupon in coupons}
+        drifted = []
+        matched = 0
+        for row in Discount.objects.filter(currency=currency, stripe_coupon_id__in=by_id).values_list(
+            'id', 'stripe_coupon_id', 'active', 'percent_off', 'duration'
+        ):
+            matched += 1
+            coupon = by_id[row[1]]
+            if not coupon.valid or coupon.percent_off != row[3] or coupon.duration != row[4]:
+                drifted.append(row)
+        stats['matched'] += matched
+        stats['orphaned'] += len(by_id) - matched
+        # Купон в Stripe изменить нельзя: старый удаляется, для скидки создается новый
+        self.enqueue('delete_stripe_coupon', [{'currency': currency, 'coupon_id': row[1]} for row in drifted])
+        self.resync_discounts(currency, drifted, stats, 'drifted')
+
+    def sweep_discounts(self, currency):
+        stats = self.counter(currency, 'coupons')
+        rows = Discount.objects.filter(currency=currency).exclude(stripe_coupon_id=None).values_list(
+            'id', 'stripe_coupon_id', 'active'
+        )
+        for chunk in chunked(rows.iterator(chunk_size=self.chunk_size), self.chunk_size):
+            self.resync_discounts(currency, self.find_missing(currency, 'coupons', chunk), stats, 'missing')
+        unsynced = [
+            discount_id
+            for discount_id in Discount.objects.filter(currency=currency, active=True, stripe_coupon_id=None).values_list('id', flat=True)
+            if discount_id not in self.resynced['discounts']
+        ]
+        stats['unsynced'] += len(unsynced)
+        self.enqueue('sync_discount', [{'discount_id': discount_id} for discount_id in unsynced])
+
+    def resync_taxes(self, currency, rows, stats, reason):
+        """
+        Сбрасывает налоговые ставки налогов (id, tax_rate_id, active) и ставит создание новых ставок для активных налогов.
+        """
+        if not rows:
+            return
+        stats[reason] += len(rows)
+        self.resynced['taxes'].update(row[0] for row in rows)
+        if self.dry_run:
+            return
+        with transaction.atomic():
+            Tax.objects.filter(
+                id__in=[row[0] for row in rows], stripe_tax_rate_id__in=[row[1] for row in rows]
+            ).update(stripe_tax_rate_id=None)
+            self.enqueue('sync_tax', [{'tax_id': row[0]} for row in rows if row[2]])
+        stats['fixed'] += len(rows)
+
+    def reconcile_tax_rates(self, currency, tax_rates):
+        stats = self.counter(currency, 'tax_rates')
+        by_id = {tax_rate.id: tax_rate for tax_rate in tax_rates}
+        drifted = []
+        reactivate = []
+        deactivate = []
+        matched = 0
+        for row in Tax.objects.filter(currency=currency, stripe_tax_rate_id__in=by_id).values_list(
+            'id', 'stripe_tax_rate_id', 'active', 'percentage'
+        ):
+            matched += 1
+            tax_rate = by_id[row[1]]
+            if tax_rate.percentage != row[3]:
+                drifted.append(row)
+            elif row[2] and not tax_rate.active:
+                reactivate.append({'tax_id': row[0]})
+            elif not row[2] and tax_rate.active:
+                deactivate.append({'currency': currency, 'tax_rate_id': row[1]})
+        stats['matched'] += matched
+        stats['orphaned'] += len(by_id) - matched
+        stats['activity'] += len(reactivate) + len(deactivate)
+        # Процент ставки в Stripe изменить нельзя: старая ставка деактивируется, для налога создается новая
+        self.enqueue('deactivate_stripe_tax_rate', deactivate + [
+            {'currency': currency, 'tax_rate_id': row[1]} for row in drifted if by_id[row[1]].active
+        ])
+        self.enqueue('sync_tax', reactivate)
+        if not self.dry_run:
+            stats['fixed'] += len(reactivate) + len(deactivate)
+        self.resync_taxes(currency, drifted, stats, 'drifted')
+
+    def sweep_taxes(self, currency):
+        stats = self.counter(currency, 'tax_rates')
+        rows = Tax.objects.filter(currency=currency).exclude(stripe_tax_rate_id=None).values_list(
+            'id', 'stripe_tax_rate_id', 'active'
+        )
+        for chunk in chunked(rows.iterator(chunk_size=self.chunk_size), self.chunk_size):
+            self.resync_taxes(currency, self.find_missing(currency, 'tax_rates', chunk), stats, 'missing')
+        unsynced = [
+            tax_id
+            for tax_id in Tax.objects.filter(currency=currency, active=True, stripe_tax_rate_id=None).values_list('id', flat=True)
+            if tax_id not in self.resynced['taxes']
+        ]
+        stats['unsynced'] += len(unsynced)
+        self.enqueue('sync_tax', [{'tax_id': tax_id} for tax_id in unsynced])
+
+    def reconcile_checkout_sessions(self, currency, sessions):
+        """
+        Сохраняет сессии Checkout и отмечает оплаченными заказы, оплата которых прошла в Stripe,
+        но не была подтверждена на странице успешной оплаты (например, покупатель закрыл вкладку).
+        """
+        stats = self.counter(currency, 'checkout_sessions')
+        order_ids = {
+            int(checkout_session.metadata['order_id'])
+            for checkout_session in sessions
+            if checkout_session.metadata and checkout_session.metadata.get('order_id')
+        }
+        orders = {}
+        for alias, ids in shards.group_by_alias(order_ids).items():
+            orders.update(Order.objects.using(alias).filter(id__in=ids).values_list('id', 'paid_at'))
+        now = timezone.now()
+        rows = []
+        unpaid = []
+        for checkout_session in sessions:
+            order_id = checkout_session.metadata.get('order_id') if checkout_session.metadata else None
+            order_id = int(order_id) if order_id and int(order_id) in orders else None
+            created_at = from_timestamp(checkout_session.created)
+            rows.append(CheckoutSession(
+                stripe_id=checkout_session.id,
+                currency=currency,
+                status=checkout_session.status or '',
+                payment_status=checkout_session.payment_status or '',
+                amount_total=checkout_session.amount_total,
+                order_id=order_id,
+                created_at=created_at,
+                synced_at=now,
+            ))
+            stats['completed'] += checkout_session.status == 'complete'
+            if checkout_session.payment_status == 'paid' and order_id and orders[order_id] is None:
+                unpaid.append((order_id, created_at))
+        stats['unconfirmed'] += len(unpaid)
+        if self.dry_run:
+            return
+        CheckoutSession.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=['stripe_id'],
+            update_fields=['status', 'payment_status', 'amount_total', 'order', 'synced_at'],
+        )
+        for order_id, paid_at in unpaid:
+            stats['fixed'] += mark_order_paid(order_id, paid_at)
@@ -0,0 +1,149 @@
+from itertools import chain
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from .models import Discount, Order, OrderItem, SalesRollup, Tax
+from . import shards
+
+AMOUNT_FIELDS = ['units', 'gross', 'discount', 'tax', 'net']
+
+# Поля строки заказа, достаточные для расчета ее вклада в продажи без загрузки моделей.
+# Проценты скидки и налога сохранены в заказе при оплате, поэтому пересчет не зависит
+# от того, что со скидкой или налогом стало потом
+LINE_FIELDS = ['order__paid_at', 'item_id', 'item__currency', 'item__price', 'quantity', 'order__discount_percent', 'order__tax_percentage']
+
+
+def line_amounts(price, quantity, percent_off, tax_percentage):
+    """
+    Раскладывает строку заказа на суммы в центах: (units, gross, discount, tax, net).
+    Скидка применяется к строке, налог начисляется на сумму после скидки, как в get_total_price.
+    """
+    gross = price * quantity
+    discount = round(gross * percent_off / 100)
+    net = gross - discount
+    tax = round(net * tax_percentage / 100)
+    return quantity, gross, discount, tax, net
+
+
+def get_rates(discount_ids=None, tax_ids=None):
+    """
+    Проценты скидок и налогов, которые учитываются так же, как при создании сессии Checkout:
+    только активные и связанные со Stripe. Возвращает словари id -> процент для скидок и налогов.
+    discount_ids и tax_ids ограничивают выборку, None — все.
+    """
+    # С primary: реплика могла еще не получить новую скидку или налог
+    discounts = Discount.objects.using('default').filter(active=True).exclude(stripe_coupon_id__isnull=True).exclude(stripe_coupon_id='')
+    taxes = Tax.objects.using('default').filter(active=True).exclude(stripe_tax_rate_id__isnull=True).exclude(stripe_tax_rate_id='')
+    if discount_ids is not None:
+        discounts = discounts.filter(id__in=discount_ids)
+    if tax_ids is not None:
+        taxes = taxes.filter(id__in=tax_ids)
+    return (
+        dict(discounts.values_list('id', 'percent_off')),
+        dict(taxes.values_list('id', 'percentage')),
+    )
+
+
+def collect(lines):
+    """
+    Складывает строки заказов (значения LINE_FIELDS) в суммы по ключу (день, товар, валюта).
+    """
+    totals = {}
+    for paid_at, item_id, currency, price, quantity, percent_off, tax_percentage in lines:
+        amounts = line_amounts(price, quantity, percent_off or 0, tax_percentage or 0)
+        key = (timezone.localdate(paid_at), item_id, currency)
+        current = totals.get(key)
+        totals[key] = amounts if current is None else tuple(a + b for a, b in zip(current, amounts))
+    return totals
+
+
+def add_to_rollups(totals):
+    """
+    Прибавляет суммы к строкам сводной таблицы одним UPDATE на ключ, создавая недостающие строки.
+    Ключи обрабатываются в фиксированном порядке, чтобы параллельные оплаты не взаимоблокировались.
+    """
+    with transaction.atomic():
+        for (day, item_id, currency), amounts in sorted(totals.items()):
+            rollup = SalesRollup.objects.filter(day=day, item_id=item_id, currency=currency)
+            increments = {field: F(field) + value for field, value in zip(AMOUNT_FIELDS, amounts)}
+            if rollup.update(**increments):
+                continue
+            try:
+                with transaction.atomic():
+                    SalesRollup.objects.create(
+                        day=day, item_id=item_id, currency=currency, **dict(zip(AMOUNT_FIELDS, amounts))
+                    )
+            except IntegrityError:
+                # Строку успела создать параллельная оплата
+                rollup.update(**increments)
+
+
+def record_paid_order(order_id, paid_at=None):
+    """
+    Отмечает заказ оплаченным, сохраняет в нем действующие проценты скидки и налога
+    и добавляет его строки в сводные продажи.
+    Повторный вызов для уже оплаченного заказа ничего не делает и возвращает False.
+    """
+    paid_at = paid_at or timezone.now()
+    alias = shards.alias_for_order_id(order_id)
+    order = Order.objects.using(alias).filter(pk=order_id)
+    # Транзакция БД заказов вложена в транзакцию primary и фиксируется раньше нее.
+    # Пока сводные продажи не зафиксированы, их строки заблокированы, и rebuild ждет,
+    # а затем видит заказ оплаченным и учитывает его вместе с прибавленными суммами
+    with transaction.atomic(), transaction.atomic(using=alias):
+        discount_id, tax_id = order.values_list('discount_id', 'tax_id').get()
+        discounts, taxes = get_rates([discount_id], [tax_id])
+        updated = order.filter(paid_at__isnull=True).update(
+            paid_at=paid_at,
+            recorded_at=timezone.now(),
+            discount_percent=discounts.get(discount_id, 0),
+            tax_percentage=taxes.get(tax_id, 0),
+        )
+        if not updated:
+            return False
+        lines = OrderItem.objects.using(alias).filter(order_id=order_id).values_list(*LINE_FIELDS)
+        add_to_rollups(collect(lines))
+    return True
+
+
+def lock_rollups():
+    """
+    Блокирует сводную таблицу на запись до конца текущей транзакции primary.
+    Чтение отчетов продолжается, а record_paid_order ждет на UPDATE или INSERT.
+    """
+    connection = connections['default']
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {SalesRollup._meta.db_table} IN SHARE ROW EXCLUSIVE MODE')
+    # SQLite допускает одного писателя на всю БД: его захватывает первый DELETE в rebuild
+
+
+def rebuild(since=None, batch_size=1000):
+    """
+    Пересчитывает сводные продажи по оплаченным заказам, начиная с дня since (или целиком).
+    Строки заказов читаются потоком из всех БД заказов, в памяти держатся только суммы по ключам.
+    Сводная таблица заблокирована на запись на весь пересчет, поэтому оплаты, записанные в это
+    время, ждут его окончания и не теряются. Возвращает количество записанных строк сводной таблицы.
+    """
+    lines = OrderItem.objects.filter(order__paid_at__isnull=False)
+    rollups = SalesRollup.objects.all()
+    if since is not None:
+        lines = lines.filter(order__paid_at__date__gte=since)
+        rollups = rollups.filter(day__gte=since)
+    with transaction.atomic():
+        lock_rollups()
+        rollups.delete()
+        totals = collect(
+            chain.from_iterable(
+                lines.using(alias).values_list(*LINE_FIELDS).iterator(chunk_size=batch_size)
+                for alias in shards.get_aliases()
+            )
+        )
+        SalesRollup.objects.bulk_create(
+            [
+                SalesRollup(day=day, item_id=item_id, currency=currency, **dict(zip(AMOUNT_FIELDS, amounts)))
+                for (day, item_id, currency), amounts in sorted(totals.items())
+            ],
+            batch_size=batch_size,
+        )
+    return len(totals)
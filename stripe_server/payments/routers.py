@@ -0,0 +1,104 @@
+import random
+from asgiref.local import Local
+from django.conf import settings
+
+# Состояние текущего запроса: должен ли он читать с primary и были ли в нем записи.
+# Заполняется PrimaryDatabasePinningMiddleware.
+state = Local()
+
+# Модели каталога, которые можно читать с реплик
+CATALOG_MODELS = {'item', 'discount', 'tax'}
+
+
+def pin_to_primary(value=True):
+    state.pinned = value
+
+
+def is_pinned_to_primary():
+    return getattr(state, 'pinned', False)
+
+
+def reset_state():
+    state.pinned = False
+    state.wrote = False
+
+
+def has_written():
+    return getattr(state, 'wrote', False)
+
+
+def get_replica_aliases():
+    return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+
+class ReplicaRouter:
+    """
+    Направляет чтения каталога (товары, скидки, налоги) на реплики, а все остальное на primary.
+    Корзина и оформление заказа всегда работают с primary.
+    Если запрос закреплен за primary (после записи в сессии или для путей корзины), читает тоже с primary.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'payments' or model._meta.model_name not in CATALOG_MODELS:
+            return 'default'
+        if is_pinned_to_primary():
+            return 'default'
+        replicas = get_replica_aliases()
+        return random.choice(replicas) if replicas else 'default'
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Реплики содержат те же данные, что и primary
+        return True
+
+
+# Модели, которые при ORDER_SHARDING хранятся в БД валюты заказа
+SHARDED_MODELS = {'order', 'orderitem'}
+
+
+def get_shard_aliases():
+    return [shard['alias'] for shard in settings.ORDER_SHARDS.values()]
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'payments' and model._meta.model_name in SHARDED_MODELS
+
+
+class OrderShardRouter:
+    """
+    Направляет заказы и их строки в БД валюты заказа (см. payments.shards), все остальное — на primary.
+    БД берется из объекта, с которым связан запрос: заказ из orders_usd читает свои строки там же,
+    а товары, резервы и сессии Checkout этого заказа — с primary. Без такой подсказки возвращает None,
+    и запрос идет туда, куда его направит следующий роутер, или в default.
+    """
+    def get_database(self, model, instance):
+        if instance is None:
+            return None
+        if is_sharded(model):
+            if is_sharded(type(instance)):
+                return instance._state.db
+            # Резерв или сессия Checkout ссылаются на заказ по id, по нему и определяется БД
+            order_id = getattr(instance, 'order_id', None)
+            if order_id is not None:
+                from .shards import alias_for_order_id
+                return alias_for_order_id(order_id)
+            return None
+        if instance._state.db in get_shard_aliases():
+            return 'default'
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self.get_database(model, hints.get('instance'))
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return self.get_database(model, hints.get('instance'))
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Заказы ссылаются на товары, скидки и налоги primary, а резервы и сессии Checkout — на заказы в БД валют
+        shard_aliases = get_shard_aliases()
+        if obj1._state.db in shard_aliases or obj2._state.db in shard_aliases:
+            return True
+        return None
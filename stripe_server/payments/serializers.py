@@ -32,3 +32,11 @@ class OrderSerializer(serializers.ModelSerializer):
     
     def get_total_full_price(self, obj):
         return "{0:.2f}".format(obj.get_total_price() / 100)
+
+class CartOperationSerializer(serializers.Serializer):
+    item_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0, default=1)
+    op = serializers.ChoiceField(choices=['set', 'increment', 'remove'], default='increment')
+
+class CartBatchSerializer(serializers.Serializer):
+    operations = CartOperationSerializer(many=True, allow_empty=False, max_length=100)
@@ -0,0 +1,196 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from .models import CheckoutSession, Discount, Item, Order, OrderItem, Reservation, Tax
+from .routers import get_shard_aliases
+
+# Таблицы, на которые ссылаются заказы. В каждой БД валюты хранится их копия:
+# она нужна для внешних ключей и для соединений в запросах к строкам заказов
+REFERENCE_MODELS = [Item, Discount, Tax]
+# Таблицы, id в которых выдаются из диапазона БД валюты
+SHARDED_MODELS = [Order, OrderItem]
+
+# БД валют, для которых в этом процессе уже проверены диапазоны id
+_ranged = set()
+_ranged_lock = threading.Lock()
+
+
+def get_aliases():
+    """
+    Все БД с заказами: default (заказы, созданные до включения шардирования) и БД валют.
+    """
+    return ['default'] + get_shard_aliases()
+
+
+def alias_for_currency(currency):
+    """
+    БД, в которой хранится заказ в валюте currency. Без шардирования — default.
+    """
+    shard = settings.ORDER_SHARDS.get(currency)
+    return shard['alias'] if shard else 'default'
+
+
+def alias_for_order_id(order_id):
+    """
+    БД заказа (или строки заказа) по его id: БД валюты с наибольшим ID_OFFSET, не превышающим id, или default.
+    """
+    alias = 'default'
+    offset = 0
+    for shard in settings.ORDER_SHARDS.values():
+        if offset <= shard['id_offset'] <= order_id:
+            alias = shard['alias']
+            offset = shard['id_offset']
+    return alias
+
+
+def group_by_alias(order_ids):
+    """
+    Раскладывает id заказов по БД, в которых они хранятся.
+    """
+    groups = {}
+    for order_id in order_ids:
+        groups.setdefault(alias_for_order_id(order_id), []).append(order_id)
+    return groups
+
+
+def get_id_offset(alias):
+    for shard in settings.ORDER_SHARDS.values():
+        if shard['alias'] == alias:
+            return shard['id_offset']
+    raise ImproperlyConfigured(f'{alias} не является БД заказов')
+
+
+def ensure_id_range(alias):
+    """
+    Сдвигает последовательности id заказов и строк заказов в БД валюты к началу ее диапазона.
+    Значение только увеличивается, поэтому повторный и параллельный вызов безопасны.
+    """
+    offset = get_id_offset(alias)
+    connection = connections[alias]
+    with transaction.atomic(using=alias), connection.cursor() as cursor:
+        for model in SHARDED_MODELS:
+            table = model._meta.db_table
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT CASE WHEN nextval(pg_get_serial_sequence(%s, %s)) < %s '
+                    'THEN setval(pg_get_serial_sequence(%s, %s), %s, false) END',
+                    [table, 'id', offset, table, 'id', offset]
+                )
+            elif connection.vendor == 'sqlite':
+                cursor.execute(
+                    'INSERT INTO sqlite_sequence (name, seq) SELECT %s, 0 '
+                    'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+                    [table, table]
+                )
+                cursor.execute(
+                    'UPDATE sqlite_sequence SET seq = %s WHERE name = %s AND seq < %s',
+                    [offset - 1, table, offset - 1]
+                )
+            else:
+                raise ImproperlyConfigured('Шардирование заказов поддерживается только для PostgreSQL и SQLite')
+
+
+def create_order(alias, **fields):
+    """
+    Создает заказ в БД alias. Диапазон id БД валюты проверяется один раз за процесс.
+    """
+    if alias != 'default' and alias not in _ranged:
+        with _ranged_lock:
+            if alias not in _ranged:
+                ensure_id_range(alias)
+                _ranged.add(alias)
+    return Order.objects.using(alias).create(**fields)
+
+
+def delete_orders(alias, order_ids):
+    """
+    Удаляет заказы вместе со строками. on_delete=SET_NULL работает только внутри одной БД,
+    поэтому ссылки на заказы из резервов и сессий Checkout на primary обнуляются явно.
+    """
+    Order.objects.using(alias).filter(pk__in=order_ids).delete()
+    if alias != 'default':
+        Reservation.objects.filter(order_id__in=order_ids).update(order=None)
+        CheckoutSession.objects.filter(order_id__in=order_ids).update(order=None)
+
+
+def relocate_order(order, alias):
+    """
+    Переносит пустой заказ в БД alias, сохраняя скидку и налог. Возвращает новый заказ.
+    """
+    relocated = create_order(alias, discount_id=order.discount_id, tax_id=order.tax_id)
+    delete_orders(order._state.db, [order.id])
+    return relocated
+
+
+@contextmanager
+def atomic(order):
+    """
+    Транзакция в БД заказа и, если это БД валюты, вложенная в нее транзакция на primary.
+    Это две независимые транзакции: при ошибке откатываются обе. Вложенная фиксируется первой,
+    поэтому при сбое между фиксациями изменения на primary (резервы) останутся без изменений заказа
+    и освободятся по истечении срока.
+    """
+    with ExitStack() as stack:
+        stack.enter_context(transaction.atomic(using=order._state.db or 'default'))
+        if order._state.db not in (None, 'default'):
+            stack.enter_context(transaction.atomic())
+        yield
+
+
+def run_in_thread(fn, alias):
+    try:
+        return fn(alias)
+    finally:
+        connections.close_all()
+
+
+def fan_out(fn, aliases=None):
+    """
+    Выполняет fn(alias) параллельно для каждой БД заказов и возвращает словарь alias -> результат.
+    У каждого потока свои соединения с БД, они закрываются по завершении.
+    """
+    aliases = aliases or get_aliases()
+    if len(aliases) == 1:
+        return {aliases[0]: fn(aliases[0])}
+    with ThreadPoolExecutor(max_workers=len(aliases), thread_name_prefix='order-shards') as executor:
+        futures = {alias: executor.submit(run_in_thread, fn, alias) for alias in aliases}
+        return {alias: future.result() for alias, future in futures.items()}
+
+
+def copy_rows(model, pks, aliases=None, batch_size=1000):
+    """
+    Копирует строки справочной таблицы с primary в БД валют: новые вставляются, существующие обновляются.
+    Строки, которых больше нет на primary, удаляются, вместе с ними удаляются или отвязываются
+    строки заказов, как при удалении на primary.
+    """
+    pks = list(pks)
+    fields = [field.name for field in model._meta.concrete_fields if not field.primary_key]
+    for alias in aliases or get_shard_aliases():
+        for start in range(0, len(pks), batch_size):
+            chunk = pks[start:start + batch_size]
+            rows = list(model.objects.using('default').filter(pk__in=chunk))
+            with transaction.atomic(using=alias):
+                model.objects.using(alias).bulk_create(
+                    rows, update_conflicts=True, unique_fields=['id'], update_fields=fields
+                )
+                missing = set(chunk) - {row.pk for row in rows}
+                if missing:
+                    model.objects.using(alias).filter(pk__in=missing).delete()
+
+
+def sync_reference_tables(alias, batch_size=1000):
+    """
+    Приводит копии товаров, скидок и налогов в БД валюты в соответствие с primary.
+    Нужна после первого включения шардирования и после записей в обход сигналов (generate_fixtures).
+    Возвращает словарь модель -> количество строк на primary.
+    """
+    stats = {}
+    for model in REFERENCE_MODELS:
+        pks = list(model.objects.using('default').order_by('pk').values_list('pk', flat=True))
+        stale = set(model.objects.using(alias).values_list('pk', flat=True)) - set(pks)
+        copy_rows(model, pks + sorted(stale), [alias], batch_size)
+        stats[model._meta.model_name] = len(pks)
+    return stats
@@ -0,0 +1,29 @@
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.conf import settings
+from .catalog import mark_changed
+from .models import Discount, Item, Tax
+from .shards import copy_rows
+
+
+@receiver([post_save, post_delete], sender=Item)
+def rebuild_catalog_snapshot(sender, **kwargs):
+    """
+    Отмечает изменение каталога после коммита транзакции, в которой изменился товар.
+    Снимок перестраивается с задержкой, одним разом на все изменения за CATALOG_SNAPSHOT_DEBOUNCE секунд.
+    """
+    if settings.CATALOG_SNAPSHOT_ENABLED:
+        transaction.on_commit(mark_changed)
+
+
+@receiver([post_save, post_delete], sender=Item)
+@receiver([post_save, post_delete], sender=Discount)
+@receiver([post_save, post_delete], sender=Tax)
+def copy_to_order_shards(sender, instance, using, **kwargs):
+    """
+    При ORDER_SHARDING копирует изменившийся товар, скидку или налог в БД валют после коммита на primary.
+    """
+    if settings.ORDER_SHARDS and using == 'default':
+        transaction.on_commit(partial(copy_rows, sender, [instance.pk]))
@@ -1,3 +1,829 @@
-from django.test import TestCase
+import tempfile
+import threading
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import stripe
+from . import (
+    capture, cart, catalog, fakestripe, fixtures, inventory, jobs, precheckout, ratelimit, reconcile, recommendations, rollups, shards,
+    tracing,
+)
+from .models import (
+    CheckoutSession, Discount, Item, ItemRecommendation, Job, Order, OrderItem, Reservation, SalesRollup, StockShard, Tax,
+)
 
-# Create your tests here.
+STRIPE_KEYS = {
+    'usd': {'public': 'pk_test_usd', 'secret': 'sk_test_usd'},
+    'eur': {'public': 'pk_test_eur', 'secret': 'sk_test_eur'},
+}
+
+# БД заказов валют для тестов шардирования. Без ORDER_SHARDING они добавляются как копии настроек default
+# до создания тестовых БД, поэтому test runner создает и мигрирует их вместе с default
+ORDER_SHARDS = settings.ORDER_SHARDS or {
+    'usd': {'alias': 'orders_usd', 'id_offset': 10 ** 12},
+    'eur': {'alias': 'orders_eur', 'id_offset': 2 * 10 ** 12},
+}
+for shard in ORDER_SHARDS.values():
+    default = connections.settings['default']
+    connections.settings.setdefault(shard['alias'], {
+        **default,
+        'NAME': f"{default['NAME']}_{shard['alias']}",
+        'TEST': {**default['TEST'], 'NAME': None},
+    })
+
+
+@override_settings(STRIPE_KEYS=STRIPE_KEYS)
+class ReconcilerTests(TransactionTestCase):
+    def fetch(self, kind, currency, since):
+        return (SimpleNamespace(id=f'{kind}_{currency}_{index}') for index in range(1000))
+
+    def test_failing_chunk_stops_producers(self):
+        reconciler = reconcile.Reconciler(since=None, chunk_size=1, concurrency=1, dry_run=True)
+        errors = []
+
+        def run():
+            try:
+                reconciler.run()
+            except RuntimeError as e:
+                errors.append(e)
+
+        with mock.patch.object(reconcile, 'fetch', self.fetch), \
+                mock.patch.object(reconcile.Reconciler, 'reconcile_coupons', side_effect=RuntimeError('boom')):
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            thread.join(timeout=10)
+        self.assertFalse(thread.is_alive(), 'сверка зависла после ошибки в обработчике куска')
+        self.assertEqual([str(e) for e in errors], ['boom'])
+
+
+@override_settings(STRIPE_KEYS={'usd': STRIPE_KEYS['usd']})
+class ReconcilerFakeStripeTests(TestCase):
+    """
+    Сверка целиком против поддельного Stripe из payments.fakestripe.
+    """
+    api_key = STRIPE_KEYS['usd']['secret']
+
+    def setUp(self):
+        self.state = fakestripe.FakeStripeState()
+        server = fakestripe.serve('127.0.0.1', 0, self.state)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        api_base = mock.patch.object(stripe, 'api_base', f'http://127.0.0.1:{server.server_address[1]}')
+        api_base.start()
+        self.addCleanup(api_base.stop)
+
+    def test_run_fixes_local_rows(self):
+        item = Item.objects.create(name='item', description='', price=1000)
+        inventory.set_stock(item.id, 5)
+        paid = Order.objects.create()
+        OrderItem.objects.create(order=paid, item=item, quantity=2)
+        unpaid = Order.objects.create()
+        self.state.load({self.api_key: {
+            'coupons': [
+                {'id': 'co_ok', 'percent_off': 10, 'duration': 'once', 'valid': True},
+                {'id': 'co_drifted', 'percent_off': 99, 'duration': 'once', 'valid': True},
+                {'id': 'co_orphaned', 'percent_off': 5, 'duration': 'once', 'valid': True},
+            ],
+            'tax_rates': [{'id': 'txr_ok', 'percentage': 20, 'active': True}],
+            'checkout/sessions': [
+                {'id': 'cs_paid', 'status': 'complete', 'payment_status': 'paid', 'amount_total': 2000,
+                 'metadata': {'order_id': str(paid.id)}},
+                {'id': 'cs_open', 'status': 'open', 'payment_status': 'unpaid', 'amount_total': 1000,
+                 'metadata': {'order_id': str(unpaid.id)}},
+            ],
+        }})
+        ok = Discount.objects.create(name='ok', percent_off=10, stripe_coupon_id='co_ok')
+        drifted = Discount.objects.create(name='drifted', percent_off=20, stripe_coupon_id='co_drifted')
+        missing = Discount.objects.create(name='missing', percent_off=30, stripe_coupon_id='co_missing')
+        unsynced = Discount.objects.create(name='unsynced', percent_off=40)
+        late = Discount.objects.create(name='late', percent_off=15, stripe_coupon_id='co_late')
+        tax_ok = Tax.objects.create(name='ok', percentage=20, stripe_tax_rate_id='txr_ok')
+        tax_missing = Tax.objects.create(name='missing', percentage=10, stripe_tax_rate_id='txr_missing')
+        fetch = reconcile.fetch
+
+        def fetch_then_sync_late(kind, currency, since):
+            yield from fetch(kind, currency, since)
+            if kind == 'coupons':
+                # Задача sync_discount создала купон уже после загрузки списка
+                self.state.create(self.api_key, 'coupons', {'id': 'co_late', 'percent_off': '15'})
+
+        with mock.patch.object(reconcile, 'fetch', fetch_then_sync_late):
+            stats = reconcile.Reconciler(since=timezone.now() - timedelta(days=1), chunk_size=2).run()
+
+        self.assertEqual(stats[('usd', 'coupons')], Counter(
+            fetched=3, matched=2, orphaned=1, drifted=1, missing=1, unsynced=1, fixed=2,
+        ))
+        self.assertEqual(stats[('usd', 'tax_rates')], Counter(fetched=1, matched=1, missing=1, fixed=1))
+        self.assertEqual(stats[('usd', 'checkout_sessions')], Counter(fetched=2, completed=1, unconfirmed=1, fixed=1))
+        self.assertEqual(
+            dict(Discount.objects.values_list('id', 'stripe_coupon_id')),
+            {ok.id: 'co_ok', drifted.id: None, missing.id: None, unsynced.id: None, late.id: 'co_late'},
+        )
+        self.assertEqual(
+            dict(Tax.objects.values_list('id', 'stripe_tax_rate_id')),
+            {tax_ok.id: 'txr_ok', tax_missing.id: None},
+        )
+        self.assertCountEqual(Job.objects.values_list('task', 'payload'), [
+            ('delete_stripe_coupon', {'currency': 'usd', 'coupon_id': 'co_drifted'}),
+            ('sync_discount', {'discount_id': drifted.id}),
+            ('sync_discount', {'discount_id': missing.id}),
+            ('sync_discount', {'discount_id': unsynced.id}),
+            ('sync_tax', {'tax_id': tax_missing.id}),
+        ])
+        paid.refresh_from_db()
+        session = CheckoutSession.objects.get(stripe_id='cs_paid')
+        self.assertEqual(paid.paid_at, session.created_at)
+        self.assertEqual(session.order_id, paid.id)
+        self.assertIsNone(Order.objects.get(pk=unpaid.pk).paid_at)
+        self.assertEqual(inventory.get_available(item.id), 3)
+
+
+@override_settings(
+    RATE_LIMITS={'add_discount': {'rate': '1/min', 'burst': 2}}, RATE_LIMIT_IP_MULTIPLIER=2, LOAD_SHED_MAX_IN_FLIGHT=0
+)
+class RateLimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def post(self, session_key=None):
+        if session_key:
+            self.client.cookies['sessionid'] = session_key
+        else:
+            self.client.cookies.pop('sessionid', None)
+        return self.client.post('/add_discount/', {'discount_name': 'missing'}).status_code
+
+    def test_token_bucket(self):
+        with mock.patch.object(ratelimit.time, 'time', return_value=1200.0):
+            self.assertEqual(ratelimit.take_token('add_discount', 'ip:1.2.3.4'), 0)
+            self.assertEqual(ratelimit.take_token('add_discount', 'ip:1.2.3.4'), 0)
+            self.assertEqual(ratelimit.take_token('add_discount', 'ip:1.2.3.4'), 120)
+            self.assertEqual(ratelimit.take_token('add_discount', 'ip:5.6.7.8'), 0)
+            # Отклоненный запрос токен не тратит
+            self.assertEqual(cache.get('rate_limit:bucket:add_discount:ip:1.2.3.4:10'), 2)
+        # В середине следующего окна половина прошлых запросов еще учитывается
+        with mock.patch.object(ratelimit.time, 'time', return_value=1380.0):
+            self.assertEqual(ratelimit.take_token('add_discount', 'ip:1.2.3.4'), 0)
+            self.assertGreater(ratelimit.take_token('add_discount', 'ip:1.2.3.4'), 0)
+
+    def test_concurrent_requests_do_not_exceed_burst(self):
+        results = []
+        barrier = threading.Barrier(20)
+
+        def take():
+            barrier.wait()
+            results.append(ratelimit.take_token('add_discount', 'ip:1.2.3.4', multiplier=5))
+
+        threads = [threading.Thread(target=take) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results.count(0), 10)
+
+    def test_session_and_ip_buckets(self):
+        self.assertEqual([self.post('a' * 32) for _ in range(3)][2], 429)
+        # Другая сессия с того же IP получает свою корзину, пока не исчерпан лимит IP
+        self.assertNotEqual(self.post('b' * 32), 429)
+        self.assertNotEqual(self.post('c' * 32), 429)
+        # Случайные cookie упираются в корзину IP
+        self.assertEqual(self.post('d' * 32), 429)
+        self.assertEqual(self.post(), 429)
+
+    def test_throttled_request_does_not_query_db(self):
+        self.post('a' * 32)
+        self.post('a' * 32)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.post('a' * 32), 429)
+
+    def test_load_shedding(self):
+        with override_settings(LOAD_SHED_MAX_IN_FLIGHT=2), mock.patch.object(ratelimit, 'in_flight', 1):
+            self.assertNotEqual(self.client.post('/add_discount/', {'discount_name': 'missing'}).status_code, 503)
+        with override_settings(LOAD_SHED_MAX_IN_FLIGHT=2), mock.patch.object(ratelimit, 'in_flight', 2):
+            response = self.client.post('/add_discount/', {'discount_name': 'missing'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(ratelimit.get_rejection_stats()['add_discount']['shed'], 1)
+
+
+class ManualTimer:
+    """
+    Таймер, который не запускается: отложенное перестроение выполняется явно через flush.
+    """
+    created = 0
+
+    def __init__(self, interval, function):
+        ManualTimer.created += 1
+
+    def start(self):
+        pass
+
+    def cancel(self):
+        pass
+
+
+class CatalogSnapshotTests(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(
+            CATALOG_SNAPSHOT_ENABLED=True,
+            CATALOG_SNAPSHOT_PATH=f'{directory.name}/catalog.snapshot',
+            CATALOG_SNAPSHOT_CHECK_INTERVAL=0,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        ManualTimer.created = 0
+        self.rebuilder = catalog.SnapshotRebuilder(timer_class=ManualTimer)
+        patcher = mock.patch.object(catalog, 'rebuilder', self.rebuilder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_saves_are_debounced_into_one_rebuild(self):
+        with mock.patch.object(catalog, 'rebuild_snapshot', wraps=catalog.rebuild_snapshot) as rebuild:
+            for index in range(5):
+                Item.objects.create(name=f'item {index}', description='', price=100 + index, currency='usd')
+            self.assertEqual(ManualTimer.created, 1)
+            rebuild.assert_not_called()
+            self.rebuilder.flush()
+        self.assertEqual(rebuild.call_count, 1)
+        self.assertEqual(len(catalog.list_items()), 5)
+
+    def test_stale_snapshot_is_rebuilt_after_version_bump(self):
+        item = Item.objects.create(name='item', description='', price=100, currency='usd')
+        self.rebuilder.flush()
+        self.assertEqual(catalog.get_item(item.id)['price'], 100)
+        # Изменение на другом хосте: товар меняется в обход сигналов, версия в общем кеше растет
+        Item.objects.filter(id=item.id).update(price=200)
+        catalog.bump_version()
+        catalog.get_item(item.id)
+        self.rebuilder.flush()
+        self.assertEqual(catalog.get_item(item.id)['price'], 200)
+
+    def test_one_process_rebuilds_the_host_file(self):
+        item = Item.objects.create(name='item', description='', price=100, currency='usd')
+        self.rebuilder.flush()
+        catalog.bump_version()
+        catalog.get_item(item.id)
+        key = catalog.REBUILD_LOCK_KEY.format(host=catalog.socket.gethostname(), path=catalog.settings.CATALOG_SNAPSHOT_PATH)
+        # Блокировку держит другой процесс хоста: этот не перестраивает файл и не откладывает перестроение
+        cache.set(key, 'other')
+        with mock.patch.object(catalog, 'rebuild_snapshot') as rebuild:
+            self.rebuilder.flush()
+            rebuild.assert_not_called()
+            self.assertIsNone(self.rebuilder.timer)
+            # Изменение в этом процессе откладывается, пока блокировка не освободится
+            self.rebuilder.schedule(force=True)
+            self.rebuilder.flush()
+            rebuild.assert_not_called()
+            self.assertIsNotNone(self.rebuilder.timer)
+            cache.delete(key)
+            self.rebuilder.flush()
+            rebuild.assert_called_once()
+
+
+class JobQueueTests(TestCase):
+    """
+    Очередь задач на SQLite: SKIP LOCKED здесь не проверяется, только выбор и повтор задач.
+    """
+    def setUp(self):
+        self.calls = []
+        patcher = mock.patch.dict(jobs.tasks, {'record': self.record, 'fail': self.fail_task})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record(self, **payload):
+        self.calls.append(payload)
+
+    def fail_task(self, **payload):
+        raise RuntimeError('stripe is down')
+
+    def test_enqueue_unknown_task(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue('missing')
+
+    def test_claim_jobs(self):
+        now = timezone.now()
+        ready = jobs.enqueue('record', value=1)
+        later = Job.objects.create(task='record', run_at=now + timedelta(minutes=5))
+        running = Job.objects.create(task='record', status=Job.RUNNING, locked_at=now)
+        stale = Job.objects.create(task='record', status=Job.RUNNING, locked_at=now - timedelta(hours=1), attempts=1)
+
+        claimed = jobs.claim_jobs(10, timedelta(minutes=10))
+        self.assertEqual({job.id for job in claimed}, {ready.id, stale.id})
+        self.assertTrue(all(job.status == Job.RUNNING for job in claimed))
+        self.assertEqual({job.id: job.attempts for job in claimed}, {ready.id: 1, stale.id: 2})
+        self.assertEqual(jobs.claim_jobs(10, timedelta(minutes=10)), [])
+        later.refresh_from_db()
+        running.refresh_from_db()
+        self.assertEqual(later.status, Job.PENDING)
+        self.assertEqual(running.attempts, 0)
+
+    def test_claim_jobs_limit(self):
+        jobs.enqueue_many('record', [{'value': index} for index in range(5)])
+        self.assertEqual(len(jobs.claim_jobs(2, timedelta(minutes=10))), 2)
+        self.assertEqual(len(jobs.claim_jobs(10, timedelta(minutes=10))), 3)
+
+    def test_run_job_success(self):
+        jobs.enqueue('record', value=1)
+        job, = jobs.claim_jobs(1, timedelta(minutes=10))
+        self.assertEqual(jobs.run_job(job), Job.DONE)
+        self.assertEqual(self.calls, [{'value': 1}])
+        job.refresh_from_db()
+        self.assertIsNone(job.locked_at)
+
+    def test_run_job_retries_with_backoff_then_fails(self):
+        Job.objects.create(task='fail', max_attempts=2)
+        job, = jobs.claim_jobs(1, timedelta(minutes=10))
+        started = timezone.now()
+        self.assertEqual(jobs.run_job(job), Job.PENDING)
+        job.refresh_from_db()
+        self.assertIn('stripe is down', job.last_error)
+        self.assertGreaterEqual(job.run_at, started + timedelta(seconds=2))
+        # Повтор еще не наступил
+        self.assertEqual(jobs.claim_jobs(1, timedelta(minutes=10)), [])
+
+        Job.objects.filter(id=job.id).update(run_at=timezone.now())
+        job, = jobs.claim_jobs(1, timedelta(minutes=10))
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(jobs.run_job(job), Job.FAILED)
+
+
+class InventoryTests(TestCase):
+    def setUp(self):
+        self.item = Item.objects.create(name='item', description='', price=100, currency='usd')
+        inventory.set_stock(self.item.id, 10, shards=3)
+
+    def test_set_stock_splits_quantity(self):
+        self.assertEqual(sorted(StockShard.objects.filter(item=self.item).values_list('quantity', flat=True)), [3, 3, 4])
+        self.assertEqual(inventory.get_available(self.item.id), 10)
+
+    def test_reserve_takes_from_several_shards(self):
+        reservations = inventory.reserve(self.item.id, 8)
+        self.assertEqual(sum(reservation.quantity for reservation in reservations), 8)
+        self.assertEqual(inventory.get_available(self.item.id), 2)
+
+    def test_reserve_out_of_stock_changes_nothing(self):
+        with self.assertRaises(inventory.OutOfStock):
+            inventory.reserve(self.item.id, 11)
+        self.assertEqual(inventory.get_available(self.item.id), 10)
+        self.assertFalse(Reservation.objects.exists())
+
+    def test_untracked_item(self):
+        other = Item.objects.create(name='other', description='', price=100, currency='usd')
+        self.assertEqual(inventory.reserve(other.id, 5), [])
+        self.assertIsNone(inventory.get_available(other.id))
+
+    def test_release_returns_stock_once(self):
+        reservations = inventory.reserve(self.item.id, 4)
+        queryset = Reservation.objects.filter(id__in=[reservation.id for reservation in reservations])
+        self.assertEqual(inventory.release(queryset), len(reservations))
+        self.assertEqual(inventory.release(queryset), 0)
+        self.assertEqual(inventory.get_available(self.item.id), 10)
+
+    def test_commit_keeps_stock_taken(self):
+        reservations = inventory.reserve(self.item.id, 4)
+        ids = [reservation.id for reservation in reservations]
+        self.assertEqual(inventory.commit(ids), {})
+        self.assertEqual(inventory.release(Reservation.objects.filter(id__in=ids)), 0)
+        self.assertEqual(inventory.get_available(self.item.id), 6)
+
+    def test_release_expired(self):
+        inventory.reserve(self.item.id, 4, ttl=60)
+        Reservation.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        inventory.reserve(self.item.id, 1, ttl=60)
+        self.assertEqual(inventory.release_expired(), Reservation.objects.filter(status=Reservation.RELEASED).count())
+        self.assertEqual(inventory.get_available(self.item.id), 9)
+
+    def test_commit_retakes_released_reservation(self):
+        ids = [reservation.id for reservation in inventory.reserve(self.item.id, 4, ttl=60)]
+        Reservation.objects.update(expires_at=timezone.now())
+        inventory.release_expired()
+        self.assertEqual(inventory.commit(ids), {})
+        self.assertEqual(inventory.get_available(self.item.id), 6)
+
+    def test_paid_order_after_reservation_expired(self):
+        order = Order.objects.create()
+        OrderItem.objects.create(order=order, item=self.item, quantity=4)
+        inventory.set_order_reservation(order, self.item.id, 4, ttl=60)
+        Reservation.objects.update(expires_at=timezone.now())
+        inventory.release_expired()
+        self.assertEqual(inventory.get_available(self.item.id), 10)
+
+        self.assertTrue(reconcile.mark_order_paid(order.id, timezone.now()))
+        self.assertEqual(inventory.get_available(self.item.id), 6)
+        committed = Reservation.objects.filter(order=order, status=Reservation.COMMITTED)
+        self.assertEqual(sum(committed.values_list('quantity', flat=True)), 4)
+        # Повторная отметка оплаты ничего не списывает
+        self.assertFalse(reconcile.mark_order_paid(order.id, timezone.now()))
+        self.assertEqual(inventory.get_available(self.item.id), 6)
+
+    def test_paid_order_takes_what_is_left(self):
+        order = Order.objects.create()
+        OrderItem.objects.create(order=order, item=self.item, quantity=4)
+        inventory.reserve(self.item.id, 8)
+        self.assertEqual(inventory.commit_order(order.id, [(self.item.id, 4)]), {self.item.id: 2})
+        self.assertEqual(inventory.get_available(self.item.id), 0)
+
+
+class RecordingViewMiddleware:
+    calls = []
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        self.calls.append(tracing.current_span.get().name)
+        return None
+
+
+@override_settings(
+    TRACING_SAMPLE_RATE=1,
+    MIDDLEWARE=[
+        'payments.middleware.TracingMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'payments.middleware.TracingViewMiddleware',
+        'payments.tests.RecordingViewMiddleware',
+    ],
+)
+class TracingViewMiddlewareTests(TestCase):
+    def test_view_span_keeps_middleware_chain(self):
+        RecordingViewMiddleware.calls = []
+        with mock.patch.object(tracing.processor, 'submit') as submit:
+            response = self.client.get('/cancel/')
+        self.assertEqual(response.status_code, 200)
+        # process_view следующих middleware вызывается внутри спана представления
+        self.assertEqual(RecordingViewMiddleware.calls, ['view TemplateView'])
+        spans = {span.name: span for span, in (call.args for call in submit.call_args_list)}
+        self.assertEqual(spans['view TemplateView'].parent_id, spans['GET cancel/'].span_id)
+
+
+class RecommendationsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = override_settings(
+            RECOMMENDATIONS_STATE_PATH=f'{directory.name}/state.npz',
+            RECOMMENDATIONS_SETTLE_SECONDS=0,
+            RECOMMENDATIONS_MIN_SUPPORT=1,
+        )
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        self.items = [Item.objects.create(name=f'item {index}', description='', price=100, currency='usd') for index in range(3)]
+
+    def pay(self, items, paid_at):
+        order = Order.objects.create()
+        for item in items:
+            OrderItem.objects.create(order=order, item=item)
+        reconcile.mark_order_paid(order.id, paid_at)
+
+    def neighbours(self, item):
+        return [neighbour for neighbour, _ in ItemRecommendation.objects.get(item=item).neighbours]
+
+    def test_incremental_refresh_includes_backdated_payments(self):
+        first, second, third = self.items
+        self.pay([first, second], timezone.now())
+        recommendations.refresh(full=True)
+        self.assertEqual(self.neighbours(first), [second.id])
+
+        # Сверка со Stripe отмечает заказ оплаченным временем создания сессии, то есть задним числом
+        self.pay([first, third], timezone.now() - timedelta(days=1))
+        recommendations.refresh()
+        self.assertCountEqual(self.neighbours(first), [second.id, third.id])
+
+
+@override_settings(CART_WRITE_BEHIND=True)
+class CartBufferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.item = Item.objects.create(name='item', description='', price=100, currency='usd')
+        self.order = Order.objects.create()
+        inventory.set_stock(self.item.id, 2)
+
+    def as_dict(self, item):
+        return {'id': item.id, 'currency': item.currency}
+
+    def test_out_of_stock_rejected_on_add(self):
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        with self.assertRaises(inventory.OutOfStock):
+            cart.buffer_add(self.order, self.as_dict(self.item))
+        cart.flush(self.order)
+        self.assertEqual(self.order.orderitem_set.get().quantity, 2)
+        self.assertEqual(inventory.get_available(self.item.id), 0)
+
+    def test_currency_mismatch_rejected_on_add(self):
+        other = Item.objects.create(name='other', description='', price=100, currency='eur')
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        with self.assertRaises(cart.CurrencyMismatch):
+            cart.buffer_add(self.order, self.as_dict(other))
+        cart.flush(self.order)
+        self.assertEqual(list(self.order.orderitem_set.values_list('item_id', 'quantity')), [(self.item.id, 1)])
+
+    def test_flush_remembers_units_sold_out_before_it(self):
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        inventory.set_stock(self.item.id, 1)
+        cart.flush(self.order)
+        self.assertEqual(self.order.orderitem_set.get().quantity, 1)
+        self.assertEqual(cart.pop_dropped(self.order.id), {self.item.id: 1})
+        self.assertEqual(cart.pop_dropped(self.order.id), {})
+
+    @override_settings(CART_BUFFER_FLUSH_DELAY=60)
+    def test_new_buffer_is_flushed_by_job(self):
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        cart.buffer_add(self.order, self.as_dict(self.item))
+        job = Job.objects.get()
+        self.assertEqual((job.task, job.payload), ('flush_cart_buffer', {'order_id': self.order.id}))
+        self.assertGreater(job.run_at, timezone.now() + timedelta(seconds=50))
+        self.assertEqual(jobs.run_job(job), Job.DONE)
+        self.assertFalse(cart.has_pending(self.order.id))
+        self.assertEqual(self.order.orderitem_set.get().quantity, 2)
+        self.assertEqual(inventory.get_available(self.item.id), 0)
+
+    @override_settings(RATE_LIMITS={}, CATALOG_SNAPSHOT_ENABLED=False, CHECKOUT_PRECREATE=False)
+    def test_checkout_stops_when_units_were_dropped(self):
+        self.client.post(f'/add_to_order/{self.item.id}/')
+        self.client.post(f'/add_to_order/{self.item.id}/')
+        inventory.set_stock(self.item.id, 1)
+        response = self.client.get('/buy_order/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['dropped'], [{'item_id': self.item.id, 'name': 'item', 'quantity': 1}])
+
+
+@override_settings(
+    CAPTURE_SAMPLE_RATE=1,
+    CAPTURE_EXCLUDE=[],
+    MIDDLEWARE=[
+        'payments.middleware.TrafficCaptureMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+    ],
+)
+class TrafficCaptureMiddlewareTests(TestCase):
+    def test_capture_enabled_checked_per_request(self):
+        with mock.patch.object(capture.writer, 'submit') as submit:
+            with override_settings(CAPTURE_ENABLED=False):
+                self.client.get('/cancel/')
+            submit.assert_not_called()
+            with override_settings(CAPTURE_ENABLED=True):
+                self.client.get('/cancel/')
+            self.assertEqual(submit.call_count, 1)
+
+
+@override_settings(RATE_LIMITS={}, CATALOG_SNAPSHOT_ENABLED=False, CART_WRITE_BEHIND=False, CHECKOUT_PRECREATE=False)
+class BatchOrderTests(TestCase):
+    def setUp(self):
+        self.usd = Item.objects.create(name='usd', description='', price=100, currency='usd')
+        self.untracked = Item.objects.create(name='untracked', description='', price=50, currency='usd')
+        self.scarce = Item.objects.create(name='scarce', description='', price=100, currency='usd')
+        self.eur = Item.objects.create(name='eur', description='', price=100, currency='eur')
+        inventory.set_stock(self.usd.id, 10)
+        inventory.set_stock(self.scarce.id, 1)
+
+    def batch(self, *operations):
+        return self.client.post('/order/batch/', {'operations': list(operations)}, content_type='application/json')
+
+    def lines(self):
+        order = Order.objects.get(pk=self.client.session['order_id'])
+        return dict(order.orderitem_set.values_list('item_id', 'quantity'))
+
+    def reserved(self):
+        return dict(
+            Reservation.objects.filter(status=Reservation.ACTIVE)
+            .values('item_id').annotate(total=Sum('quantity')).values_list('item_id', 'total')
+        )
+
+    def test_set_increment_remove(self):
+        response = self.batch(
+            {'op': 'set', 'item_id': self.usd.id, 'quantity': 3},
+            {'op': 'increment', 'item_id': self.untracked.id, 'quantity': 2},
+            {'op': 'increment', 'item_id': self.usd.id},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['order']['items']), 2)
+        self.assertEqual(self.lines(), {self.usd.id: 4, self.untracked.id: 2})
+        self.assertEqual(self.reserved(), {self.usd.id: 4})
+
+        response = self.batch(
+            {'op': 'set', 'item_id': self.usd.id, 'quantity': 1},
+            {'op': 'remove', 'item_id': self.untracked.id},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.lines(), {self.usd.id: 1})
+        self.assertEqual(self.reserved(), {self.usd.id: 1})
+        self.assertEqual(inventory.get_available(self.usd.id), 9)
+
+    def test_currency_mismatch_rejected(self):
+        self.assertEqual(self.batch(
+            {'op': 'increment', 'item_id': self.usd.id},
+            {'op': 'increment', 'item_id': self.eur.id},
+        ).status_code, 400)
+        self.batch({'op': 'increment', 'item_id': self.usd.id})
+        self.assertEqual(self.batch({'op': 'increment', 'item_id': self.eur.id}).status_code, 400)
+        self.assertEqual(self.lines(), {self.usd.id: 1})
+
+    def test_out_of_stock_rolls_back_whole_batch(self):
+        self.batch({'op': 'set', 'item_id': self.usd.id, 'quantity': 5})
+        response = self.batch(
+            {'op': 'set', 'item_id': self.usd.id, 'quantity': 2},
+            {'op': 'increment', 'item_id': self.untracked.id},
+            {'op': 'increment', 'item_id': self.scarce.id, 'quantity': 2},
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.lines(), {self.usd.id: 5})
+        self.assertEqual(self.reserved(), {self.usd.id: 5})
+        self.assertEqual(inventory.get_available(self.usd.id), 5)
+        self.assertEqual(inventory.get_available(self.scarce.id), 1)
+
+    def test_one_line_per_item(self):
+        self.batch({'op': 'increment', 'item_id': self.usd.id})
+        order = Order.objects.get(pk=self.client.session['order_id'])
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            OrderItem.objects.create(order=order, item=self.usd)
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.discount = Discount.objects.create(name='Sale', percent_off=10, stripe_coupon_id='co_sale')
+        self.tax = Tax.objects.create(name='VAT', percentage=20, stripe_tax_rate_id='txr_vat')
+        item = Item.objects.create(name='Book', description='', price=1000)
+        self.order = Order.objects.create(discount=self.discount, tax=self.tax)
+        OrderItem.objects.create(order=self.order, item=item, quantity=2)
+
+    def amounts(self):
+        return list(SalesRollup.objects.values_list(*rollups.AMOUNT_FIELDS))
+
+    def test_payment_stores_applied_rates(self):
+        self.assertTrue(rollups.record_paid_order(self.order.id))
+        self.assertFalse(rollups.record_paid_order(self.order.id))
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.discount_percent, self.order.tax_percentage), (10, 20))
+        self.assertEqual(self.amounts(), [(2, 2000, 200, 360, 1800)])
+
+    def test_rebuild_uses_rates_applied_at_payment(self):
+        rollups.record_paid_order(self.order.id)
+        recorded = self.amounts()
+        # Скидку отключили, как в админке, а налог изменили уже после оплаты
+        Discount.objects.filter(pk=self.discount.pk).update(active=False, stripe_coupon_id=None)
+        Tax.objects.filter(pk=self.tax.pk).update(percentage=5)
+        self.assertEqual(rollups.rebuild(), 1)
+        self.assertEqual(self.amounts(), recorded)
+
+    def test_inactive_rates_are_not_applied_at_payment(self):
+        Discount.objects.filter(pk=self.discount.pk).update(active=False)
+        rollups.record_paid_order(self.order.id)
+        self.order.refresh_from_db()
+        self.assertEqual((self.order.discount_percent, self.order.tax_percentage), (0, 20))
+        self.assertEqual(self.amounts(), [(2, 2000, 0, 400, 2000)])
+
+
+@override_settings(STRIPE_KEYS=STRIPE_KEYS, CHECKOUT_PRECREATE=True)
+class PrecheckoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.order = Order.objects.create()
+        item = Item.objects.create(name='item', description='', price=100)
+        self.line = OrderItem.objects.create(order=self.order, item=item, quantity=1)
+        patches = [
+            mock.patch.object(precheckout.preparer, 'submit', side_effect=lambda fn, *args: fn(*args)),
+            mock.patch.object(precheckout, 'create_session', side_effect=[SimpleNamespace(id='cs_1'), SimpleNamespace(id='cs_2')]),
+            mock.patch.object(precheckout.stripe.checkout.Session, 'expire'),
+        ]
+        self.submit, self.create_session, self.expire = [patch.start() for patch in patches]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def checkout_data(self):
+        return precheckout.get_checkout_data(self.order, list(self.order.orderitem_set.select_related('item')), 'usd')
+
+    def prepare(self):
+        precheckout.prepare(self.order, list(self.order.orderitem_set.select_related('item')), 'usd')
+
+    def test_same_cart_takes_prepared_session(self):
+        self.prepare()
+        self.prepare()
+        self.assertEqual(precheckout.take(self.order.id, 'usd', self.checkout_data()), 'cs_1')
+        self.assertEqual(precheckout.take(self.order.id, 'usd', self.checkout_data()), 'cs_1')
+        self.assertEqual(self.create_session.call_count, 1)
+        self.expire.assert_not_called()
+
+    def test_changed_cart_expires_prepared_session(self):
+        self.prepare()
+        OrderItem.objects.filter(pk=self.line.pk).update(quantity=2)
+        self.assertIsNone(precheckout.take(self.order.id, 'usd', self.checkout_data()))
+        self.expire.assert_called_once_with('cs_1', api_key=STRIPE_KEYS['usd']['secret'])
+        self.assertEqual(precheckout.create(self.order.id, 'usd', self.checkout_data()), 'cs_2')
+        self.assertEqual(precheckout.take(self.order.id, 'usd', self.checkout_data()), 'cs_2')
+
+    @override_settings(CHECKOUT_PRECREATE=False)
+    def test_disabled_precreate_does_nothing(self):
+        self.prepare()
+        self.submit.assert_not_called()
+        self.assertEqual(precheckout.create(self.order.id, 'usd', self.checkout_data()), 'cs_1')
+        self.assertIsNone(precheckout.take(self.order.id, 'usd', self.checkout_data()))
+        self.assertEqual(self.create_session.call_count, 1)
+
+
+@override_settings(
+    ORDER_SHARDS=ORDER_SHARDS,
+    DATABASE_ROUTERS=['payments.routers.OrderShardRouter'],
+    STRIPE_KEYS=STRIPE_KEYS,
+    RATE_LIMITS={},
+    CATALOG_SNAPSHOT_ENABLED=False,
+    CART_WRITE_BEHIND=False,
+    CHECKOUT_PRECREATE=False,
+)
+class OrderShardingTests(TransactionTestCase):
+    databases = {'default'} | {shard['alias'] for shard in ORDER_SHARDS.values()}
+
+    def setUp(self):
+        self.usd_db = ORDER_SHARDS['usd']['alias']
+        self.eur_db = ORDER_SHARDS['eur']['alias']
+        # Диапазоны id проверяются один раз за процесс, а между тестами БД очищаются
+        shards._ranged.clear()
+        # Копии товаров в БД валют создает сигнал после коммита
+        self.usd = Item.objects.create(name='book', description='', price=1000, currency='usd')
+        self.eur = Item.objects.create(name='pen', description='', price=300, currency='eur')
+        inventory.set_stock(self.usd.id, 5)
+
+    def test_routing_helpers(self):
+        self.assertEqual(shards.alias_for_currency('eur'), self.eur_db)
+        self.assertEqual(shards.alias_for_currency('gbp'), 'default')
+        self.assertEqual(shards.alias_for_order_id(ORDER_SHARDS['usd']['id_offset'] - 1), 'default')
+        self.assertEqual(shards.alias_for_order_id(ORDER_SHARDS['usd']['id_offset']), self.usd_db)
+        self.assertEqual(shards.alias_for_order_id(ORDER_SHARDS['eur']['id_offset'] + 5), self.eur_db)
+        shards.ensure_id_range(self.eur_db)
+        shards.ensure_id_range(self.eur_db)
+        self.assertGreaterEqual(Order.objects.using(self.eur_db).create().id, ORDER_SHARDS['eur']['id_offset'])
+        self.assertEqual(shards.fan_out(lambda alias: Item.objects.using(alias).count()), {
+            'default': 2, self.usd_db: 2, self.eur_db: 2,
+        })
+
+    def test_cart_lives_in_currency_database(self):
+        self.client.post(f'/add_to_order/{self.usd.id}/')
+        self.client.post(f'/add_to_order/{self.usd.id}/')
+        order_id = self.client.session['order_id']
+        self.assertEqual(self.client.session['order_db'], self.usd_db)
+        self.assertGreaterEqual(order_id, ORDER_SHARDS['usd']['id_offset'])
+        self.assertFalse(Order.objects.filter(pk=order_id).exists())
+        self.assertEqual(Reservation.objects.filter(order_id=order_id).aggregate(total=Sum('quantity'))['total'], 2)
+        response = self.client.get('/order/')
+        self.assertEqual(
+            [(line['item']['id'], line['quantity']) for line in response.data['order']['items']], [(self.usd.id, 2)]
+        )
+
+    def test_empty_cart_moves_to_item_currency(self):
+        self.client.get('/order/')
+        empty_id = self.client.session['order_id']
+        self.assertEqual(shards.alias_for_order_id(empty_id), self.usd_db)
+        self.client.post(f'/add_to_order/{self.eur.id}/')
+        order_id = self.client.session['order_id']
+        self.assertEqual(self.client.session['order_db'], self.eur_db)
+        self.assertFalse(Order.objects.using(self.usd_db).filter(pk=empty_id).exists())
+        order = Order.objects.using(self.eur_db).get(pk=order_id)
+        self.assertEqual(list(order.orderitem_set.values_list('item_id', flat=True)), [self.eur.id])
+
+    def test_orders_report_merges_databases(self):
+        paid_at = timezone.now()
+        for alias, item, quantity in [('default', self.usd, 1), (self.usd_db, self.usd, 2), (self.eur_db, self.eur, 2)]:
+            order = shards.create_order(alias, paid_at=paid_at)
+            OrderItem.objects.using(alias).create(order=order, item=item, quantity=quantity)
+        shards.create_order(self.usd_db)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get('/orders_report/')
+        day = timezone.localdate(paid_at).isoformat()
+        self.assertEqual(response.json()['rows'], [
+            {'day': day, 'currency': 'eur', 'orders': 1, 'units': 2, 'gross': 600},
+            {'day': day, 'currency': 'usd', 'orders': 2, 'units': 3, 'gross': 3000},
+        ])
+        self.assertEqual(response.json()['databases'], {
+            'default': {'orders': 1, 'paid': 1, 'open': 0},
+            self.usd_db: {'orders': 2, 'paid': 1, 'open': 1},
+            self.eur_db: {'orders': 1, 'paid': 1, 'open': 0},
+        })
+
+    def test_fixtures_write_orders_to_currency_databases(self):
+        generator = fixtures.FixtureGenerator(seed=1, distributions=fixtures.Distributions(paid_ratio=0.5))
+        generator.run(items=20, orders=200, discounts=4, taxes=2)
+        self.assertFalse(Order.objects.exists())
+        for currency, shard in ORDER_SHARDS.items():
+            orders = Order.objects.using(shard['alias'])
+            self.assertTrue(orders.exists())
+            self.assertGreaterEqual(orders.order_by('id').first().id, shard['id_offset'])
+            lines = OrderItem.objects.using(shard['alias'])
+            self.assertGreaterEqual(lines.order_by('id').first().id, shard['id_offset'])
+            self.assertFalse(lines.exclude(item__currency=currency).exists())
+            self.assertFalse(orders.filter(discount__isnull=False).exclude(discount__currency=currency).exists())
+            last_id = orders.order_by('-id').first().id
+            self.assertEqual(shards.create_order(shard['alias']).id, last_id + 1)
@@ -0,0 +1,315 @@
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates, Template
+from django.utils.module_loading import import_string
+
+# Виды спанов в терминах OpenTelemetry
+INTERNAL = 1
+SERVER = 2
+CLIENT = 3
+
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+# Текущий спан запроса. None означает, что запрос не попал в выборку и спаны не создаются
+current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    Отрезок времени выполнения запроса: вид, атрибуты, статус и связь с родительским спаном.
+    """
+    __slots__ = ['trace_id', 'span_id', 'parent_id', 'name', 'kind', 'attributes', 'start_ns', 'end_ns', 'error']
+
+    def __init__(self, name, trace_id, parent_id=None, kind=INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'kind': self.kind,
+            'start_ns': self.start_ns,
+            'end_ns': self.end_ns,
+            'duration_ms': (self.end_ns - self.start_ns) / 1e6,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+def should_sample(traceparent):
+    """
+    Решение о выборке принимается один раз в начале трассы (head sampling).
+    Если запрос пришел с заголовком traceparent, решение вызывающей стороны сохраняется.
+    Возвращает (trace_id, parent_id) для трассируемого запроса или None.
+    """
+    match = TRACEPARENT_RE.match(traceparent or '')
+    if match:
+        trace_id, parent_id, flags = match.groups()
+        return (trace_id, parent_id) if int(flags, 16) & 1 else None
+    if random.random() < settings.TRACING_SAMPLE_RATE:
+        return '%032x' % random.getrandbits(128), None
+    return None
+
+
+@contextmanager
+def activate(span):
+    """
+    Делает спан текущим на время блока, фиксирует ошибку и отправляет завершенный спан экспортеру.
+    """
+    token = current_span.set(span)
+    try:
+        yield span
+    except Exception as e:
+        span.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        span.end_ns = time.time_ns()
+        current_span.reset(token)
+        processor.submit(span)
+
+
+@contextmanager
+def start_span(name, kind=INTERNAL, **attributes):
+    """
+    Открывает дочерний спан текущего спана. Вне трассируемого запроса ничего не делает.
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    with activate(Span(name, parent.trace_id, parent.span_id, kind, attributes)) as span:
+        yield span
+
+
+@contextmanager
+def start_trace(name, traceparent=None, kind=SERVER, **attributes):
+    """
+    Открывает корневой спан запроса, если он попал в выборку.
+    """
+    sampled = should_sample(traceparent)
+    if sampled is None:
+        yield None
+        return
+    trace_id, parent_id = sampled
+    with activate(Span(name, trace_id, parent_id, kind, attributes)) as span:
+        yield span
+
+
+def trace_query(execute, sql, params, many, context):
+    """
+    Обертка connection.execute_wrapper: открывает спан на каждый запрос к БД.
+    Параметры запроса не записываются, чтобы в трассы не попадали персональные данные.
+    """
+    with start_span('db.query', CLIENT, **{
+        'db.system': context['connection'].vendor,
+        'db.alias': context['connection'].alias,
+        'db.statement': sql[:1000],
+    }):
+        return execute(sql, params, many, context)
+
+
+class TracedTemplate(Template):
+    def render(self, context=None, request=None):
+        with start_span('template.render', template=self.origin.template_name):
+            return super().render(context, request)
+
+
+class TracedDjangoTemplates(DjangoTemplates):
+    """
+    Шаблонный бэкенд Django, открывающий спан на каждый рендеринг шаблона.
+    """
+    def from_string(self, template_code):
+        return TracedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TracedTemplate(template.template, self)
+
+
+def instrument_stripe():
+    """
+    Оборачивает HTTP-клиент Stripe: каждый вызов API получает клиентский спан,
+    а в запрос добавляется заголовок traceparent.
+    """
+    import stripe
+    client = stripe.new_default_http_client(verify_ssl_certs=stripe.verify_ssl_certs, proxy=stripe.proxy)
+    request_with_retries = client.request_with_retries
+
+    def traced_request_with_retries(method, url, headers, post_data=None, max_network_retries=None, **kwargs):
+        with start_span('stripe.request', CLIENT, **{
+            'http.method': method.upper(),
+            'http.url': urlsplit(url).path,
+        }) as span:
+            if span is not None:
+                headers = {**headers, 'traceparent': span.traceparent}
+            body, status, response_headers = request_with_retries(
+                method, url, headers, post_data, max_network_retries, **kwargs
+            )
+            if span is not None:
+                span.attributes['http.status_code'] = status
+            return body, status, response_headers
+
+    client.request_with_retries = traced_request_with_retries
+    stripe.default_http_client = client
+
+
+class JsonlFileExporter:
+    """
+    Записывает спаны в локальный файл, по одному JSON-объекту на строку.
+    """
+    def __init__(self, path='traces.jsonl'):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + '\n' for span in spans)
+        with self.lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def shutdown(self):
+        pass
+
+
+class OtlpHttpExporter:
+    """
+    Отправляет спаны в коллектор OpenTelemetry по протоколу OTLP/HTTP в JSON-кодировке.
+    """
+    def __init__(self, endpoint='http://localhost:4318/v1/traces', headers=None, timeout=5, service_name='stripe_server'):
+        import requests
+        self.session = requests.Session()
+        self.endpoint = endpoint
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+        self.timeout = timeout
+        self.service_name = service_name
+
+    def encode_value(self, value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def encode_span(self, span):
+        encoded = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': span.kind,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': [{'key': key, 'value': self.encode_value(value)} for key, value in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+        }
+        if span.parent_id:
+            encoded['parentSpanId'] = span.parent_id
+        return encoded
+
+    def export(self, spans):
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': [
+                    {'key': 'service.name', 'value': {'stringValue': self.service_name}},
+                    {'key': 'process.pid', 'value': {'intValue': str(os.getpid())}},
+                ]},
+                'scopeSpans': [{
+                    'scope': {'name': 'payments.tracing'},
+                    'spans': [self.encode_span(span) for span in spans],
+                }],
+            }],
+        }
+        self.session.post(self.endpoint, json=payload, headers=self.headers, timeout=self.timeout)
+
+    def shutdown(self):
+        self.session.close()
+
+
+class BatchSpanProcessor:
+    """
+    Накапливает завершенные спаны в ограниченной очереди и отправляет их экспортеру пачками из фонового потока.
+    При переполнении очереди спаны отбрасываются, чтобы трассировка не замедляла запросы.
+    Поток запускается лениво, поэтому корректно работает в воркерах gunicorn после fork.
+    """
+    def __init__(self, max_queue_size=2048, batch_size=512, interval=1.0):
+        self.queue = queue.Queue(max_queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.exporter = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.exporter = import_string(settings.TRACING_EXPORTER)(**settings.TRACING_EXPORTER_OPTIONS)
+            self.pid = os.getpid()
+            threading.Thread(target=self.run, name='span-exporter', daemon=True).start()
+            atexit.register(self.flush)
+
+    def submit(self, span):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def drain(self):
+        spans = []
+        while len(spans) < self.batch_size:
+            try:
+                spans.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return spans
+
+    def export(self, spans):
+        try:
+            self.exporter.export(spans)
+        except Exception:
+            self.dropped += len(spans)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            spans = self.drain()
+            while spans:
+                self.export(spans)
+                spans = self.drain()
+
+    def flush(self):
+        spans = self.drain()
+        while spans:
+            self.export(spans)
+            spans = self.drain()
+        self.exporter.shutdown()
+
+
+processor = BatchSpanProcessor()
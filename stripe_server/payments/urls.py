@@ -1,6 +1,6 @@
 from django.urls import path
 from django.views.generic import TemplateView
-from .views import ItemAPIView, BuyAPIView, ListItemAPIView, OrderAPIView, AddToOrderAPIView, BuyIntentAPIView, BuyIntentTemplateAPIView, ClearOrderAPIView, BuyOrderAPIView, AddDiscountAPIView, AddTaxAPIView
+from .views import ItemAPIView, BuyAPIView, ListItemAPIView, OrderAPIView, AddToOrderAPIView, BatchOrderAPIView, BuyIntentAPIView, BuyIntentTemplateAPIView, BuyIntentCompleteAPIView, ClearOrderAPIView, BuyOrderAPIView, CheckoutSuccessAPIView, AddDiscountAPIView, AddTaxAPIView, DatabasePoolStatsAPIView, RateLimitStatsAPIView, SalesReportAPIView, OrdersReportAPIView
 
 urlpatterns = [
     path('', ListItemAPIView.as_view(), name='list-items'),
@@ -8,12 +8,18 @@ urlpatterns = [
     path('buy/<int:id>/', BuyAPIView.as_view(), name='buy'),
     path('buy_intent/<int:item_id>/', BuyIntentAPIView.as_view(), name='buy-intent'),
     path('buy_intent_html/<int:item_id>/', BuyIntentTemplateAPIView.as_view(), name='buy-intent-html'),
+    path('buy_intent_done/<int:item_id>/', BuyIntentCompleteAPIView.as_view(), name='buy-intent-done'),
     path('order/', OrderAPIView.as_view(), name='order'),
     path('add_to_order/<int:item_id>/', AddToOrderAPIView.as_view(), name='add-to-order'),
+    path('order/batch/', BatchOrderAPIView.as_view(), name='order-batch'),
     path('buy_order/', BuyOrderAPIView.as_view(), name='buy-order'),
     path('clear_order/', ClearOrderAPIView.as_view(), name='clear-order'),
     path('add_discount/', AddDiscountAPIView.as_view(), name='add-discount'),
     path('add_tax/', AddTaxAPIView.as_view(), name='add-tax'),
-    path('success/', TemplateView.as_view(template_name='success.html')), 
+    path('success/', CheckoutSuccessAPIView.as_view(), name='success'),
     path('cancel/', TemplateView.as_view(template_name='cancel.html')),
+    path('db_pool_stats/', DatabasePoolStatsAPIView.as_view(), name='db-pool-stats'),
+    path('rate_limit_stats/', RateLimitStatsAPIView.as_view(), name='rate-limit-stats'),
+    path('sales_report/', SalesReportAPIView.as_view(), name='sales-report'),
+    path('orders_report/', OrdersReportAPIView.as_view(), name='orders-report'),
 ]
\ No newline at end of file
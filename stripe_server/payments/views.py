@@ -1,29 +1,59 @@
-from django.shortcuts import get_object_or_404
+import os
+import time
+from datetime import date, timedelta
+from django.shortcuts import get_object_or_404, redirect
 from django.conf import settings
+from django.db import connections, DatabaseError
+from django.db.models import Count, F, Prefetch, Sum
+from django.db.models.functions import TruncDate
+from django.http import Http404
+from django.utils import timezone
 from rest_framework.views import APIView
-from rest_framework.generics import ListAPIView
 from rest_framework.renderers import TemplateHTMLRenderer, JSONRenderer
-from rest_framework.permissions import AllowAny
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.response import Response
 import stripe
-from .models import Item, Order, OrderItem, Discount, Tax
-from .serializers import ItemSerializer, OrderSerializer
+from .models import Item, Order, OrderItem, Discount, Tax, Reservation, SalesRollup, ItemRecommendation
+from .serializers import ItemSerializer, OrderSerializer, CartBatchSerializer
+from . import cart, catalog, inventory, popularity, precheckout, ratelimit, reconcile, rollups, shards
 
-def get_or_create_order(request):
+def get_or_create_order(request, currency=None):
     """
     Создает новый заказ, если он не существует, и сохраняет его в сессии.
-    Возвращает существующий заказ, если он уже есть в сессии.
+    Возвращает существующий заказ, если он уже есть в сессии и еще не оплачен.
+    При ORDER_SHARDING заказ хранится в БД валюты первого товара, ее alias сохраняется в сессии.
+    Пока валюта неизвестна, заказ создается в БД валюты по умолчанию, а при добавлении первого товара
+    в другой валюте пустой заказ переносится в ее БД.
     """
+    alias = shards.alias_for_currency(currency or 'usd')
     order_id = request.session.get('order_id')
     if order_id:
+        order_db = get_order_db(request)
         try:
-            return Order.objects.get(id=order_id)
+            order = Order.objects.using(order_db).get(id=order_id, paid_at__isnull=True)
         except Order.DoesNotExist:
-            pass
-    order = Order.objects.create()
+            order = None
+        if order is not None:
+            if currency and order_db != alias and not order.orderitem_set.exists() and not cart.has_pending(order.id):
+                order = shards.relocate_order(order, alias)
+                request.session['order_id'] = order.id
+                request.session['order_db'] = alias
+            return order
+    order = shards.create_order(alias)
     request.session['order_id'] = order.id
+    request.session['order_db'] = alias
     return order
 
+def get_order_db(request):
+    """
+    БД текущего заказа из сессии. Для сессий без order_db или с БД, которой больше нет в настройках,
+    определяется по id заказа.
+    """
+    order_db = request.session.get('order_db')
+    if order_db not in settings.DATABASES:
+        order_db = shards.alias_for_order_id(request.session['order_id'])
+    return order_db
+
 def get_order_currency(order):
     """
     Возвращает валюту первого товара в заказе.
@@ -34,37 +64,121 @@ def get_order_currency(order):
         return order_items.first().item.currency
     return 'usd'
 
-class ListItemAPIView(ListAPIView):
+def get_or_create_payment_intent(request, item):
+    """
+    Возвращает незавершенное платежное намерение для пары сессия/товар.
+    Намерение хранится в сессии и переиспользуется без обращения к Stripe.
+    Если цена товара изменилась, намерение обновляется, а не создается заново.
+    Если обновить намерение нельзя (оно уже подтверждено или отменено), создается новое.
+    """
+    payment_intents = request.session.get('payment_intents', {})
+    payment_intent = payment_intents.get(str(item.id))
+    api_key = settings.STRIPE_KEYS[item.currency]['secret']
+    if payment_intent and payment_intent['currency'] == item.currency:
+        if payment_intent['amount'] == item.price:
+            return payment_intent
+        try:
+            stripe.PaymentIntent.modify(payment_intent['id'], amount=item.price, api_key=api_key)
+            payment_intent['amount'] = item.price
+            request.session['payment_intents'] = payment_intents
+            return payment_intent
+        except stripe.error.InvalidRequestError:
+            pass
+
+    created = stripe.PaymentIntent.create(
+        api_key=api_key,
+        amount=item.price,
+        currency=item.currency,
+        automatic_payment_methods={'enabled': True},
+    )
+    payment_intents[str(item.id)] = {
+        'id': created.id,
+        'client_secret': created.client_secret,
+        'amount': item.price,
+        'currency': item.currency,
+    }
+    request.session['payment_intents'] = payment_intents
+    return payment_intents[str(item.id)]
+
+# Запас времени между истечением сессии Stripe Checkout и резерва товара,
+# чтобы оплата не могла пройти после возврата товара на склад
+CHECKOUT_TTL_MARGIN = 300
+
+def get_dropped_items(order):
+    """
+    Товары, которые не попали в корзину при записи отложенных добавлений: их раскупили раньше.
+    Список словарей с id, названием и количеством единиц; после чтения список очищается.
+    """
+    dropped = cart.pop_dropped(order.id)
+    names = {item['id']: item['name'] for item in catalog.get_items(sorted(dropped))}
+    return [
+        {'item_id': item_id, 'name': names.get(item_id, ''), 'quantity': quantity}
+        for item_id, quantity in sorted(dropped.items())
+    ]
+
+
+def remember_checkout(request, session_id, currency, reservation_ids, order_id=None):
+    """
+    Сохраняет в сессии созданную сессию Stripe Checkout, резервы, которые нужно подтвердить после оплаты,
+    и оплачиваемый заказ.
+    """
+    checkouts = request.session.get('checkouts', {})
+    checkouts[session_id] = {
+        'currency': currency,
+        'reservation_ids': reservation_ids,
+        'order_id': order_id,
+    }
+    request.session['checkouts'] = checkouts
+
+class ListItemAPIView(APIView):
     """
     Возвращает список всех товаров.
+    Товары читаются из снимка каталога в памяти без обращения к БД, поэтому страница
+    продолжает работать, даже если БД недоступна.
+    Популярные товары по каждой валюте берутся из кеша, который обновляет команда rollup_popularity.
     """
-    queryset = Item.objects.all()
     renderer_classes = [TemplateHTMLRenderer]
-    serializer_class = ItemSerializer
     permission_classes = [AllowAny]
+    authentication_classes = []
     template_name = 'list.html'
 
-    def list(self, request, *args, **kwargs):
-        queryset = self.get_queryset()
-        serializer = self.get_serializer(queryset, many=True)
+    def get(self, request):
+        try:
+            has_order = 'order_id' in request.session
+        except DatabaseError:
+            has_order = False
+        items = catalog.list_items()
         return Response({
-            'object_list': serializer.data
+            'object_list': items,
+            'popular': popularity.get_popular_items(items),
+            'has_order': has_order,
         })
 
 class OrderAPIView(APIView):
     """
     Возвращает текущий заказ(корзину) пользователя.
     Если заказ(корзина) не существует, создает новый.
+    Перед чтением сбрасывает в БД отложенные изменения корзины и показывает товары,
+    которые при этом не удалось добавить.
+    При CHECKOUT_PRECREATE=True запускает в фоне создание сессии Stripe Checkout для текущей корзины,
+    чтобы кнопка оплаты не ждала Stripe.
     """
     renderer_classes=[TemplateHTMLRenderer]
     permission_classes=[AllowAny]
+    use_primary_db=True
     template_name='order.html'
     def get(self, request):
         order = get_or_create_order(request)
+        cart.flush(order)
+        dropped = get_dropped_items(order)
         currency = get_order_currency(order)
         serializer = OrderSerializer(order)
+        order_items = list(order.orderitem_set.select_related('item'))
+        if order_items and all(order_item.item.currency == currency for order_item in order_items):
+            precheckout.prepare(order, order_items, currency)
         return Response({
             'order': serializer.data,
+            'dropped': dropped,
             'STRIPE_PUBLIC_KEY': settings.STRIPE_KEYS[currency]['public']
         })
 
@@ -74,34 +188,109 @@ class AddToOrderAPIView(APIView):
     Если товар уже есть в заказе(корзине), увеличивает его количество.
     Если заказа(корзины) нет, создает новый.
     Если товар с другой валютой, возвращает ошибку.
+    Резервирует единицу товара на складе, если товара нет в наличии, возвращает ошибку.
+    При CART_WRITE_BEHIND=True изменение откладывается в буфер корзины в кеше и записывается в БД пачкой,
+    а товар резервируется при сбросе буфера. Наличие товара проверяется сразу.
     """
     permission_classes=[AllowAny]
+    rate_limit_scope='add_to_order'
     renderer_classes=[TemplateHTMLRenderer]
     template_name='add_to_order.html'
     def post(self, request, item_id):
-        item = get_object_or_404(Item, id=item_id)
-        order = get_or_create_order(request)
-        order_items = order.orderitem_set.all()
-        for order_item in order_items:
-            if order_item.item.currency != item.currency:
+        item = catalog.get_item(item_id)
+        if item is None:
+            raise Http404
+        order = get_or_create_order(request, item['currency'])
+        if settings.CART_WRITE_BEHIND:
+            try:
+                cart.buffer_add(order, item)
+            except cart.CurrencyMismatch:
                 return Response({
                     'error': 'Невозможно добавить товар с другой валютой в текущий заказ'
                 }, status=400)
-        order_item, created = OrderItem.objects.get_or_create(
-            order=order,
-            item=item,
-            defaults={'quantity': 1}
-        )
-        if not created:
-            order_item.quantity += 1
-            order_item.save()
+            except inventory.OutOfStock:
+                return Response({
+                    'error': 'Товара нет в наличии'
+                }, status=409)
+            popularity.record(item['id'], 'add')
+            return Response({
+                'message': 'Предмет успешно добавлен в корзину'
+            })
+        if order.orderitem_set.exclude(item__currency=item['currency']).exists():
+            return Response({
+                'error': 'Невозможно добавить товар с другой валютой в текущий заказ'
+            }, status=400)
+        try:
+            with shards.atomic(order):
+                inventory.reserve(item['id'], 1, order)
+                order_item, created = order.orderitem_set.get_or_create(
+                    item_id=item['id'],
+                    defaults={'quantity': 1}
+                )
+                if not created:
+                    order_item.quantity += 1
+                    order_item.save()
+                inventory.extend_order_reservations(order)
+        except inventory.OutOfStock:
+            return Response({
+                'error': 'Товара нет в наличии'
+            }, status=409)
+        popularity.record(item['id'], 'add')
         return Response({
             'message': 'Предмет успешно добавлен в корзину'
         })
     
+class BatchOrderAPIView(APIView):
+    """
+    Применяет к текущему заказу(корзине) пакет операций за один запрос.
+    Операции: set — установить количество, increment — увеличить количество, remove — удалить товар.
+    Все изменения применяются в одной транзакции несколькими запросами на весь пакет, а не на каждый товар.
+    Если товары в пакете или в корзине в разных валютах, возвращает ошибку и ничего не меняет.
+    Резервы на складе приводятся к новым количествам, если товара не хватает, ничего не меняет.
+    Отложенные добавления в корзину записываются до применения пакета.
+    Возвращает обновленный заказ(корзину).
+    """
+    permission_classes = [AllowAny]
+    renderer_classes = [JSONRenderer]
+    rate_limit_scope = 'add_to_order'
+
+    def post(self, request):
+        serializer = CartBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data['operations']
+
+        items = {}
+        for operation in operations:
+            if operation['op'] != 'remove' and operation['item_id'] not in items:
+                item = catalog.get_item(operation['item_id'])
+                if item is None:
+                    return Response({'error': f"Товар {operation['item_id']} не найден"}, status=404)
+                items[item['id']] = item
+        currencies = {item['currency'] for item in items.values()}
+        if len(currencies) > 1:
+            return Response({'error': 'Все товары в заказе должны быть в одной валюте'}, status=400)
+
+        order = get_or_create_order(request, next(iter(currencies), None))
+        cart.flush(order)
+        try:
+            added = cart.apply_operations(order, operations, currencies)
+        except inventory.OutOfStock as e:
+            return Response({'error': f'Товара {e.item_id} нет в наличии в нужном количестве'}, status=409)
+        except cart.CurrencyMismatch:
+            return Response({
+                'error': 'Невозможно добавить товар с другой валютой в текущий заказ'
+            }, status=400)
+        for item_id, quantity in added.items():
+            popularity.record(item_id, 'add', quantity)
+
+        order = Order.objects.using(order._state.db).prefetch_related(
+            Prefetch('orderitem_set', queryset=OrderItem.objects.select_related('item'))
+        ).select_related('discount', 'tax').get(pk=order.pk)
+        return Response({'order': OrderSerializer(order).data})
+
 class ClearOrderAPIView(APIView):
     """
-    Очищает текущий заказ(корзину) пользователя.
+    Очищает текущий заказ(корзину) пользователя и возвращает зарезервированные товары на склад.
     Если заказа(корзины) нет, возвращает сообщение об этом.
     """
     permission_classes = [AllowAny]
@@ -109,9 +298,11 @@ class ClearOrderAPIView(APIView):
     template_name = 'clear_order.html'
     def post(self, request):
         if 'order_id' in request.session:
-            order = Order.objects.filter(pk = request.session['order_id'])
-            order.delete()
+            cart.discard(request.session['order_id'])
+            inventory.release(Reservation.objects.filter(order_id=request.session['order_id']))
+            shards.delete_orders(get_order_db(request), [request.session['order_id']])
             del request.session['order_id']
+            request.session.pop('order_db', None)
             return Response({
                 'message': 'Корзина успешно очищена'
             })
@@ -127,6 +318,7 @@ class AddDiscountAPIView(APIView):
     Если заказа(корзины) нет, создает новый.
     """
     permission_classes = [AllowAny]
+    rate_limit_scope = 'add_discount'
     renderer_classes = [TemplateHTMLRenderer]
     template_name = 'add_discount.html'
     def get(self, request):
@@ -136,7 +328,7 @@ class AddDiscountAPIView(APIView):
     def post(self, request):
         order = get_or_create_order(request)
         discount_name = request.data.get('discount_name')
-        discount = get_object_or_404(Discount, name=discount_name)
+        discount = get_object_or_404(Discount, name=discount_name, active=True)
         if discount.currency != get_order_currency(order):
             return Response({
                 'error': 'Невозможно добавить скидку с другой валютой в текущий заказ'
@@ -163,7 +355,7 @@ class AddTaxAPIView(APIView):
     def post(self, request):
         order = get_or_create_order(request)
         tax_name = request.data.get('tax_name')
-        tax = get_object_or_404(Tax, name=tax_name)
+        tax = get_object_or_404(Tax, name=tax_name, active=True)
         if tax.currency != get_order_currency(order):
             return Response({
                 'error': 'Невозможно добавить налог с другой валютой в текущий заказ'
@@ -177,17 +369,26 @@ class AddTaxAPIView(APIView):
 class ItemAPIView(APIView):
     """
     Возвращает информацию о товаре по его ID и публичный ключ Stripe.
+    Товар читается из снимка каталога в памяти без обращения к БД.
+    Рекомендации «покупают вместе» читаются одним запросом по первичному ключу, если БД недоступна, не показываются.
     Если товар не найден, возвращает 404 ошибку.
     """
     renderer_classes=[TemplateHTMLRenderer]
     permission_classes=[AllowAny]
+    authentication_classes=[]
     template_name='item.html'
     def get(self, request, id):
-        item = get_object_or_404(Item, pk=id)
-        serializer = ItemSerializer(item)
+        item = catalog.get_item(id)
+        if item is None:
+            raise Http404
+        try:
+            neighbours = ItemRecommendation.objects.filter(pk=id).values_list('neighbours', flat=True).first() or []
+        except DatabaseError:
+            neighbours = []
         return Response({
-            'item': serializer.data,
-            'STRIPE_PUBLIC_KEY': settings.STRIPE_KEYS[item.currency]['public'],
+            'item': item,
+            'recommendations': catalog.get_items([neighbour_id for neighbour_id, _ in neighbours]),
+            'STRIPE_PUBLIC_KEY': settings.STRIPE_KEYS[item['currency']]['public'],
         })
 
 class BuyAPIView(APIView):
@@ -195,14 +396,20 @@ class BuyAPIView(APIView):
     Создает сессию Stripe Checkout для покупки товара по его ID.
     Возвращает ID сессии, который используется для перенаправления пользователя на страницу оплаты.
     Если товар не найден, возвращает 404 ошибку.
+    Резервирует единицу товара на время жизни сессии, если товара нет в наличии, возвращает ошибку.
     Если возникает ошибка при создании сессии, возвращает сообщение об ошибке.
     """
     permission_classes=[AllowAny]
+    use_primary_db=True
     def get(self, request, id):
         item = get_object_or_404(Item, pk=id)
         try:
-            stripe.api_key = settings.STRIPE_KEYS[item.currency]['secret']
+            reservations = inventory.reserve(item.id, 1, ttl=settings.INVENTORY_CHECKOUT_TTL + CHECKOUT_TTL_MARGIN)
+        except inventory.OutOfStock:
+            return Response({'error': 'Товара нет в наличии'}, status=409)
+        try:
             checkout_session = stripe.checkout.Session.create(
+                api_key=settings.STRIPE_KEYS[item.currency]['secret'],
                 payment_method_types=['card'],
                 line_items=[
                     {
@@ -218,33 +425,33 @@ class BuyAPIView(APIView):
                     }
                 ],
                 mode='payment',
-                success_url=settings.SITE_URL + '/success/',
+                success_url=settings.SITE_URL + '/success/?session_id={CHECKOUT_SESSION_ID}',
                 cancel_url=settings.SITE_URL + '/cancel/',
+                expires_at=int(time.time()) + settings.INVENTORY_CHECKOUT_TTL,
             )
+            remember_checkout(request, checkout_session.id, item.currency, [r.id for r in reservations])
             return Response({'id': checkout_session.id})
         except Exception as e:
+            inventory.release(Reservation.objects.filter(id__in=[r.id for r in reservations]))
             return Response({'error': str(e)}, status=500)
 
 class BuyIntentAPIView(APIView):
     """
-    Создает платежное намерение для покупки товара по его ID.
+    Возвращает платежное намерение для покупки товара по его ID.
     Возвращает client_secret платежного намерения, который используется для подтверждения оплаты на клиенте.
+    Незавершенное намерение текущей сессии переиспользуется, новое создается только при его отсутствии.
     Если товар не найден, возвращает 404 ошибку.
     Если возникает ошибка при создании платежного намерения, возвращает сообщение об ошибке.
     """
     permission_classes=[AllowAny]
+    use_primary_db=True
     renderer_classes=[JSONRenderer]
     def get(self, request, item_id):
         item = get_object_or_404(Item, pk=item_id)
         try:
-            stripe.api_key = settings.STRIPE_KEYS[item.currency]['secret']
-            payment_intent = stripe.PaymentIntent.create(
-                amount=item.price,
-                currency=item.currency,
-                automatic_payment_methods={'enabled': True},
-            )
+            payment_intent = get_or_create_payment_intent(request, item)
             return Response({
-                             'clientSecret': payment_intent.client_secret,
+                             'clientSecret': payment_intent['client_secret'],
                              'STRIPE_PUBLIC_KEY': settings.STRIPE_KEYS[item.currency]['public']})
         except Exception as e:
             return Response({'error': str(e)}, status=500) 
@@ -252,74 +459,241 @@ class BuyIntentAPIView(APIView):
 class BuyIntentTemplateAPIView(APIView):
     """
     Возвращает HTML-шаблон для страницы оплаты с использованием платежного намерения.
-    Используется для отображения формы оплаты на клиенте.
+    client_secret встраивается прямо в страницу, поэтому клиенту не нужен дополнительный запрос.
+    Повторная загрузка страницы переиспользует намерение сессии без обращения к Stripe.
     """
     renderer_classes = [TemplateHTMLRenderer]
     permission_classes = [AllowAny]
+    use_primary_db = True
     template_name = 'buy_intend.html'
 
     def get(self, request, item_id):
         item = get_object_or_404(Item, pk=item_id)
-        return Response({'item': item,
+        try:
+            payment_intent = get_or_create_payment_intent(request, item)
+        except Exception as e:
+            return Response({'item': ItemSerializer(item).data, 'error': str(e)}, status=500)
+        return Response({'item': ItemSerializer(item).data,
+                         'client_secret': payment_intent['client_secret'],
                          'STRIPE_PUBLIC_KEY': settings.STRIPE_KEYS[item.currency]['public']})
 
+class BuyIntentCompleteAPIView(APIView):
+    """
+    Вызывается клиентом после успешного подтверждения платежного намерения.
+    Удаляет намерение из сессии, чтобы следующая покупка товара создала новое, и перенаправляет на страницу успеха.
+    """
+    permission_classes = [AllowAny]
+
+    def get(self, request, item_id):
+        payment_intents = request.session.get('payment_intents', {})
+        if payment_intents.pop(str(item_id), None):
+            request.session['payment_intents'] = payment_intents
+        return redirect('/success/')
+
+class CheckoutSuccessAPIView(APIView):
+    """
+    Страница успешной оплаты.
+    Проверяет в Stripe, что сессия Checkout из текущей сессии пользователя оплачена,
+    и подтверждает резервы товаров, чтобы они не вернулись на склад.
+    Оплаченный заказ попадает в сводные продажи, а покупатель получает новую пустую корзину.
+    """
+    permission_classes = [AllowAny]
+    renderer_classes = [TemplateHTMLRenderer]
+    use_primary_db = True
+    template_name = 'success.html'
+
+    def get(self, request):
+        checkouts = request.session.get('checkouts', {})
+        session_id = request.query_params.get('session_id')
+        checkout = checkouts.get(session_id)
+        if checkout:
+            try:
+                checkout_session = stripe.checkout.Session.retrieve(
+                    session_id, api_key=settings.STRIPE_KEYS[checkout['currency']]['secret']
+                )
+            except stripe.error.StripeError:
+                checkout_session = None
+            if checkout_session:
+                reconcile.record_checkout_session(checkout_session, checkout['currency'], checkout.get('order_id'))
+            if checkout_session and checkout_session.payment_status == 'paid':
+                inventory.commit(checkout['reservation_ids'])
+                order_id = checkout.get('order_id')
+                if order_id:
+                    reconcile.mark_order_paid(order_id, None)
+                    if request.session.get('order_id') == order_id:
+                        del request.session['order_id']
+                        request.session.pop('order_db', None)
+                del checkouts[session_id]
+                request.session['checkouts'] = checkouts
+        return Response({})
+
 class BuyOrderAPIView(APIView):
     """
     Создает сессию Stripe Checkout для покупки текущего заказа(корзины).
     Возвращает ID сессии, который используется для перенаправления пользователя на страницу оплаты.
     Если заказ(корзина) пуст, возвращает сообщение об ошибке.
+    Продлевает резервы заказа на время жизни сессии, если товара не хватает, возвращает ошибку.
+    Если для корзины в том же составе уже создана сессия заранее (см. OrderAPIView), возвращает ее без обращения к Stripe.
+    Если при записи отложенных добавлений часть товаров не попала в корзину, возвращает ошибку со списком,
+    чтобы покупатель увидел изменившуюся корзину до оплаты.
     """
     permission_classes = [AllowAny]
+    rate_limit_scope = 'buy_order'
+    use_primary_db = True
     
     def get(self, request):
         order = get_or_create_order(request)
-        order_items = order.orderitem_set.all()
+        cart.flush(order)
+        dropped = get_dropped_items(order)
+        if dropped:
+            return Response({
+                'error': 'Часть товаров закончилась, проверьте корзину перед оплатой',
+                'dropped': dropped,
+            }, status=409)
+        order_items = list(order.orderitem_set.select_related('item'))
         
-        if not order_items.exists():
+        if not order_items:
             return Response({'error': 'Заказ пуст'}, status=400)
         currencies = {item.item.currency for item in order_items}
         if len(currencies) > 1:
             return Response({'error': 'Все товары в заказе должны быть в одной валюте'}, status=400)
-        currency = order_items.first().item.currency
+        currency = order_items[0].item.currency
         try:
-            stripe.api_key = settings.STRIPE_KEYS[currency]['secret']
-            line_items = []
-            for order_item in order_items:
-                line_item = {
-                    'price_data': {
-                        'currency': currency,
-                        'unit_amount': order_item.item.price,
-                        'product_data': {
-                            'name': order_item.item.name,
-                            'description': order_item.item.description,
-                        },
-                    },
-                    'quantity': order_item.quantity,
-                }
+            reservation_ids = inventory.ensure_order_reserved(order, settings.INVENTORY_CHECKOUT_TTL + CHECKOUT_TTL_MARGIN)
+        except inventory.OutOfStock as e:
+            return Response({'error': f'Товара {e.item_id} нет в наличии в нужном количестве'}, status=409)
+        checkout_data = precheckout.get_checkout_data(order, order_items, currency)
+        session_id = precheckout.take(order.id, currency, checkout_data)
+        if session_id is None:
+            try:
+                session_id = precheckout.create(order.id, currency, checkout_data)
+            except Exception as e:
+                return Response({'error': str(e)}, status=500)
+        remember_checkout(request, session_id, currency, reservation_ids, order.id)
+        return Response({'id': session_id})
+
+class DatabasePoolStatsAPIView(APIView):
+    """
+    Возвращает статистику пулов соединений с БД текущего процесса gunicorn.
+    Пул у каждого воркера свой, поэтому в ответ добавляется pid процесса.
+    Для баз без пула возвращает null.
+    """
+    permission_classes = [IsAdminUser]
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request):
+        pools = {}
+        for alias in connections:
+            pool = getattr(connections[alias], 'pool', None)
+            pools[alias] = pool.get_stats() if pool else None
+        return Response({
+            'pid': os.getpid(),
+            'pools': pools,
+        })
+
+class RateLimitStatsAPIView(APIView):
+    """
+    Возвращает счетчики запросов, отклоненных лимитами и сбросом нагрузки, по маршрутам.
+    Количество выполняющихся запросов относится к текущему процессу gunicorn.
+    """
+    permission_classes = [IsAdminUser]
+    renderer_classes = [JSONRenderer]
+
+    def get(self, request):
+        return Response({
+            'pid': os.getpid(),
+            'in_flight': ratelimit.in_flight,
+            'rejected': ratelimit.get_rejection_stats(),
+        })
+
+def get_report_period(request):
+    """
+    Период отчета из параметров since и until (YYYY-MM-DD), по умолчанию последние 30 дней.
+    """
+    until = date.fromisoformat(request.query_params['until']) if 'until' in request.query_params else timezone.localdate()
+    since = date.fromisoformat(request.query_params['since']) if 'since' in request.query_params else until - timedelta(days=29)
+    return since, until
 
-                # Добавляем налог, если он есть
-                if order.tax and order.tax.stripe_tax_rate_id:
-                    line_item['tax_rates'] = [order.tax.stripe_tax_rate_id]
+class SalesReportAPIView(APIView):
+    """
+    Отчет о продажах для персонала по предрасчитанным сводным продажам.
+    Параметры: since и until (YYYY-MM-DD, по умолчанию последние 30 дней), currency и group_by (day или item).
+    Суммы возвращаются в центах.
+    """
+    permission_classes = [IsAdminUser]
+    renderer_classes = [JSONRenderer]
+    group_fields = {
+        'day': ['day', 'currency'],
+        'item': ['item_id', 'item__name', 'currency'],
+    }
 
-                line_items.append(line_item)
+    def get(self, request):
+        try:
+            since, until = get_report_period(request)
+        except ValueError:
+            return Response({'error': 'Даты должны быть в формате YYYY-MM-DD'}, status=400)
+        group_by = request.query_params.get('group_by', 'day')
+        if group_by not in self.group_fields:
+            return Response({'error': 'group_by должен быть day или item'}, status=400)
 
-            checkout_data = {
-                'payment_method_types': ['card'],
-                'line_items': line_items,
-                'mode': 'payment',
-                'success_url': settings.SITE_URL + '/success/',
-                'cancel_url': settings.SITE_URL + '/cancel/',
-            }
+        rows = SalesRollup.objects.filter(day__range=(since, until))
+        currency = request.query_params.get('currency')
+        if currency:
+            rows = rows.filter(currency=currency)
+        sums = {field: Sum(field) for field in rollups.AMOUNT_FIELDS}
+        fields = self.group_fields[group_by]
+        return Response({
+            'since': since,
+            'until': until,
+            'rows': list(rows.values(*fields).annotate(**sums).order_by(*fields)),
+            'totals': list(rows.values('currency').annotate(**sums).order_by('currency')),
+        })
 
-            # Добавляем скидку, если она есть
-            if order.discount and order.discount.stripe_coupon_id:
-                checkout_data['discounts'] = [{
-                    'coupon': order.discount.stripe_coupon_id
-                }]
+class OrdersReportAPIView(APIView):
+    """
+    Отчет о заказах для персонала напрямую по таблицам заказов, без сводных продаж.
+    При ORDER_SHARDING запросы к БД заказов выполняются параллельно, а результаты складываются.
+    Параметры: since и until (YYYY-MM-DD, по умолчанию последние 30 дней) и currency.
+    Возвращает по дням и валютам оплаченные заказы, единицы товара и сумму по текущим ценам в центах
+    без скидок и налогов, а по каждой БД — количество заказов, оплаченных заказов и открытых корзин.
+    """
+    permission_classes = [IsAdminUser]
+    renderer_classes = [JSONRenderer]
 
-            checkout_session = stripe.checkout.Session.create(**checkout_data)
+    def get(self, request):
+        try:
+            since, until = get_report_period(request)
+        except ValueError:
+            return Response({'error': 'Даты должны быть в формате YYYY-MM-DD'}, status=400)
+        currency = request.query_params.get('currency')
 
-            return Response({'id': checkout_session.id})
-        except Exception as e:
-            return Response({'error': str(e)}, status=500)
+        def load(alias):
+            lines = OrderItem.objects.using(alias).filter(order__paid_at__date__range=(since, until))
+            if currency:
+                lines = lines.filter(item__currency=currency)
+            rows = (
+                lines.annotate(day=TruncDate('order__paid_at'))
+                .values('day', 'item__currency')
+                .annotate(orders=Count('order', distinct=True), units=Sum('quantity'), gross=Sum(F('quantity') * F('item__price')))
+            )
+            return list(rows), Order.objects.using(alias).aggregate(orders=Count('id'), paid=Count('paid_at'))
 
+        totals = {}
+        databases = {}
+        for alias, (rows, orders) in shards.fan_out(load).items():
+            # Каждый заказ хранится только в одной БД, поэтому суммы по БД можно складывать
+            for row in rows:
+                key = (row['day'], row['item__currency'])
+                current = totals.setdefault(key, {'orders': 0, 'units': 0, 'gross': 0})
+                for field in current:
+                    current[field] += row[field]
+            databases[alias] = {**orders, 'open': orders['orders'] - orders['paid']}
+        return Response({
+            'since': since,
+            'until': until,
+            'rows': [
+                {'day': day, 'currency': row_currency, **values}
+                for (day, row_currency), values in sorted(totals.items())
+            ],
+            'databases': databases,
+        })
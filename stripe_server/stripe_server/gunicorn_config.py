@@ -0,0 +1,41 @@
+"""
+Gunicorn config for stripe_server project.
+
+Usage: gunicorn -c python:stripe_server.gunicorn_config stripe_server.wsgi:application
+
+Every value can be overridden from the environment, defaults are derived from the CPU count.
+"""
+
+import multiprocessing
+import os
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8000')
+
+# gthread держит несколько потоков на воркер: запросы к Stripe и БД в основном ждут I/O
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('GUNICORN_WORKERS', cpu_count * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 4 if worker_class == 'gthread' else 1))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Приложение импортируется один раз в мастере, воркеры форкаются уже прогретыми
+preload_app = os.getenv('GUNICORN_PRELOAD', 'True') == 'True'
+
+# Периодический перезапуск воркеров со случайным разбросом, чтобы они не рестартовали одновременно
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.getenv('GUNICORN_ACCESSLOG', '-')
+errorlog = os.getenv('GUNICORN_ERRORLOG', '-')
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
+
+
+def post_fork(server, worker):
+    # Соединения с БД, открытые в мастере до форка, не должны разделяться между воркерами
+    from django.db import connections
+    connections.close_all()
@@ -11,7 +11,9 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
+from django.core.exceptions import ImproperlyConfigured
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -42,6 +44,9 @@ STRIPE_KEYS ={
     }
 }
 
+# Адрес Stripe API, например локального поддельного Stripe (manage.py run_fake_stripe)
+STRIPE_API_BASE = os.getenv('STRIPE_API_BASE')
+
 SITE_URL = os.getenv('SITE_URL', 'http://localhost:8000')
 # Application definition
 
@@ -57,6 +62,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'payments.middleware.HealthCheckMiddleware',
+    'payments.middleware.RateLimitMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -98,9 +105,242 @@ DATABASES = {
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 0)),
+        'CONN_HEALTH_CHECKS': os.getenv('DB_CONN_HEALTH_CHECKS', 'True') == 'True',
+        'OPTIONS': {},
+    }
+}
+
+# Connection pool (psycopg 3)
+# https://docs.djangoproject.com/en/5.2/ref/databases/#connection-pool
+# Пул живет в каждом процессе gunicorn, поэтому суммарно к БД открывается до DB_POOL_MAX_SIZE * GUNICORN_WORKERS соединений.
+# Пул несовместим с постоянными соединениями, поэтому CONN_MAX_AGE в этом режиме игнорируется.
+
+DB_POOL = os.getenv('DB_POOL', 'False') == 'True'
+
+if DB_POOL and DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 2)),
+        'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 10)),
+        'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+        'max_waiting': int(os.getenv('DB_POOL_MAX_WAITING', 0)),
+        'max_idle': float(os.getenv('DB_POOL_MAX_IDLE', 600)),
+        'max_lifetime': float(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+    }
+
+# PgBouncer в режиме transaction pooling: соединение с сервером меняется между транзакциями,
+# поэтому нельзя использовать серверные курсоры и подготовленные запросы.
+
+DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'False') == 'True'
+
+if DB_PGBOUNCER:
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+    DATABASES['default']['OPTIONS']['prepare_threshold'] = None
+
+
+# SQLite for single-node deployments
+# https://docs.djangoproject.com/en/5.2/ref/databases/#sqlite-notes
+# WAL позволяет читать параллельно с записью, busy_timeout заставляет писателей ждать блокировку вместо ошибки
+# "database is locked". Транзакции открываются как BEGIN IMMEDIATE: блокировка записи берется в начале atomic(),
+# поэтому транзакция корзины, которая сначала читает, а потом пишет, не падает при повышении блокировки.
+# Чтения вне atomic() идут в autocommit и блокировку записи не берут, поэтому в atomic() оборачивается
+# только запись, а ATOMIC_REQUESTS с этим профилем не включается: каждый запрос стал бы писателем.
+
+DB_SQLITE_TUNING = os.getenv('DB_SQLITE_TUNING', 'True') == 'True'
+
+if DB_SQLITE_TUNING and DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['default']['OPTIONS'].update({
+        'init_command': ';'.join([
+            'PRAGMA journal_mode=WAL',
+            f"PRAGMA busy_timeout={int(os.getenv('DB_SQLITE_BUSY_TIMEOUT', 5000))}",
+            'PRAGMA synchronous=NORMAL',
+            f"PRAGMA mmap_size={int(os.getenv('DB_SQLITE_MMAP_SIZE', 268435456))}",
+            f"PRAGMA cache_size={int(os.getenv('DB_SQLITE_CACHE_SIZE', -65536))}",
+        ]),
+        'transaction_mode': 'IMMEDIATE',
+    })
+
+# Read replicas
+# Чтения каталога направляются на реплику, корзина и оплата работают с primary.
+# Для локальной проверки маршрутизации подойдет копия файла SQLite primary: DB_REPLICA_NAME=replica.sqlite3.
+# Копия не реплицируется, ее нужно снимать заново после изменений каталога.
+
+DB_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 5))
+DATABASE_ROUTERS = []
+
+if os.getenv('DB_REPLICA_HOST') or os.getenv('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.getenv('DB_REPLICA_NAME', DATABASES['default']['NAME']),
+        'HOST': os.getenv('DB_REPLICA_HOST', DATABASES['default']['HOST']),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'USER': os.getenv('DB_REPLICA_USER', DATABASES['default']['USER']),
+        'PASSWORD': os.getenv('DB_REPLICA_PASSWORD', DATABASES['default']['PASSWORD']),
+        'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        'TEST': {'MIRROR': 'default'},
     }
+    # В реплику не пишут, поэтому ее транзакции не должны брать блокировку записи
+    DATABASES['replica']['OPTIONS'].pop('transaction_mode', None)
+    DATABASE_ROUTERS.append('payments.routers.ReplicaRouter')
+    MIDDLEWARE.append('payments.middleware.PrimaryDatabasePinningMiddleware')
+
+
+# Order sharding
+# Заказы и их строки хранятся в отдельной БД для каждой валюты (alias orders_usd, orders_eur, ...),
+# остальные таблицы остаются на primary. Id заказов в БД валюты начинаются с DB_ORDERS_<CUR>_ID_OFFSET,
+# поэтому по id всегда понятно, где лежит заказ. DB_ORDERS_<CUR>_NAME обязателен, остальные незаданные
+# параметры подключения берутся из default. Каждая валюта должна указывать на свою БД.
+# Для локальной проверки достаточно файлов SQLite: DB_ORDERS_USD_NAME=orders_usd.sqlite3 DB_ORDERS_EUR_NAME=orders_eur.sqlite3
+
+ORDER_SHARDING = os.getenv('ORDER_SHARDING', 'False') == 'True'
+ORDER_SHARDS = {}
+
+if ORDER_SHARDING:
+    for index, currency in enumerate(STRIPE_KEYS, start=1):
+        prefix = f'DB_ORDERS_{currency.upper()}_'
+        alias = f'orders_{currency}'
+        if not os.getenv(prefix + 'NAME'):
+            raise ImproperlyConfigured(f'ORDER_SHARDING требует {prefix}NAME для БД заказов в {currency}')
+        DATABASES[alias] = {
+            **DATABASES['default'],
+            'NAME': os.getenv(prefix + 'NAME'),
+            'HOST': os.getenv(prefix + 'HOST', DATABASES['default']['HOST']),
+            'PORT': os.getenv(prefix + 'PORT', DATABASES['default']['PORT']),
+            'USER': os.getenv(prefix + 'USER', DATABASES['default']['USER']),
+            'PASSWORD': os.getenv(prefix + 'PASSWORD', DATABASES['default']['PASSWORD']),
+            'OPTIONS': dict(DATABASES['default']['OPTIONS']),
+        }
+        ORDER_SHARDS[currency] = {
+            'alias': alias,
+            'id_offset': int(os.getenv(prefix + 'ID_OFFSET', index * 10 ** 12)),
+        }
+    targets = {}
+    for alias in ['default'] + [shard['alias'] for shard in ORDER_SHARDS.values()]:
+        target = tuple(DATABASES[alias][key] for key in ('HOST', 'PORT', 'NAME'))
+        if target in targets:
+            raise ImproperlyConfigured(f'БД заказов {alias} совпадает с {targets[target]}: у каждой валюты должна быть своя БД')
+        targets[target] = alias
+    DATABASE_ROUTERS.insert(0, 'payments.routers.OrderShardRouter')
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# Для общих между процессами лимитов запросов нужен общий кеш, например
+# CACHE_BACKEND=django.core.cache.backends.redis.RedisCache CACHE_LOCATION=redis://redis:6379/0
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+# Кеши, данные которых видны только в одном процессе
+LOCAL_CACHE_BACKENDS = [
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+]
+
+
+# Catalog snapshot
+# Каталог товаров хранится в бинарном файле, который отображается в память всеми воркерами.
+# Файл перестраивается при изменении товаров и командой build_catalog_snapshot.
+# Изменения за CATALOG_SNAPSHOT_DEBOUNCE секунд собираются в одно перестроение. Версия каталога хранится в кеше:
+# при общем кеше процессы на других хостах раз в CATALOG_SNAPSHOT_CHECK_INTERVAL секунд сверяют с ней свой файл,
+# и файл хоста перестраивает один из них.
+
+CATALOG_SNAPSHOT_ENABLED = os.getenv('CATALOG_SNAPSHOT_ENABLED', 'True') == 'True'
+CATALOG_SNAPSHOT_PATH = os.getenv('CATALOG_SNAPSHOT_PATH', os.path.join(BASE_DIR, 'catalog.snapshot'))
+CATALOG_SNAPSHOT_DEBOUNCE = float(os.getenv('CATALOG_SNAPSHOT_DEBOUNCE', 1))
+CATALOG_SNAPSHOT_CHECK_INTERVAL = float(os.getenv('CATALOG_SNAPSHOT_CHECK_INTERVAL', 5))
+
+
+# Inventory
+# Срок резерва товара в корзине и время жизни сессии Stripe Checkout (Stripe требует не меньше 30 минут), секунды
+
+INVENTORY_RESERVATION_TTL = int(os.getenv('INVENTORY_RESERVATION_TTL', 900))
+INVENTORY_CHECKOUT_TTL = max(int(os.getenv('INVENTORY_CHECKOUT_TTL', 1800)), 1800)
+
+
+# Popularity
+# События популярности копятся в памяти процесса и сбрасываются в части счетчиков раз в POPULARITY_FLUSH_INTERVAL секунд.
+# Команда rollup_popularity сворачивает их в рейтинг с периодом полураспада POPULARITY_HALF_LIFE секунд.
+# Список популярных хранится в кеше POPULARITY_TOP_TTL секунд: без общего кеша каждый процесс перечитывает его из БД.
+
+POPULARITY_SHARDS = int(os.getenv('POPULARITY_SHARDS', 8))
+POPULARITY_FLUSH_INTERVAL = float(os.getenv('POPULARITY_FLUSH_INTERVAL', 5))
+POPULARITY_HALF_LIFE = int(os.getenv('POPULARITY_HALF_LIFE', 86400))
+POPULARITY_TOP_N = int(os.getenv('POPULARITY_TOP_N', 5))
+POPULARITY_TOP_TTL = int(os.getenv('POPULARITY_TOP_TTL', 300))
+POPULARITY_WEIGHTS = {
+    'add': int(os.getenv('POPULARITY_WEIGHT_ADD', 1)),
+    'purchase': int(os.getenv('POPULARITY_WEIGHT_PURCHASE', 5)),
+}
+
+
+# Recommendations
+# Матрица совместных покупок хранится в файле между запусками build_recommendations, чтобы обрабатывать только новые заказы.
+# Заказы, оплаченные менее RECOMMENDATIONS_SETTLE_SECONDS секунд назад, откладываются до следующего запуска.
+
+RECOMMENDATIONS_STATE_PATH = os.getenv('RECOMMENDATIONS_STATE_PATH', os.path.join(BASE_DIR, 'recommendations.npz'))
+RECOMMENDATIONS_TOP_K = int(os.getenv('RECOMMENDATIONS_TOP_K', 10))
+RECOMMENDATIONS_MIN_SUPPORT = int(os.getenv('RECOMMENDATIONS_MIN_SUPPORT', 1))
+RECOMMENDATIONS_SETTLE_SECONDS = int(os.getenv('RECOMMENDATIONS_SETTLE_SECONDS', 60))
+
+
+# Cart write-behind
+# Добавления в корзину копятся в буфере в кеше и записываются в БД пачкой перед просмотром корзины и оплатой.
+# Буфер должен быть общим для всех процессов, поэтому режим требует общего кеша (CACHE_BACKEND), например Redis.
+# Через CART_BUFFER_FLUSH_DELAY секунд после первого добавления буфер записывает воркер run_jobs.
+
+CART_WRITE_BEHIND = os.getenv('CART_WRITE_BEHIND', 'False') == 'True'
+CART_BUFFER_TTL = int(os.getenv('CART_BUFFER_TTL', 86400))
+CART_BUFFER_MAX_PENDING = int(os.getenv('CART_BUFFER_MAX_PENDING', 50))
+CART_BUFFER_LOCK_TIMEOUT = float(os.getenv('CART_BUFFER_LOCK_TIMEOUT', 5))
+CART_BUFFER_FLUSH_DELAY = int(os.getenv('CART_BUFFER_FLUSH_DELAY', 300))
+
+if CART_WRITE_BEHIND and CACHES['default']['BACKEND'] in LOCAL_CACHE_BACKENDS:
+    raise ImproperlyConfigured('CART_WRITE_BEHIND требует общего кеша (CACHE_BACKEND), например Redis')
+
+
+# Checkout pre-creation
+# При просмотре корзины сессия Stripe Checkout создается заранее в фоновых потоках процесса и хранится в кеше
+# CHECKOUT_PRECREATE_MAX_AGE секунд. /buy_order/ отдает ее, если состав корзины не изменился.
+# Выключено по умолчанию: требует общего кеша (CACHE_BACKEND), иначе с несколькими воркерами сессия
+# найдется только в том же процессе, а остальные будут создавать ее заново.
+
+CHECKOUT_PRECREATE = os.getenv('CHECKOUT_PRECREATE', 'False') == 'True'
+CHECKOUT_PRECREATE_MAX_AGE = min(int(os.getenv('CHECKOUT_PRECREATE_MAX_AGE', 600)), INVENTORY_CHECKOUT_TTL // 2)
+CHECKOUT_PRECREATE_WORKERS = int(os.getenv('CHECKOUT_PRECREATE_WORKERS', 4))
+
+
+# Rate limiting
+# Лимиты задаются для маршрутов с атрибутом rate_limit_scope: rate — скорость пополнения токенов, burst — емкость корзины.
+
+RATE_LIMITS = {
+    'add_to_order': {
+        'rate': os.getenv('RATE_LIMIT_ADD_TO_ORDER', '60/min'),
+        'burst': int(os.getenv('RATE_LIMIT_ADD_TO_ORDER_BURST', 20)),
+    },
+    'add_discount': {
+        'rate': os.getenv('RATE_LIMIT_ADD_DISCOUNT', '10/min'),
+        'burst': int(os.getenv('RATE_LIMIT_ADD_DISCOUNT_BURST', 5)),
+    },
+    'buy_order': {
+        'rate': os.getenv('RATE_LIMIT_BUY_ORDER', '10/min'),
+        'burst': int(os.getenv('RATE_LIMIT_BUY_ORDER_BURST', 5)),
+    },
 }
 
+RATE_LIMIT_TRUST_X_FORWARDED_FOR = os.getenv('RATE_LIMIT_TRUST_X_FORWARDED_FOR', 'False') == 'True'
+# Во сколько раз лимит корзины IP больше лимита корзины сессии: за одним NAT бывает несколько покупателей
+RATE_LIMIT_IP_MULTIPLIER = int(os.getenv('RATE_LIMIT_IP_MULTIPLIER', 5))
+
+# Количество одновременно выполняющихся запросов процесса, при превышении которого
+# маршруты из RATE_LIMITS получают 503. Должно быть меньше GUNICORN_THREADS, чтобы
+# оставить потоки для каталога. 0 отключает сброс нагрузки.
+LOAD_SHED_MAX_IN_FLIGHT = int(os.getenv('LOAD_SHED_MAX_IN_FLIGHT', 0))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -137,7 +377,7 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = '/static/'
-STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
+STATIC_ROOT = os.getenv('STATIC_ROOT', os.path.join(BASE_DIR, 'staticfiles'))
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
@@ -145,3 +385,33 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Tracing
+# Спаны на представления, запросы к БД, вызовы Stripe и рендеринг шаблонов.
+# TRACING_EXPORTER — путь к классу экспортера: payments.tracing.JsonlFileExporter или payments.tracing.OtlpHttpExporter,
+# TRACING_EXPORTER_OPTIONS — JSON с аргументами экспортера, например {"path": "/var/log/traces.jsonl"}.
+
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'False') == 'True'
+TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', 0.01))
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'payments.tracing.JsonlFileExporter')
+TRACING_EXPORTER_OPTIONS = json.loads(os.getenv('TRACING_EXPORTER_OPTIONS', '{}'))
+
+if TRACING_ENABLED:
+    MIDDLEWARE.insert(MIDDLEWARE.index('payments.middleware.HealthCheckMiddleware') + 1, 'payments.middleware.TracingMiddleware')
+    MIDDLEWARE.append('payments.middleware.TracingViewMiddleware')
+    TEMPLATES[0]['BACKEND'] = 'payments.tracing.TracedDjangoTemplates'
+
+
+# Traffic capture
+# Выборка реальных запросов по сессиям записывается в сжатые файлы CAPTURE_DIR для воспроизведения командой replay_traffic.
+# Строковые значения параметров и тел запросов не записываются, ключ сессии заменяется псевдонимом.
+
+CAPTURE_ENABLED = os.getenv('CAPTURE_ENABLED', 'False') == 'True'
+CAPTURE_SAMPLE_RATE = float(os.getenv('CAPTURE_SAMPLE_RATE', 0.01))
+CAPTURE_DIR = os.getenv('CAPTURE_DIR', os.path.join(BASE_DIR, 'captures'))
+CAPTURE_FILE_MAX_RECORDS = int(os.getenv('CAPTURE_FILE_MAX_RECORDS', 100000))
+CAPTURE_EXCLUDE = [prefix for prefix in os.getenv('CAPTURE_EXCLUDE', '/admin/').split(',') if prefix]
+
+if CAPTURE_ENABLED:
+    MIDDLEWARE.insert(MIDDLEWARE.index('django.contrib.sessions.middleware.SessionMiddleware'), 'payments.middleware.TrafficCaptureMiddleware')